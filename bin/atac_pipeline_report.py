@@ -74,12 +74,37 @@ def parse_trimgalore_log(results_dir, sample):
     
     return data if data else None
 
+def load_rm_orphan_stats(results_dir, sample):
+    """bampe_rm_orphan.py JSON 통계 파일 읽기 (paired-end 샘플만 있음)"""
+    stats_file = os.path.join(results_dir, 'bwa', 'mergedLibrary', f'{sample}.mLb.clN.sorted_bampe_rm_orphan.json')
+    
+    if not os.path.exists(stats_file):
+        return None
+    
+    try:
+        with open(stats_file, 'r') as f:
+            return json.load(f)
+    except:
+        return None
+
 def parse_bwa_flagstat(results_dir, sample):
     """BWA alignment flagstat 파싱"""
     flagstat_file = os.path.join(results_dir, 'bwa', 'mergedLibrary', f'{sample}.mLb.clN.sorted.bam.flagstat')
     
     if not os.path.exists(flagstat_file):
-        return None
+        # flagstat 파일이 없으면 bampe_rm_orphan.py JSON 통계 사용
+        stats = load_rm_orphan_stats(results_dir, sample)
+        if not stats:
+            return None
+        passed = stats['flagstat']['QC-passed reads']
+        return {
+            'total': passed['total'],
+            'duplicates': passed['duplicates'],
+            'mapped': passed['mapped'],
+            'mapped_pct': passed['mapped %'] or 0,
+            'properly_paired': passed['properly paired'],
+            'properly_paired_pct': passed['properly paired %'] or 0
+        }
     
     data = {}
     try:
@@ -222,7 +247,12 @@ def parse_fragment_size(results_dir, sample):
     insert_file = os.path.join(results_dir, 'bwa', 'mergedLibrary', 'picard_metrics', f'{sample}.mLb.clN.sorted.CollectInsertSizeMetrics.txt')
     
     if not os.path.exists(insert_file):
-        return None
+        # Picard 결과가 없으면 bampe_rm_orphan.py JSON 통계 사용
+        stats = load_rm_orphan_stats(results_dir, sample)
+        if not stats or not stats['fragment_length'].get('fragments'):
+            return None
+        fragment_length = stats['fragment_length']
+        return {key: float(fragment_length[key]) for key in ['median', 'mode', 'median_absolute_deviation', 'min', 'max']}
     
     data = {}
     try:
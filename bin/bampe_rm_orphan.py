@@ -7,9 +7,26 @@
 ###############################################################################
 
 import os
+import re
+import sys
+import json
+import math
+import heapq
+import bisect
 import pysam
 import errno
+import queue
 import argparse
+import traceback
+import contextlib
+import array
+import datetime
+import tempfile
+import itertools
+import threading
+import collections
+import multiprocessing
+from genome_intervals import IntervalSet
 
 ############################################
 ############################################
@@ -17,26 +34,196 @@ import argparse
 ############################################
 ############################################
 
-Description = (
-    "Remove singleton reads from paired-end BAM file i.e if read1 is present in BAM file without read 2 and vice versa."
-)
-Epilog = """Example usage: bampe_rm_orphan.py <BAM_INPUT_FILE> <BAM_OUTPUT_FILE>"""
 
-argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+def parse_args(args=None):
+    Description = "Remove singleton reads from paired-end BAM file i.e if read1 is present in BAM file without read 2 and vice versa."
+    Epilog = """Example usage: bampe_rm_orphan.py <BAM_INPUT_FILE> <BAM_OUTPUT_FILE>"""
 
-## REQUIRED PARAMETERS
-argParser.add_argument("BAM_INPUT_FILE", help="Input BAM file sorted by name.")
-argParser.add_argument("BAM_OUTPUT_FILE", help="Output BAM file sorted by name.")
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS UNLESS A MANIFEST IS GIVEN
+    parser.add_argument(
+        "BAM_INPUT_FILE",
+        nargs="?",
+        help="Input BAM file sorted by name (or by coordinate with --sort_order coordinate).",
+    )
+    parser.add_argument("BAM_OUTPUT_FILE", nargs="?", help="Output BAM file with the same sort order as the input.")
+
+    ## OPTIONAL PARAMETERS
+    parser.add_argument(
+        "-mf",
+        "--manifest",
+        dest="MANIFEST",
+        default=None,
+        help="Tab-separated file with one BAM_INPUT_FILE, BAM_OUTPUT_FILE and optional FRAGMENTS_OUTPUT per line to process instead of a single BAM file. All other options apply to every line.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        dest="WORKERS",
+        default=1,
+        help="Number of manifest lines processed at the same time, each in its own process with --threads threads (default: 1).",
+    )
+    parser.add_argument(
+        "-fr",
+        "--only_fr_pairs",
+        dest="ONLY_FR_PAIRS",
+        help="Only keeps pairs that are in FR orientation on same chromosome.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of threads used for BGZF decompression/compression. Values above 1 also run reading, filtering and writing in a pipeline (default: 1).",
+    )
+    parser.add_argument(
+        "-cl",
+        "--compression_level",
+        type=int,
+        dest="COMPRESSION_LEVEL",
+        default=None,
+        choices=range(0, 10),
+        metavar="[0-9]",
+        help="BGZF compression level of the output BAM file, 0 being uncompressed (default: htslib default).",
+    )
+    parser.add_argument(
+        "-so",
+        "--sort_order",
+        dest="SORT_ORDER",
+        default="queryname",
+        choices=["queryname", "coordinate"],
+        help="Sort order of the input BAM file. Coordinate-sorted input is filtered directly by buffering unmatched mates (default: queryname).",
+    )
+    parser.add_argument(
+        "-as",
+        "--auto_sort",
+        dest="AUTO_SORT",
+        help="Take the sort order from the SO field of the input header instead of --sort_order. Input that is neither queryname- nor coordinate-sorted, or coordinate-sorted input with --mark_duplicates, is grouped by read name with an external merge sort and written in queryname order.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-sm",
+        "--sort_memory",
+        type=int,
+        dest="SORT_MEMORY",
+        default=768,
+        help="Approximate memory in megabytes used to hold reads before a sorted run is written to --tmp_dir by --auto_sort (default: 768).",
+    )
+    parser.add_argument(
+        "-mb",
+        "--max_buffered_reads",
+        type=int,
+        dest="MAX_BUFFERED_READS",
+        default=1000000,
+        help="Maximum number of unmatched mates held in memory for coordinate-sorted input before spilling to disk (default: 1000000).",
+    )
+    parser.add_argument(
+        "-td",
+        "--tmp_dir",
+        dest="TMP_DIR",
+        default=None,
+        help="Directory for temporary files written when the mate buffer spills to disk or reads are sorted by name (default: output directory).",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        dest="PROCESSES",
+        default=1,
+        help="Number of worker processes used to filter an indexed coordinate-sorted BAM file in chromosome shards. The --threads are shared between them (default: 1).",
+    )
+    parser.add_argument(
+        "-fc",
+        "--filter_config",
+        dest="FILTER_CONFIG",
+        default=None,
+        help="BAMTools filter JSON file e.g. assets/bamtools_filter_pe.json. Reads failing the rules are removed before pairing.",
+    )
+    parser.add_argument(
+        "-L",
+        "--include_regions",
+        dest="INCLUDE_REGIONS",
+        default=None,
+        help="BED file of regions to keep. Reads not overlapping a region are removed before pairing, as with 'samtools view -L'.",
+    )
+    parser.add_argument(
+        "-f",
+        "--require_flags",
+        dest="REQUIRE_FLAGS",
+        default=[],
+        action="append",
+        help="Only keep reads with all of these SAM flag bits set, as with 'samtools view -f'. Can be given more than once.",
+    )
+    parser.add_argument(
+        "-F",
+        "--exclude_flags",
+        dest="EXCLUDE_FLAGS",
+        default=[],
+        action="append",
+        help="Only keep reads with none of these SAM flag bits set, as with 'samtools view -F'. Can be given more than once.",
+    )
+    parser.add_argument(
+        "-q",
+        "--min_mapq",
+        type=int,
+        dest="MIN_MAPQ",
+        default=0,
+        help="Only keep reads with a mapping quality of at least this value, as with 'samtools view -q' (default: 0).",
+    )
+    parser.add_argument(
+        "-mn",
+        "--mito_name",
+        dest="MITO_NAME",
+        default=None,
+        help="Name of the mitochondrial contig used for the mitochondrial read counts in the JSON stats file. By default any of '%s' is used."
+        % ("', '".join(["chrM", "MT", "M", "chrMT"])),
+    )
+    parser.add_argument(
+        "-fo",
+        "--fragments_output",
+        dest="FRAGMENTS_OUTPUT",
+        default=None,
+        help="Also write the kept pairs as a BGZF-compressed, tabix-indexed fragment file e.g. 'sample.fragments.tsv.gz' with one line per unique fragment: chrom, Tn5-shifted start (+4), Tn5-shifted end (-5) and the number of pairs with those coordinates.",
+    )
+    parser.add_argument(
+        "-md",
+        "--mark_duplicates",
+        dest="MARK_DUPLICATES",
+        help="Mark duplicate pairs with the 0x400 flag. Pairs are duplicates of the first pair seen with the same library, contigs, unclipped 5' positions and strands. Only used with --sort_order queryname.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-rd",
+        "--remove_duplicates",
+        dest="REMOVE_DUPLICATES",
+        help="Remove duplicate pairs instead of marking them. Implies --mark_duplicates.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-dm",
+        "--duplicate_metrics",
+        dest="DUPLICATE_METRICS",
+        default=None,
+        help="Picard MarkDuplicates-style metrics file written when marking duplicates (default: '<BAM_OUTPUT_FILE prefix>.MarkDuplicates.metrics.txt').",
+    )
+    args = parser.parse_args(args)
+
+    if args.MANIFEST:
+        if args.BAM_INPUT_FILE or args.BAM_OUTPUT_FILE:
+            parser.error("BAM_INPUT_FILE and BAM_OUTPUT_FILE cannot be given with --manifest.")
+        if args.FRAGMENTS_OUTPUT or args.DUPLICATE_METRICS:
+            parser.error(
+                "--fragments_output and --duplicate_metrics cannot be given with --manifest. Fragment files are set in "
+                "the fragmentsOut column of the manifest, and duplicate metrics are written next to each output BAM."
+            )
+    elif not args.BAM_OUTPUT_FILE:
+        parser.error("BAM_INPUT_FILE and BAM_OUTPUT_FILE are required without --manifest.")
+    return args
 
-## OPTIONAL PARAMETERS
-argParser.add_argument(
-    "-fr",
-    "--only_fr_pairs",
-    dest="ONLY_FR_PAIRS",
-    help="Only keeps pairs that are in FR orientation on same chromosome.",
-    action="store_true",
-)
-args = argParser.parse_args()
 
 ############################################
 ############################################
@@ -44,6 +231,10 @@ args = argParser.parse_args()
 ############################################
 ############################################
 
+## NUMBER OF READS PASSED BETWEEN PIPELINE THREADS AT A TIME AND MAXIMUM NUMBER OF BATCHES IN FLIGHT
+BATCH_SIZE = 10000
+QUEUE_SIZE = 8
+
 
 def makedir(path):
     if not len(path) == 0:
@@ -54,6 +245,1281 @@ def makedir(path):
                 raise
 
 
+def split_threads(threads):
+    ## BGZF COMPRESSION IS SEVERAL TIMES MORE EXPENSIVE THAN DECOMPRESSION SO GIVE MOST THREADS TO THE WRITER
+    threads = max(1, threads)
+    readThreads = max(1, threads // 4)
+    writeThreads = max(1, threads - readThreads)
+    return readThreads, writeThreads
+
+
+def iter_in_background(iterable, batchSize=BATCH_SIZE, queueSize=QUEUE_SIZE):
+    """
+    Consume an iterable on a separate thread and yield its items through a bounded queue of batches.
+    Used so that BAM decoding overlaps with filtering in the main thread.
+    """
+    batchQueue = queue.Queue(maxsize=queueSize)
+    errors = []
+
+    def producer():
+        try:
+            batch = []
+            for item in iterable:
+                batch.append(item)
+                if len(batch) == batchSize:
+                    batchQueue.put(batch)
+                    batch = []
+            if batch:
+                batchQueue.put(batch)
+        except BaseException as exception:
+            errors.append(exception)
+        finally:
+            batchQueue.put(None)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    while True:
+        batch = batchQueue.get()
+        if batch is None:
+            break
+        for item in batch:
+            yield item
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+class BackgroundWriter(object):
+    """
+    Batch reads and hand them to a separate thread that writes them with writeFunc.
+    Used so that BAM encoding overlaps with filtering in the main thread.
+    """
+
+    def __init__(self, writeFunc, batchSize=BATCH_SIZE, queueSize=QUEUE_SIZE):
+        self.writeFunc = writeFunc
+        self.batchSize = batchSize
+        self.batch = []
+        self.errors = []
+        self.batchQueue = queue.Queue(maxsize=queueSize)
+        self.thread = threading.Thread(target=self._consumer, daemon=True)
+        self.thread.start()
+
+    def _consumer(self):
+        while True:
+            batch = self.batchQueue.get()
+            if batch is None:
+                break
+            if self.errors:
+                continue
+            try:
+                for item in batch:
+                    self.writeFunc(item)
+            except BaseException as exception:
+                self.errors.append(exception)
+
+    def write(self, item):
+        self.batch.append(item)
+        if len(self.batch) == self.batchSize:
+            if self.errors:
+                raise self.errors[0]
+            self.batchQueue.put(self.batch)
+            self.batch = []
+
+    def close(self):
+        if self.batch:
+            self.batchQueue.put(self.batch)
+            self.batch = []
+        self.batchQueue.put(None)
+        self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def is_fr_pair(pair1, pair2):
+    ## FILTER FOR READS ON SAME CHROMOSOME IN FR ORIENTATION
+    if pair1.tid != pair2.tid:
+        return False
+
+    ## READ1 FORWARD AND READ2 REVERSE STRAND
+    if not pair1.is_reverse and pair2.is_reverse:
+        return pair1.reference_start <= pair2.reference_start
+
+    ## READ1 REVERSE AND READ2 FORWARD STRAND
+    if pair1.is_reverse and not pair2.is_reverse:
+        return pair2.reference_start <= pair1.reference_start
+
+    return False
+
+
+def coordinate_sort_key(read):
+    ## UNMAPPED READS WITHOUT A PLACED MATE HAVE A TID OF -1 AND ARE SORTED LAST
+    tid = read.reference_id if read.reference_id >= 0 else sys.maxsize
+    return (tid, read.reference_start)
+
+
+def mate_sort_key(read):
+    tid = read.next_reference_id if read.next_reference_id >= 0 else sys.maxsize
+    return (tid, read.next_reference_start)
+
+
+## STATE OF A READ IN THE OUTPUT WINDOW THAT HAS TO BE WRITTEN TO THE SPILL FILE WHEN IT REACHES THE FRONT
+SPILL_READ = "spill"
+
+## MINIMAL INFORMATION KEPT FOR A MATE THAT IS NO LONGER BUFFERED IN MEMORY. HAS THE ATTRIBUTES USED BY is_fr_pair()
+ParkedMate = collections.namedtuple("ParkedMate", ["tid", "reference_start", "is_reverse"])
+
+
+class SpillFile(object):
+    """
+    Temporary BAM file holding reads evicted from the in-memory mate buffer of filter_coordinate_sorted().
+    Reads are written in input order so the file stays coordinate-sorted.
+    """
+
+    def __init__(self, header, tmpDir):
+        self.header = header
+        self.tmpDir = tmpDir
+        self.path = None
+        self.handle = None
+        self.keptNames = set()
+        self.numReads = 0
+
+    def write(self, read):
+        if self.handle is None:
+            fd, self.path = tempfile.mkstemp(prefix="bampe_rm_orphan.", suffix=".spill.bam", dir=self.tmpDir)
+            os.close(fd)
+            self.handle = pysam.AlignmentFile(self.path, "wb", header=self.header, format_options=["level=1"])
+        self.handle.write(read)
+        self.numReads += 1
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def iter_kept(self):
+        with pysam.AlignmentFile(self.path, "rb") as SAMFin:
+            for read in SAMFin.fetch(until_eof=True):
+                if read.query_name in self.keptNames:
+                    yield read
+
+    def remove(self):
+        self.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+## APPROXIMATE MEMORY USED BY AN ALIGNED SEGMENT ON TOP OF ITS SEQUENCE, QUALITIES AND NAME
+READ_MEMORY_OVERHEAD = 400
+
+## MAXIMUM NUMBER OF SORTED RUN FILES OPENED AT ONCE WHEN MERGING
+MAX_MERGE_RUNS = 64
+
+
+def name_sort_key(read):
+    return read.query_name
+
+
+def name_sorted_header(header):
+    headerDict = header.to_dict()
+    headerDict.setdefault("HD", {"VN": "1.6"})["SO"] = "queryname"
+    return pysam.AlignmentHeader.from_dict(headerDict)
+
+
+class NameSortRuns(object):
+    """
+    Temporary BAM files of reads sorted by name, written by sort_by_name() each time the reads held in memory
+    reach its memory limit. Runs are merged with a heap when read back, a batch at a time if there are many.
+    """
+
+    def __init__(self, header, tmpDir):
+        self.header = header
+        self.tmpDir = tmpDir
+        self.paths = []
+
+    def write(self, reads):
+        fd, path = tempfile.mkstemp(prefix="bampe_rm_orphan.", suffix=".sort.bam", dir=self.tmpDir)
+        os.close(fd)
+        self.paths.append(path)
+        with pysam.AlignmentFile(path, "wb", header=self.header, format_options=["level=1"]) as SAMFout:
+            for read in reads:
+                SAMFout.write(read)
+
+    def merge(self, paths):
+        handles = [pysam.AlignmentFile(x, "rb") for x in paths]
+        try:
+            for read in heapq.merge(*[x.fetch(until_eof=True) for x in handles], key=name_sort_key):
+                yield read
+        finally:
+            for handle in handles:
+                handle.close()
+
+    def iter_sorted(self):
+        while len(self.paths) > MAX_MERGE_RUNS:
+            paths, self.paths = self.paths[:MAX_MERGE_RUNS], self.paths[MAX_MERGE_RUNS:]
+            self.write(self.merge(paths))
+            for path in paths:
+                os.remove(path)
+        return self.merge(self.paths)
+
+    def remove(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.paths = []
+
+
+def sort_by_name(readIter, header, tmpDir, maxMemory):
+    """
+    Yield reads from readIter grouped by name with an external merge sort. Reads are held in memory until their
+    approximate size reaches maxMemory bytes and are then sorted and written to a run file in tmpDir. Input that
+    fits in memory is sorted without writing any files.
+    """
+    runs = NameSortRuns(header, tmpDir)
+    try:
+        reads = []
+        memory = 0
+        for read in readIter:
+            reads.append(read)
+            memory += READ_MEMORY_OVERHEAD + 2 * read.query_length + len(read.query_name)
+            if memory >= maxMemory:
+                reads.sort(key=name_sort_key)
+                runs.write(reads)
+                reads = []
+                memory = 0
+        reads.sort(key=name_sort_key)
+        if not runs.paths:
+            for read in reads:
+                yield read
+        else:
+            if reads:
+                runs.write(reads)
+                reads = []
+            for read in runs.iter_sorted():
+                yield read
+    finally:
+        runs.remove()
+
+
+def filter_name_sorted(readIter, counts, onlyFRPairs=False):
+    """
+    Yield reads from a name-sorted BAM file whose mate is also present, updating counts in place.
+    """
+    currRead = None
+    for read in readIter:
+        counts["totalReads"] += 1
+        if currRead is None:
+            currRead = read
+        elif currRead.query_name == read.query_name:
+            if not onlyFRPairs or is_fr_pair(currRead, read):
+                counts["totalOutputPairs"] += 1
+                yield currRead
+                yield read
+            else:
+                counts["totalImproperPairs"] += 1
+            currRead = None
+
+        ## READS WHERE ONLY ONE OF A PAIR IS IN FILE
+        else:
+            counts["totalSingletons"] += 1
+            currRead = read
+
+    if currRead is not None:
+        counts["totalSingletons"] += 1
+
+
+def filter_coordinate_sorted(
+    readIter,
+    counts,
+    spillFile,
+    onlyFRPairs=False,
+    maxBufferedReads=1000000,
+    shardTids=None,
+    crossShardMates=None,
+):
+    """
+    Yield reads from a coordinate-sorted BAM file whose mate is also present, updating counts in place.
+    Output order is the same as the input order.
+
+    Reads waiting for their mate are buffered by query name. A buffered read is dropped as a singleton once the
+    input has moved past the position recorded for its mate. When more than maxBufferedReads are waiting, the
+    oldest are moved to spillFile and the names of the ones whose mate turns up are added to spillFile.keptNames
+    so they can be merged back into the output afterwards.
+
+    When only the contigs in shardTids are being read, reads whose mate is on another contig are not counted
+    here. They are recorded in crossShardMates, and written to spillFile when they could still be kept, so that
+    they can be resolved once every shard has been filtered.
+    """
+    pending = {}
+    parked = {}
+    window = collections.deque()
+    mateHeap = []
+    prevKey = None
+    seq = 0
+
+    ## READS ARE ONLY WRITTEN WHEN THEY REACH THE FRONT OF THE WINDOW SO BOTH OUTPUT AND SPILL FILE STAY SORTED
+    def flush_window():
+        while window and window[0][1] is not None:
+            slot = window.popleft()
+            if slot[1] is True:
+                yield slot[0]
+            elif slot[1] == SPILL_READ:
+                spillFile.write(slot[0])
+
+    for read in readIter:
+        counts["totalReads"] += 1
+        key = coordinate_sort_key(read)
+        if prevKey is not None and key < prevKey:
+            raise ValueError(
+                "Input BAM file is not sorted by coordinate at read '%s'. Use --sort_order queryname for name-sorted input."
+                % (read.query_name)
+            )
+        prevKey = key
+
+        ## DROP BUFFERED READS WHOSE MATE SHOULD ALREADY HAVE BEEN SEEN
+        while mateHeap and mateHeap[0][0] < key:
+            mateKey, slotSeq, qname = heapq.heappop(mateHeap)
+            slot = pending.get(qname)
+            if slot is not None and slot[2] == slotSeq:
+                del pending[qname]
+                slot[1] = False
+                counts["totalSingletons"] += 1
+
+        qname = read.query_name
+        if qname in pending:
+            ## MATE IS BUFFERED IN MEMORY
+            slot = pending.pop(qname)
+            if not onlyFRPairs or is_fr_pair(slot[0], read):
+                counts["totalOutputPairs"] += 1
+                slot[1] = True
+                window.append([read, True, None])
+            else:
+                counts["totalImproperPairs"] += 1
+                slot[1] = False
+
+        elif qname in parked:
+            ## MATE WAS SPILLED TO DISK OR ONLY KEPT FOR COUNTING
+            mate, spilled = parked.pop(qname)
+            if not onlyFRPairs or is_fr_pair(mate, read):
+                counts["totalOutputPairs"] += 1
+                spillFile.keptNames.add(qname)
+                window.append([read, True, None])
+            else:
+                counts["totalImproperPairs"] += 1
+
+        elif shardTids is not None and read.next_reference_id not in shardTids:
+            ## MATE IS IN ANOTHER SHARD SO RESOLVE IT ONCE ALL SHARDS HAVE BEEN FILTERED
+            crossShardMates[qname] = ParkedMate(read.reference_id, read.reference_start, read.is_reverse)
+            if not onlyFRPairs:
+                window.append([read, SPILL_READ, None])
+
+        else:
+            mateKey = mate_sort_key(read)
+            if mateKey < key:
+                ## MATE POSITION HAS ALREADY BEEN PASSED SO IT ISNT IN THE FILE
+                counts["totalSingletons"] += 1
+            elif onlyFRPairs and read.next_reference_id != read.reference_id:
+                ## PAIR WILL BE EXCLUDED REGARDLESS SO ONLY REMEMBER THE NAME FOR THE COUNTS
+                parked[qname] = (ParkedMate(read.reference_id, read.reference_start, read.is_reverse), False)
+            else:
+                slot = [read, None, seq]
+                pending[qname] = slot
+                window.append(slot)
+                heapq.heappush(mateHeap, (mateKey, seq, qname))
+                seq += 1
+
+                ## SPILL OLDEST UNMATCHED READS TO DISK WHEN THE BUFFER IS FULL
+                while len(pending) > maxBufferedReads:
+                    for outRead in flush_window():
+                        yield outRead
+                    slot = window.popleft()
+                    spillRead = slot[0]
+                    del pending[spillRead.query_name]
+                    spillFile.write(spillRead)
+                    parked[spillRead.query_name] = (
+                        ParkedMate(spillRead.reference_id, spillRead.reference_start, spillRead.is_reverse),
+                        True,
+                    )
+
+        for outRead in flush_window():
+            yield outRead
+
+    ## ANY READS STILL WAITING FOR THEIR MATE ARE SINGLETONS
+    for slot in pending.values():
+        slot[1] = False
+    counts["totalSingletons"] += len(pending) + len(parked)
+    for outRead in flush_window():
+        yield outRead
+
+
+def merge_spilled_reads(BAMOut, spillFile, threads=1, formatOptions=None, stats=None, fragments=None):
+    """
+    Merge reads from spillFile whose mate was kept back into the coordinate-sorted BAMOut, adding them to stats
+    and fragments.
+    """
+    readThreads, writeThreads = split_threads(threads)
+    unmergedBAM = BAMOut + ".unmerged.bam"
+    os.replace(BAMOut, unmergedBAM)
+    with pysam.AlignmentFile(unmergedBAM, "rb", threads=readThreads) as SAMFin:
+        with pysam.AlignmentFile(
+            BAMOut, "wb", header=SAMFin.header, threads=writeThreads, format_options=formatOptions or []
+        ) as SAMFout:
+            keptReads = spillFile.iter_kept()
+            if stats is not None:
+                keptReads = count_reads(keptReads, stats, fragments)
+            for read in heapq.merge(SAMFin.fetch(until_eof=True), keptReads, key=coordinate_sort_key):
+                SAMFout.write(read)
+    os.remove(unmergedBAM)
+
+
+## NAMES COMMONLY GIVEN TO THE MITOCHONDRIAL CONTIG
+MITO_NAMES = ["chrM", "MT", "M", "chrMT"]
+
+## SAMTOOLS FLAGSTAT FIELDS IN THE ORDER THEY ARE REPORTED
+FLAGSTAT_FIELDS = [
+    "total",
+    "primary",
+    "secondary",
+    "supplementary",
+    "duplicates",
+    "primary duplicates",
+    "mapped",
+    "mapped %",
+    "primary mapped",
+    "primary mapped %",
+    "paired in sequencing",
+    "read1",
+    "read2",
+    "properly paired",
+    "properly paired %",
+    "with itself and mate mapped",
+    "singletons",
+    "singletons %",
+    "with mate mapped to a different chr",
+    "with mate mapped to a different chr (mapQ >= 5)",
+]
+
+
+def percentage(numerator, denominator):
+    return round(100.0 * numerator / denominator, 2) if denominator else None
+
+
+class ReadStats(object):
+    """
+    Tally the reads written to the output BAM file so that samtools flagstat, per-contig and fragment length
+    summaries can be reported without another pass over the file. Reads are only counted by flag, contig and
+    mate contig here. Everything else is derived from those tallies in to_dict().
+    """
+
+    def __init__(self):
+        self.recordCounts = collections.defaultdict(int)
+        self.diffChrCounts = collections.defaultdict(int)
+        self.fragmentLengths = collections.defaultdict(int)
+        self.filterReasons = collections.defaultdict(int)
+
+    def add(self, read):
+        flag = read.flag
+        tid = read.reference_id
+        self.recordCounts[flag, tid] += 1
+        if read.next_reference_id != tid:
+            self.diffChrCounts[flag, read.mapping_quality >= 5] += 1
+
+        ## ONE FRAGMENT PER PAIR FROM THE PRIMARY FIRST MATE
+        if flag & 0x40:
+            tlen = read.template_length
+            if tlen and not flag & 0x900:
+                self.fragmentLengths[abs(tlen)] += 1
+
+    def add_filtered(self, read, reasons):
+        for reason, test in reasons:
+            if not test(read):
+                self.filterReasons[reason] += 1
+                break
+
+    def update(self, other):
+        for attr in ["recordCounts", "diffChrCounts", "fragmentLengths", "filterReasons"]:
+            tally = getattr(self, attr)
+            for key, count in getattr(other, attr).items():
+                tally[key] += count
+
+    def flagstat(self):
+        ## SAME FIELDS AND DEFINITIONS AS 'samtools flagstat -O json'
+        stats = [collections.Counter(), collections.Counter()]
+        for (flag, tid), count in self.recordCounts.items():
+            fs = stats[1 if flag & 0x200 else 0]
+            mapped = not flag & 0x4
+            fs["total"] += count
+            fs["mapped"] += count if mapped else 0
+            fs["duplicates"] += count if flag & 0x400 else 0
+            if flag & 0x100:
+                fs["secondary"] += count
+            elif flag & 0x800:
+                fs["supplementary"] += count
+            else:
+                fs["primary"] += count
+                fs["primary mapped"] += count if mapped else 0
+                fs["primary duplicates"] += count if flag & 0x400 else 0
+                if flag & 0x1:
+                    fs["paired in sequencing"] += count
+                    fs["read1"] += count if flag & 0x40 else 0
+                    fs["read2"] += count if flag & 0x80 else 0
+                    fs["properly paired"] += count if (flag & 0x2 and mapped) else 0
+                    fs["singletons"] += count if (flag & 0x8 and mapped) else 0
+                    fs["with itself and mate mapped"] += count if (mapped and not flag & 0x8) else 0
+        for (flag, highMapQ), count in self.diffChrCounts.items():
+            if not flag & 0x90C and flag & 0x1:
+                fs = stats[1 if flag & 0x200 else 0]
+                fs["with mate mapped to a different chr"] += count
+                fs["with mate mapped to a different chr (mapQ >= 5)"] += count if highMapQ else 0
+
+        flagstat = {}
+        for key, fs in zip(["QC-passed reads", "QC-failed reads"], stats):
+            fs["mapped %"] = percentage(fs["mapped"], fs["total"])
+            fs["primary mapped %"] = percentage(fs["primary mapped"], fs["primary"])
+            fs["properly paired %"] = percentage(fs["properly paired"], fs["paired in sequencing"])
+            fs["singletons %"] = percentage(fs["singletons"], fs["paired in sequencing"])
+            flagstat[key] = collections.OrderedDict([(field, fs[field]) for field in FLAGSTAT_FIELDS])
+        return flagstat
+
+    def fragment_length_summary(self):
+        ## SAME SUMMARY STATISTICS AS PICARD CollectInsertSizeMetrics
+        numFragments = sum(self.fragmentLengths.values())
+        if not numFragments:
+            return {"fragments": 0}
+        lengths = sorted(self.fragmentLengths.items())
+        median = histogram_median(lengths, numFragments)
+        deviations = collections.Counter()
+        for length, count in lengths:
+            deviations[abs(length - median)] += count
+        return {
+            "fragments": numFragments,
+            "median": median,
+            "mode": max(lengths, key=lambda x: (x[1], -x[0]))[0],
+            "median_absolute_deviation": histogram_median(sorted(deviations.items()), numFragments),
+            "min": lengths[0][0],
+            "max": lengths[-1][0],
+            "mean": round(sum([x * y for x, y in lengths]) / float(numFragments), 2),
+        }
+
+    def to_dict(self, header, counts, mitoName=None):
+        contigCounts = collections.Counter()
+        for (flag, tid), count in self.recordCounts.items():
+            contigCounts[tid] += count
+        contigs = collections.OrderedDict(
+            [(header.get_reference_name(tid), contigCounts[tid]) for tid in sorted(contigCounts) if tid >= 0]
+        )
+        mitoNames = [mitoName] if mitoName else MITO_NAMES
+        mitoReads = sum([contigs.get(x, 0) for x in mitoNames])
+        totalReads = sum(contigCounts.values())
+
+        filterReasons = collections.OrderedDict(sorted(self.filterReasons.items()))
+        filterReasons["singleton_reads"] = counts["totalSingletons"]
+        filterReasons["improper_pairs"] = counts["totalImproperPairs"]
+        return collections.OrderedDict(
+            [
+                ("counts", counts),
+                ("flagstat", self.flagstat()),
+                ("fragment_length", self.fragment_length_summary()),
+                (
+                    "fragment_length_histogram",
+                    collections.OrderedDict([(str(x), y) for x, y in sorted(self.fragmentLengths.items())]),
+                ),
+                ("contigs", contigs),
+                ("unplaced_reads", contigCounts[-1]),
+                (
+                    "mitochondrial",
+                    {
+                        "contigs": [x for x in mitoNames if x in contigs],
+                        "reads": mitoReads,
+                        "percent": percentage(mitoReads, totalReads),
+                    },
+                ),
+                ("filter_reasons", filterReasons),
+            ]
+        )
+
+
+def histogram_median(values, numValues):
+    ## MEDIAN OF A SORTED LIST OF (VALUE, COUNT) TUPLES, AVERAGING THE MIDDLE TWO VALUES FOR AN EVEN NUMBER
+    lowRank, highRank = (numValues - 1) // 2, numValues // 2
+    low = None
+    seen = 0
+    for value, count in values:
+        seen += count
+        if low is None and seen > lowRank:
+            low = value
+        if seen > highRank:
+            return (low + value) / 2.0
+
+
+## SHIFTS APPLIED TO FRAGMENT ENDS TO GIVE THE CENTRE OF THE TN5 INSERTION
+TN5_SHIFT_START = 4
+TN5_SHIFT_END = -5
+
+
+class FragmentCollector(object):
+    """
+    Collect one fragment per kept pair from the primary first mate, spanning the leftmost start to the rightmost
+    end of the pair. Fragments are held per reference id as 64-bit integers of start and end so they can be
+    sorted and collapsed into duplicate counts once all reads have been seen, whatever order they arrive in.
+    """
+
+    def __init__(self):
+        self.fragments = {}
+
+    def add(self, read):
+        flag = read.flag
+        if flag & 0x40 and not flag & 0x90C:
+            tlen = read.template_length
+            tid = read.reference_id
+            if tlen and read.next_reference_id == tid:
+                start = min(read.reference_start, read.next_reference_start)
+                if tid not in self.fragments:
+                    self.fragments[tid] = array.array("q")
+                self.fragments[tid].append((start << 32) | (start + abs(tlen)))
+
+    def update(self, other):
+        for tid, fragments in other.fragments.items():
+            if tid not in self.fragments:
+                self.fragments[tid] = array.array("q")
+            self.fragments[tid].extend(fragments)
+
+    def write(self, fileName, header):
+        """
+        Write fragments sorted by contig in header order, then start and end, and index the file with tabix.
+        Returns the number of unique fragments written.
+        """
+        numFragments = 0
+        with pysam.BGZFile(fileName, "wb") as fout:
+            for tid in sorted(self.fragments):
+                contig = header.get_reference_name(tid)
+                lines = []
+                for key, group in itertools.groupby(sorted(self.fragments[tid])):
+                    start = (key >> 32) + TN5_SHIFT_START
+                    end = (key & 0xFFFFFFFF) + TN5_SHIFT_END
+                    if end > start:
+                        lines.append("%s\t%d\t%d\t%d\n" % (contig, start, end, sum(1 for x in group)))
+                    if len(lines) == BATCH_SIZE:
+                        fout.write("".join(lines).encode())
+                        numFragments += len(lines)
+                        lines = []
+                fout.write("".join(lines).encode())
+                numFragments += len(lines)
+                self.fragments[tid] = None
+        pysam.tabix_index(fileName, preset="bed", force=True)
+        return numFragments
+
+
+## NUMBER OF DUPLICATE KEYS HELD IN A HASH SET BEFORE THEY ARE COMPACTED INTO A SORTED ARRAY OF 64-BIT INTEGERS
+DUPLICATE_KEYS_IN_MEMORY = 1000000
+
+## COLUMNS OF THE DUPLICATION METRICS WRITTEN BY PICARD MarkDuplicates BEFORE SECONDARY_OR_SUPPLEMENTARY_RDS WAS ADDED
+DUPLICATE_METRICS_FIELDS = [
+    "LIBRARY",
+    "UNPAIRED_READS_EXAMINED",
+    "READ_PAIRS_EXAMINED",
+    "UNMAPPED_READS",
+    "UNPAIRED_READ_DUPLICATES",
+    "READ_PAIR_DUPLICATES",
+    "READ_PAIR_OPTICAL_DUPLICATES",
+    "PERCENT_DUPLICATION",
+    "ESTIMATED_LIBRARY_SIZE",
+]
+
+
+class DuplicateKeys(object):
+    """
+    Set of 64-bit hashes of duplicate keys. New keys go into a hash set that is compacted into a sorted array
+    once it holds maxKeys entries, and arrays of similar size are merged so only a few have to be searched.
+    Memory use is then about eight bytes per unique key rather than the size of a Python set entry.
+    """
+
+    def __init__(self, maxKeys=DUPLICATE_KEYS_IN_MEMORY):
+        self.maxKeys = maxKeys
+        self.recent = set()
+        self.sortedKeys = []
+
+    def add(self, key):
+        ## RETURNS TRUE IF THE KEY HAS BEEN SEEN BEFORE
+        key = hash(key)
+        if key in self.recent:
+            return True
+        for keys in self.sortedKeys:
+            idx = bisect.bisect_left(keys, key)
+            if idx < len(keys) and keys[idx] == key:
+                return True
+        self.recent.add(key)
+        if len(self.recent) >= self.maxKeys:
+            self.compact()
+        return False
+
+    def compact(self):
+        keys = array.array("q", sorted(self.recent))
+        self.recent = set()
+        while self.sortedKeys and len(self.sortedKeys[-1]) <= 2 * len(keys):
+            keys = array.array("q", sorted(itertools.chain(self.sortedKeys.pop(), keys)))
+        self.sortedKeys.append(keys)
+
+
+def unclipped_five_prime(read):
+    ## 5' POSITION OF THE READ INCLUDING SOFT AND HARD CLIPPED BASES, AS USED BY PICARD MarkDuplicates
+    cigar = read.cigartuples
+    if read.is_reverse:
+        position = read.reference_end - 1
+        for op, length in reversed(cigar):
+            if op not in (4, 5):
+                break
+            position += length
+    else:
+        position = read.reference_start
+        for op, length in cigar:
+            if op not in (4, 5):
+                break
+            position -= length
+    return position
+
+
+def estimate_library_size(readPairs, uniqueReadPairs):
+    ## SAME LANDER-WATERMAN ESTIMATE AND BISECTION AS PICARD DuplicationMetrics.estimateLibrarySize
+    def f(x, c, n):
+        return c / x - 1 + math.exp(-n / x)
+
+    if readPairs <= 0 or readPairs <= uniqueReadPairs:
+        return None
+    m, M = 1.0, 100.0
+    if f(m * uniqueReadPairs, uniqueReadPairs, readPairs) < 0:
+        return None
+    while f(M * uniqueReadPairs, uniqueReadPairs, readPairs) > 0:
+        M *= 10.0
+    for i in range(40):
+        r = (m + M) / 2.0
+        u = f(r * uniqueReadPairs, uniqueReadPairs, readPairs)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return int(uniqueReadPairs * (m + M) / 2.0)
+
+
+class DuplicateMarker(object):
+    """
+    Mark or remove duplicate pairs from a name-sorted BAM file where both mates of a pair are seen together.
+    The first pair seen with a given library, contigs, unclipped 5' positions and strands is kept as the
+    original, so unlike Picard MarkDuplicates the pair with the highest base qualities is not preferred.
+    Mapped reads whose mate is unmapped are compared with each other in the same way on their own end.
+    """
+
+    def __init__(self, header, removeDuplicates=False, maxKeys=DUPLICATE_KEYS_IN_MEMORY):
+        self.removeDuplicates = removeDuplicates
+        self.pairKeys = DuplicateKeys(maxKeys)
+        self.fragmentKeys = DuplicateKeys(maxKeys)
+
+        ## LIBRARY OF EACH READ GROUP. READS WITHOUT ONE ARE COUNTED UNDER THE SAME NAME PICARD USES
+        self.libraries = {}
+        for readGroup in header.to_dict().get("RG", []):
+            self.libraries[readGroup["ID"]] = readGroup.get("LB", "Unknown Library")
+        self.metrics = collections.OrderedDict()
+
+    def library(self, read):
+        if read.has_tag("RG"):
+            library = self.libraries.get(read.get_tag("RG"), "Unknown Library")
+        else:
+            library = "Unknown Library"
+        if library not in self.metrics:
+            self.metrics[library] = collections.OrderedDict([(field, 0) for field in DUPLICATE_METRICS_FIELDS[1:7]])
+        return library
+
+    def is_duplicate_pair(self, read1, read2):
+        ## SECONDARY AND SUPPLEMENTARY ALIGNMENTS ARE NOT EXAMINED
+        if (read1.flag | read2.flag) & 0x900:
+            return False
+        library = self.library(read1)
+        metrics = self.metrics[library]
+        unmapped = [x for x in (read1, read2) if x.is_unmapped]
+        metrics["UNMAPPED_READS"] += len(unmapped)
+        if len(unmapped) == 2:
+            return False
+        if unmapped:
+            read = read2 if read1.is_unmapped else read1
+            metrics["UNPAIRED_READS_EXAMINED"] += 1
+            key = (library, read.reference_id, unclipped_five_prime(read), read.is_reverse)
+            duplicate = self.fragmentKeys.add(key)
+            metrics["UNPAIRED_READ_DUPLICATES"] += duplicate
+            return duplicate
+        metrics["READ_PAIRS_EXAMINED"] += 1
+        ends = sorted(
+            [
+                (read1.reference_id, unclipped_five_prime(read1), read1.is_reverse),
+                (read2.reference_id, unclipped_five_prime(read2), read2.is_reverse),
+            ]
+        )
+        duplicate = self.pairKeys.add((library,) + ends[0] + ends[1])
+        metrics["READ_PAIR_DUPLICATES"] += duplicate
+        return duplicate
+
+    def process_pairs(self, readIter, counts):
+        """
+        Yield the reads of the pairs from readIter with their duplicate flag set or cleared, leaving out duplicate
+        pairs when removing them. Reads are expected two at a time as yielded by filter_name_sorted().
+        """
+        for read1 in readIter:
+            read2 = next(readIter)
+            duplicate = self.is_duplicate_pair(read1, read2)
+            if duplicate:
+                counts["totalDuplicatePairs"] += 1
+                if self.removeDuplicates:
+                    counts["totalOutputPairs"] -= 1
+                    continue
+            for read in (read1, read2):
+                if duplicate:
+                    read.flag |= 0x400
+                else:
+                    read.flag &= ~0x400
+            yield read1
+            yield read2
+
+    def write_metrics(self, fileName, BAMIn, BAMOut):
+        ## SAME LAYOUT AS PICARD MarkDuplicates SO THAT MultiQC AND atac_pipeline_report.py CAN PARSE IT
+        with open(fileName, "w") as fout:
+            fout.write("## htsjdk.samtools.metrics.StringHeader\n")
+            fout.write(
+                "# bampe_rm_orphan.py INPUT=%s OUTPUT=%s REMOVE_DUPLICATES=%s\n"
+                % (BAMIn, BAMOut, str(self.removeDuplicates).lower())
+            )
+            fout.write("## htsjdk.samtools.metrics.StringHeader\n")
+            fout.write("# Started on: %s\n\n" % (datetime.datetime.now().strftime("%a %b %d %H:%M:%S %Y")))
+            fout.write("## METRICS CLASS\tpicard.sam.DuplicationMetrics\n")
+            fout.write("\t".join(DUPLICATE_METRICS_FIELDS) + "\n")
+            for library, metrics in self.metrics.items():
+                readsExamined = metrics["UNPAIRED_READS_EXAMINED"] + 2 * metrics["READ_PAIRS_EXAMINED"]
+                readDuplicates = metrics["UNPAIRED_READ_DUPLICATES"] + 2 * metrics["READ_PAIR_DUPLICATES"]
+                percentDuplication = float(readDuplicates) / readsExamined if readsExamined else 0
+                librarySize = estimate_library_size(
+                    metrics["READ_PAIRS_EXAMINED"] - metrics["READ_PAIR_OPTICAL_DUPLICATES"],
+                    metrics["READ_PAIRS_EXAMINED"] - metrics["READ_PAIR_DUPLICATES"],
+                )
+                fields = [library] + [str(x) for x in metrics.values()]
+                ## PICARD LEAVES THE ESTIMATE EMPTY WHEN THERE ARE NO DUPLICATES TO ESTIMATE IT FROM
+                fields += ["%.6f" % (percentDuplication), "" if librarySize is None else str(librarySize)]
+                fout.write("\t".join(fields) + "\n")
+            fout.write("\n")
+
+
+def count_reads(readIter, stats, fragments=None):
+    for read in readIter:
+        stats.add(read)
+        if fragments is not None:
+            fragments.add(read)
+        yield read
+
+
+def new_counts():
+    return {
+        "totalReads": 0,
+        "totalFilteredReads": 0,
+        "totalOutputPairs": 0,
+        "totalSingletons": 0,
+        "totalImproperPairs": 0,
+        "totalDuplicatePairs": 0,
+    }
+
+
+def write_reads(outIter, SAMFout, pipelined=False):
+    writer = BackgroundWriter(SAMFout.write) if pipelined else None
+    try:
+        for read in outIter:
+            if writer:
+                writer.write(read)
+            else:
+                SAMFout.write(read)
+    finally:
+        if writer:
+            writer.close()
+
+
+def plan_shards(SAMFin, numShards):
+    """
+    Split the contigs of an indexed BAM file into at most numShards groups of consecutive contigs holding roughly
+    equal numbers of reads, so that concatenating the shards in order keeps the file coordinate-sorted.
+    Returns a list of (contigs, tids, numReads) tuples.
+    """
+    weights = [(x.contig, SAMFin.get_tid(x.contig), x.total) for x in SAMFin.get_index_statistics() if x.total > 0]
+    target = sum([x[2] for x in weights]) / float(max(1, numShards))
+    shards = []
+    contigs, tids, numReads = [], [], 0
+    for contig, tid, weight in weights:
+        if contigs and numReads + weight > target and len(shards) < numShards - 1:
+            shards.append((contigs, tids, numReads))
+            contigs, tids, numReads = [], [], 0
+        contigs.append(contig)
+        tids.append(tid)
+        numReads += weight
+    if contigs:
+        shards.append((contigs, tids, numReads))
+
+    ## READS WITHOUT A COORDINATE ARE STORED AFTER ALL CONTIGS
+    if SAMFin.nocoordinate > 0:
+        shards.append((["*"], [-1], SAMFin.nocoordinate))
+    return shards
+
+
+def filter_shard(shard):
+    """
+    Filter the contigs of one shard of an indexed coordinate-sorted BAM file. Run in a worker process.
+    """
+    counts = new_counts()
+    stats = ReadStats()
+    fragments = FragmentCollector() if shard["fragments"] else None
+    crossShardMates = {}
+    readThreads, writeThreads = split_threads(shard["threads"])
+    SAMFin = pysam.AlignmentFile(shard["BAMIn"], "rb", index_filename=shard["index"], threads=readThreads)
+    SAMFout = pysam.AlignmentFile(
+        shard["BAMOut"], "wb", header=SAMFin.header, threads=writeThreads, format_options=shard["formatOptions"]
+    )
+    spillFile = SpillFile(SAMFin.header, shard["tmpDir"])
+    readIter = itertools.chain.from_iterable(SAMFin.fetch(contig) for contig in shard["contigs"])
+    if shard["threads"] > 1:
+        readIter = iter_in_background(readIter)
+    readFilter = build_read_filter(SAMFin.header, **shard["readFilter"])
+    if readFilter:
+        readIter = apply_read_filter(readIter, readFilter, counts, stats)
+    outIter = filter_coordinate_sorted(
+        readIter,
+        counts,
+        spillFile,
+        onlyFRPairs=shard["onlyFRPairs"],
+        maxBufferedReads=shard["maxBufferedReads"],
+        shardTids=set(shard["tids"]),
+        crossShardMates=crossShardMates,
+    )
+    outIter = count_reads(outIter, stats, fragments)
+    try:
+        write_reads(outIter, SAMFout, pipelined=shard["threads"] > 1)
+    finally:
+        SAMFin.close()
+        SAMFout.close()
+        spillFile.close()
+    return {
+        "BAMOut": shard["BAMOut"],
+        "counts": counts,
+        "stats": stats,
+        "fragments": fragments,
+        "crossShardMates": crossShardMates,
+        "spillPath": spillFile.path,
+        "keptNames": spillFile.keptNames,
+    }
+
+
+def merge_shard_spill(result):
+    stats = ReadStats()
+    fragments = FragmentCollector() if result["collectFragments"] else None
+    spillFile = SpillFile(None, None)
+    spillFile.path = result["spillPath"]
+    spillFile.keptNames = result["keptNames"]
+    try:
+        if spillFile.keptNames:
+            merge_spilled_reads(
+                result["BAMOut"], spillFile, formatOptions=result["formatOptions"], stats=stats, fragments=fragments
+            )
+    finally:
+        spillFile.remove()
+    return stats, fragments
+
+
+def filter_sharded(
+    BAMIn,
+    BAMOut,
+    counts,
+    stats,
+    fragments,
+    onlyFRPairs,
+    threads,
+    processes,
+    formatOptions,
+    maxBufferedReads,
+    tmpDir,
+    readFilter,
+):
+    """
+    Filter an indexed coordinate-sorted BAM file in parallel chromosome shards, resolve pairs whose mates ended
+    up in different shards and concatenate the shard BAM files without recompressing them.
+    """
+    shardDir = tempfile.mkdtemp(prefix="bampe_rm_orphan.", suffix=".shards", dir=tmpDir)
+    try:
+        ## BUILD A TEMPORARY INDEX IF THERE ISNT ONE NEXT TO THE INPUT
+        SAMFin = pysam.AlignmentFile(BAMIn, "rb")
+        indexFile = None
+        if not SAMFin.has_index():
+            indexFile = os.path.join(shardDir, "input.bam.bai")
+            SAMFin.close()
+            pysam.index("-@", str(threads), BAMIn, indexFile)
+            SAMFin = pysam.AlignmentFile(BAMIn, "rb", index_filename=indexFile)
+        shardPlan = plan_shards(SAMFin, processes * 4)
+        SAMFin.close()
+
+        shards = []
+        for idx, (contigs, tids, numReads) in enumerate(shardPlan):
+            shards.append(
+                {
+                    "BAMIn": BAMIn,
+                    "index": indexFile,
+                    "BAMOut": os.path.join(shardDir, "shard_%05d.bam" % (idx)),
+                    "contigs": contigs,
+                    "tids": tids,
+                    "numReads": numReads,
+                    "onlyFRPairs": onlyFRPairs,
+                    "threads": max(1, threads // processes),
+                    "formatOptions": formatOptions,
+                    "maxBufferedReads": max(1, maxBufferedReads // processes),
+                    "tmpDir": shardDir,
+                    "readFilter": readFilter,
+                    "fragments": fragments is not None,
+                }
+            )
+
+        ## LARGEST SHARDS FIRST SO THE LAST ONES TO FINISH ARE SMALL
+        pool = multiprocessing.get_context("fork").Pool(processes=processes)
+        try:
+            results = pool.map(filter_shard, sorted(shards, key=lambda x: x["numReads"], reverse=True), chunksize=1)
+            results = sorted(results, key=lambda x: x["BAMOut"])
+
+            ## RECONCILE PAIRS SPLIT ACROSS SHARDS
+            unmatched = {}
+            for idx, result in enumerate(results):
+                for key in counts:
+                    counts[key] += result["counts"][key]
+                stats.update(result["stats"])
+                result["stats"] = None
+                if fragments is not None:
+                    fragments.update(result["fragments"])
+                result["fragments"] = None
+                for qname, mate in result["crossShardMates"].items():
+                    if qname in unmatched:
+                        mateIdx, otherMate = unmatched.pop(qname)
+                        if not onlyFRPairs or is_fr_pair(otherMate, mate):
+                            counts["totalOutputPairs"] += 1
+                            results[mateIdx]["keptNames"].add(qname)
+                            result["keptNames"].add(qname)
+                        else:
+                            counts["totalImproperPairs"] += 1
+                    else:
+                        unmatched[qname] = (idx, mate)
+                result["crossShardMates"] = None
+                result["formatOptions"] = formatOptions
+                result["collectFragments"] = fragments is not None
+            counts["totalSingletons"] += len(unmatched)
+
+            ## PUT BACK SPILLED READS WHOSE MATE WAS FOUND
+            for spillStats, spillFragments in pool.map(merge_shard_spill, results, chunksize=1):
+                stats.update(spillStats)
+                if fragments is not None:
+                    fragments.update(spillFragments)
+        finally:
+            pool.close()
+            pool.join()
+
+        pysam.cat("-o", BAMOut, *[x["BAMOut"] for x in results])
+    finally:
+        for fileName in os.listdir(shardDir):
+            os.remove(os.path.join(shardDir, fileName))
+        os.rmdir(shardDir)
+
+
+############################################
+############################################
+## READ FILTERS
+############################################
+############################################
+
+## BAMTOOLS FILTER PROPERTIES AND THE PYSAM EXPRESSIONS THEY ARE COMPILED TO
+BAMTOOLS_BOOL_PROPERTIES = {
+    "isDuplicate": "read.is_duplicate",
+    "isFailedQC": "read.is_qcfail",
+    "isFirstMate": "read.is_read1",
+    "isMapped": "(not read.is_unmapped)",
+    "isMateMapped": "(not read.mate_is_unmapped)",
+    "isMateReverseStrand": "read.mate_is_reverse",
+    "isPaired": "read.is_paired",
+    "isPrimaryAlignment": "(not read.is_secondary)",
+    "isProperPair": "read.is_proper_pair",
+    "isReverseStrand": "read.is_reverse",
+    "isSecondMate": "read.is_read2",
+}
+BAMTOOLS_NUMERIC_PROPERTIES = {
+    "alignmentFlag": "read.flag",
+    "insertSize": "read.template_length",
+    "length": "read.query_length",
+    "mapQuality": "read.mapping_quality",
+    "matePosition": "read.next_reference_start",
+    "position": "read.reference_start",
+}
+BAMTOOLS_STRING_PROPERTIES = {
+    "cigar": "(read.cigarstring or '')",
+    "mateReference": "(read.next_reference_name or '')",
+    "name": "read.query_name",
+    "queryBases": "(read.query_sequence or '')",
+    "reference": "(read.reference_name or '')",
+}
+BAMTOOLS_OPERATORS = {"=": "==", "!": "!=", ">": ">", "<": "<", ">=": ">=", "<=": "<="}
+
+
+def parse_bamtools_value(value):
+    ## SPLIT A VALUE SUCH AS '>=-2000', '!*S*' OR 'true' INTO ITS OPERATOR AND OPERAND
+    value = str(value).strip()
+    for op in (">=", "<=", ">", "<", "!"):
+        if value.startswith(op):
+            return op, value[len(op) :]
+    return "=", value
+
+
+def parse_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def compile_string_match(expr, op, value):
+    ## '*' AT EITHER END OF A STRING VALUE IS A WILDCARD
+    if len(value) > 1 and value.startswith("*") and value.endswith("*"):
+        match = "(%r in %s)" % (value[1:-1], expr)
+    elif value.startswith("*"):
+        match = "%s.endswith(%r)" % (expr, value[1:])
+    elif value.endswith("*"):
+        match = "%s.startswith(%r)" % (expr, value[:-1])
+    else:
+        match = "(%s == %r)" % (expr, value)
+    return "(not %s)" % (match) if op == "!" else match
+
+
+def compile_bamtools_property(name, value):
+    """
+    Return Python source testing one BAMTools filter property of 'read'.
+    """
+    if name in BAMTOOLS_BOOL_PROPERTIES:
+        op, operand = parse_bamtools_value(value)
+        isTrue = operand.lower() == "true"
+        if op == "!":
+            isTrue = not isTrue
+        expr = BAMTOOLS_BOOL_PROPERTIES[name]
+        return expr if isTrue else "(not %s)" % (expr)
+
+    if name in BAMTOOLS_NUMERIC_PROPERTIES:
+        op, operand = parse_bamtools_value(value)
+        return "(%s %s %r)" % (BAMTOOLS_NUMERIC_PROPERTIES[name], BAMTOOLS_OPERATORS[op], parse_number(operand))
+
+    if name in BAMTOOLS_STRING_PROPERTIES:
+        op, operand = parse_bamtools_value(value)
+        return compile_string_match(BAMTOOLS_STRING_PROPERTIES[name], op, operand)
+
+    if name == "tag":
+        ## TAG VALUES LOOK LIKE 'NM:<=4'. READS WITHOUT THE TAG FAIL THE TEST
+        tag, tagValue = str(value).split(":", 1)
+        op, operand = parse_bamtools_value(tagValue)
+        try:
+            match = "(tagValue %s %r)" % (BAMTOOLS_OPERATORS[op], parse_number(operand))
+        except ValueError:
+            match = compile_string_match("str(tagValue)", op, operand)
+        return "tag_matches(read, %r, lambda tagValue: %s)" % (tag, match)
+
+    raise ValueError("BAMTools filter property '%s' is not supported." % (name))
+
+
+def tag_matches(read, tag, test):
+    if not read.has_tag(tag):
+        return False
+    return test(read.get_tag(tag))
+
+
+def compile_bamtools_rules(configFile):
+    """
+    Return Python source for the filters and 'rule' of a BAMTools filter JSON file e.g. assets/bamtools_filter_pe.json.
+    Properties of a filter are combined with AND unless its 'type' is OR. Without a rule, filters are combined with OR.
+    """
+    with open(configFile, "r") as fin:
+        config = json.load(fin)
+
+    filterSources = {}
+    for idx, filterDict in enumerate(config.get("filters", [config])):
+        filterId = str(filterDict.get("id", "filter%d" % (idx)))
+        joiner = " or " if str(filterDict.get("type", "AND")).upper() == "OR" else " and "
+        properties = [
+            compile_bamtools_property(name, value)
+            for name, value in filterDict.items()
+            if name not in ("id", "type", "rule", "filters")
+        ]
+        filterSources[filterId] = "(%s)" % (joiner.join(properties) if properties else "True")
+
+    rule = config.get("rule")
+    if not rule:
+        return "(%s)" % (" or ".join(filterSources.values()))
+
+    ## '!' BINDS TIGHTER THAN '&' WHICH BINDS TIGHTER THAN '|', THE SAME AS 'not', 'and' AND 'or' IN PYTHON
+    ruleSource = []
+    for token in re.findall(r"[^\s&|!()]+|[&|!()]", rule):
+        if token in ("&", "|", "!", "(", ")"):
+            ruleSource.append({"&": "and", "|": "or", "!": "not", "(": "(", ")": ")"}[token])
+        elif token in filterSources:
+            ruleSource.append(filterSources[token])
+        else:
+            raise ValueError("BAMTools filter rule refers to unknown filter id '%s'." % (token))
+    return "(%s)" % (" ".join(ruleSource))
+
+
+def build_read_filter(header, filterConfig=None, includeRegions=None, requireFlags=0, excludeFlags=0, minMapQ=0):
+    """
+    Compile the samtools view style flag, mapping quality and region filters together with the BAMTools rules in
+    filterConfig into a single predicate taking a read. Returns None if there is nothing to filter on.
+    """
+    tests = []
+    namespace = {"tag_matches": tag_matches}
+    if excludeFlags:
+        tests.append(("exclude_flags", "not (read.flag & %d)" % (excludeFlags)))
+    if requireFlags:
+        tests.append(("require_flags", "(read.flag & %d) == %d" % (requireFlags, requireFlags)))
+    if minMapQ:
+        tests.append(("min_mapq", "read.mapping_quality >= %d" % (minMapQ)))
+    if includeRegions:
+        namespace["regions"] = IntervalSet.from_bed(includeRegions)
+        tests.append(
+            (
+                "include_regions",
+                "regions.overlaps(read.reference_name, read.reference_start, read.reference_end or read.reference_start)",
+            )
+        )
+    if filterConfig:
+        tests.append(("filter_config", compile_bamtools_rules(filterConfig)))
+    if not tests:
+        return None
+
+    def compile_test(source):
+        return eval(compile("lambda read: %s" % (source), "<read_filter>", "eval"), namespace)
+
+    ## THE INDIVIDUAL TESTS ARE ONLY RUN ON READS FAILING THE COMBINED ONE TO FIND OUT WHY THEY WERE REMOVED
+    readFilter = compile_test(" and ".join([x[1] for x in tests]))
+    readFilter.reasons = [(reason, compile_test(source)) for reason, source in tests]
+    return readFilter
+
+
+def apply_read_filter(readIter, readFilter, counts, stats):
+    for read in readIter:
+        if readFilter(read):
+            yield read
+        else:
+            counts["totalReads"] += 1
+            counts["totalFilteredReads"] += 1
+            stats.add_filtered(read, readFilter.reasons)
+
+
+def parse_flags(flags):
+    ## COMBINE FLAGS GIVEN MORE THAN ONCE, IN DECIMAL OR HEXADECIMAL
+    value = 0
+    for flag in flags:
+        value |= int(str(flag), 0)
+    return value
+
+
 ############################################
 ############################################
 ## MAIN FUNCTION
@@ -61,81 +1527,146 @@ def makedir(path):
 ############################################
 
 
-def bampe_rm_orphan(BAMIn, BAMOut, onlyFRPairs=False):
+def bampe_rm_orphan(
+    BAMIn,
+    BAMOut,
+    onlyFRPairs=False,
+    threads=1,
+    compressionLevel=None,
+    sortOrder="queryname",
+    maxBufferedReads=1000000,
+    tmpDir=None,
+    processes=1,
+    filterConfig=None,
+    includeRegions=None,
+    requireFlags=0,
+    excludeFlags=0,
+    minMapQ=0,
+    mitoName=None,
+    fragmentsOut=None,
+    markDuplicates=False,
+    removeDuplicates=False,
+    duplicateMetrics=None,
+    autoSort=False,
+    sortMemory=768,
+):
     ## SETUP DIRECTORY/FILE STRUCTURE
     OutDir = os.path.dirname(BAMOut)
     makedir(OutDir)
+    tmpDir = tmpDir if tmpDir else (OutDir if OutDir else ".")
 
     ## COUNT VARIABLES
-    totalReads = 0
-    totalOutputPairs = 0
-    totalSingletons = 0
-    totalImproperPairs = 0
-
-    ## ITERATE THROUGH BAM FILE
-    EOF = 0
-    SAMFin = pysam.AlignmentFile(BAMIn, "rb")
-    SAMFout = pysam.AlignmentFile(BAMOut, "wb", header=SAMFin.header)
-    iter = SAMFin.fetch(until_eof=True)
-    currRead = next(iter)
-    for read in iter:
-        totalReads += 1
-        if currRead.qname == read.qname:
-            pair1 = currRead
-            pair2 = read
-
-            ## FILTER FOR READS ON SAME CHROMOSOME IN FR ORIENTATION
-            if onlyFRPairs:
-                if pair1.tid == pair2.tid:
-                    ## READ1 FORWARD AND READ2 REVERSE STRAND
-                    if not pair1.is_reverse and pair2.is_reverse:
-                        if pair1.reference_start <= pair2.reference_start:
-                            totalOutputPairs += 1
-                            SAMFout.write(pair1)
-                            SAMFout.write(pair2)
-                        else:
-                            totalImproperPairs += 1
-
-                    ## READ1 REVERSE AND READ2 FORWARD STRAND
-                    elif pair1.is_reverse and not pair2.is_reverse:
-                        if pair2.reference_start <= pair1.reference_start:
-                            totalOutputPairs += 1
-                            SAMFout.write(pair1)
-                            SAMFout.write(pair2)
-                        else:
-                            totalImproperPairs += 1
+    counts = new_counts()
+    stats = ReadStats()
+    fragments = FragmentCollector() if fragmentsOut else None
+    formatOptions = [] if compressionLevel is None else ["level=%d" % (compressionLevel)]
 
-                    else:
-                        totalImproperPairs += 1
-                else:
-                    totalImproperPairs += 1
-            else:
-                totalOutputPairs += 1
-                SAMFout.write(pair1)
-                SAMFout.write(pair2)
+    readFilterArgs = {
+        "filterConfig": filterConfig,
+        "includeRegions": includeRegions,
+        "requireFlags": requireFlags,
+        "excludeFlags": excludeFlags,
+        "minMapQ": minMapQ,
+    }
 
-            ## RESET COUNTER
-            try:
-                totalReads += 1
-                currRead = next(iter)
-            except:
-                StopIteration
-                EOF = 1
+    markDuplicates = markDuplicates or removeDuplicates
 
-        ## READS WHERE ONLY ONE OF A PAIR IS IN FILE
+    ## TAKE THE SORT ORDER FROM THE HEADER. BUFFERING MATES OF COORDINATE-SORTED INPUT IS CHEAPER THAN SORTING IT
+    sortByName = False
+    if autoSort:
+        with pysam.AlignmentFile(BAMIn, "rb") as SAMFin:
+            inputSortOrder = SAMFin.header.to_dict().get("HD", {}).get("SO", "unknown")
+        if inputSortOrder == "queryname" or (inputSortOrder == "coordinate" and not markDuplicates):
+            sortOrder = inputSortOrder
         else:
-            totalSingletons += 1
-            pair1 = currRead
-            currRead = read
+            sortOrder = "queryname"
+            sortByName = True
+            print("Input sort order is '%s'. Sorting reads by name before removing orphans." % (inputSortOrder))
 
-    if not EOF:
-        totalReads += 1
-        totalSingletons += 1
-        pair1 = currRead
+    if processes > 1 and sortOrder != "coordinate":
+        print("WARNING: --processes is only used with --sort_order coordinate. Running in a single process.")
+        processes = 1
 
-    ## CLOSE ALL FILE HANDLES
-    SAMFin.close()
-    SAMFout.close()
+    if markDuplicates and sortOrder != "queryname":
+        print("WARNING: --mark_duplicates is only used with --sort_order queryname. Duplicates are left as they are.")
+        markDuplicates = False
+    duplicateMarker = None
+
+    if processes > 1:
+        filter_sharded(
+            BAMIn,
+            BAMOut,
+            counts,
+            stats,
+            fragments,
+            onlyFRPairs=onlyFRPairs,
+            threads=max(threads, processes),
+            processes=processes,
+            formatOptions=formatOptions,
+            maxBufferedReads=maxBufferedReads,
+            tmpDir=tmpDir,
+            readFilter=readFilterArgs,
+        )
+    else:
+        ## OPEN BAM FILES WITH MULTI-THREADED BGZF DECOMPRESSION/COMPRESSION
+        readThreads, writeThreads = split_threads(threads)
+        SAMFin = pysam.AlignmentFile(BAMIn, "rb", threads=readThreads)
+        SAMFout = pysam.AlignmentFile(
+            BAMOut,
+            "wb",
+            header=name_sorted_header(SAMFin.header) if sortByName else SAMFin.header,
+            threads=writeThreads,
+            format_options=formatOptions,
+        )
+
+        ## ITERATE THROUGH BAM FILE, OVERLAPPING READING, FILTERING AND WRITING WHEN MULTIPLE THREADS ARE AVAILABLE
+        readIter = SAMFin.fetch(until_eof=True)
+        if threads > 1:
+            readIter = iter_in_background(readIter)
+        readFilter = build_read_filter(SAMFin.header, **readFilterArgs)
+        if readFilter:
+            readIter = apply_read_filter(readIter, readFilter, counts, stats)
+        if sortByName:
+            readIter = sort_by_name(readIter, SAMFin.header, tmpDir, sortMemory * 1024 * 1024)
+        spillFile = SpillFile(SAMFin.header, tmpDir)
+        if sortOrder == "coordinate":
+            outIter = filter_coordinate_sorted(
+                readIter, counts, spillFile, onlyFRPairs=onlyFRPairs, maxBufferedReads=maxBufferedReads
+            )
+        else:
+            outIter = filter_name_sorted(readIter, counts, onlyFRPairs=onlyFRPairs)
+            if markDuplicates:
+                duplicateMarker = DuplicateMarker(SAMFin.header, removeDuplicates=removeDuplicates)
+                outIter = duplicateMarker.process_pairs(outIter, counts)
+        outIter = count_reads(outIter, stats, fragments)
+        try:
+            write_reads(outIter, SAMFout, pipelined=threads > 1)
+        finally:
+            ## CLOSE ALL FILE HANDLES
+            SAMFin.close()
+            SAMFout.close()
+            spillFile.close()
+
+        ## PUT BACK SPILLED READS WHOSE MATE WAS FOUND LATER ON
+        try:
+            if spillFile.keptNames:
+                merge_spilled_reads(
+                    BAMOut, spillFile, threads=threads, formatOptions=formatOptions, stats=stats, fragments=fragments
+                )
+        finally:
+            spillFile.remove()
+
+    ## WRITE TN5-SHIFTED FRAGMENTS OF THE KEPT PAIRS
+    with pysam.AlignmentFile(BAMOut, "rb") as SAMFin:
+        header = SAMFin.header
+    if fragments is not None:
+        counts["totalOutputFragments"] = fragments.write(fragmentsOut, header)
+
+    ## WRITE PICARD-STYLE DUPLICATION METRICS
+    if duplicateMarker is not None:
+        if not duplicateMetrics:
+            duplicateMetrics = os.path.join(OutDir, "%s.MarkDuplicates.metrics.txt" % (os.path.basename(BAMOut[:-4])))
+        duplicateMarker.write_metrics(duplicateMetrics, BAMIn, BAMOut)
 
     LogFile = os.path.join(OutDir, "%s_bampe_rm_orphan.log" % (os.path.basename(BAMOut[:-4])))
     SamLogFile = open(LogFile, "w")
@@ -147,23 +1678,151 @@ def bampe_rm_orphan(BAMIn, BAMOut, onlyFRPairs=False):
     SamLogFile.write("\n##############################\n")
     SamLogFile.write("OVERALL COUNTS")
     SamLogFile.write("\n##############################\n\n")
-    SamLogFile.write("Total Input Reads = " + str(totalReads) + "\n")
-    SamLogFile.write("Total Output Pairs = " + str(totalOutputPairs) + "\n")
-    SamLogFile.write("Total Singletons Excluded = " + str(totalSingletons) + "\n")
-    SamLogFile.write("Total Improper Pairs Excluded = " + str(totalImproperPairs) + "\n")
+    SamLogFile.write("Total Input Reads = " + str(counts["totalReads"]) + "\n")
+    SamLogFile.write("Total Reads Excluded By Filters = " + str(counts["totalFilteredReads"]) + "\n")
+    SamLogFile.write("Total Output Pairs = " + str(counts["totalOutputPairs"]) + "\n")
+    SamLogFile.write("Total Singletons Excluded = " + str(counts["totalSingletons"]) + "\n")
+    SamLogFile.write("Total Improper Pairs Excluded = " + str(counts["totalImproperPairs"]) + "\n")
+    if duplicateMarker is not None:
+        SamLogFile.write(
+            "Total Duplicate Pairs %s = " % ("Removed" if removeDuplicates else "Marked")
+            + str(counts["totalDuplicatePairs"])
+            + "\n"
+        )
     SamLogFile.write("\n##############################\n")
     SamLogFile.close()
 
+    ## WRITE SUMMARY STATISTICS OF THE OUTPUT BAM FILE NEXT TO THE LOG FILE
+    StatsFile = os.path.join(OutDir, "%s_bampe_rm_orphan.json" % (os.path.basename(BAMOut[:-4])))
+    with open(StatsFile, "w") as fout:
+        json.dump(stats.to_dict(header, counts, mitoName=mitoName), fout, indent=4)
+        fout.write("\n")
 
-############################################
-############################################
-## RUN FUNCTION
-############################################
-############################################
 
-bampe_rm_orphan(BAMIn=args.BAM_INPUT_FILE, BAMOut=args.BAM_OUTPUT_FILE, onlyFRPairs=args.ONLY_FR_PAIRS)
+## OPTIONS OF bampe_rm_orphan() SET ON EACH LINE OF A MANIFEST RATHER THAN FOR THE WHOLE BATCH
+MANIFEST_COLUMNS = ["BAMIn", "BAMOut", "fragmentsOut"]
 
-############################################
-############################################
-############################################
-############################################
+
+def read_manifest(manifestFile):
+    ## ONE INPUT BAM, OUTPUT BAM AND OPTIONAL FRAGMENTS FILE PER LINE. BLANK LINES AND COMMENTS ARE SKIPPED
+    entries = []
+    with open(manifestFile) as fin:
+        for lineNum, line in enumerate(fin, start=1):
+            fields = [x.strip() for x in line.rstrip("\n").split("\t")]
+            if not fields[0] or fields[0].startswith("#"):
+                continue
+            if len(fields) < 2 or len(fields) > len(MANIFEST_COLUMNS) or not all(fields):
+                raise ValueError(
+                    "Line %d of manifest '%s' should have 2 or 3 tab-separated columns: %s"
+                    % (lineNum, manifestFile, ", ".join(MANIFEST_COLUMNS))
+                )
+            entries.append(dict(zip(MANIFEST_COLUMNS, fields)))
+    return entries
+
+
+@contextlib.contextmanager
+def redirect_output(fout):
+    ## REDIRECT THE STDOUT AND STDERR FILE DESCRIPTORS SO MESSAGES FROM HTSLIB END UP IN THE SAME FILE
+    sys.stdout.flush()
+    sys.stderr.flush()
+    savedFds = [os.dup(1), os.dup(2)]
+    os.dup2(fout.fileno(), 1)
+    os.dup2(fout.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, savedFd in zip([1, 2], savedFds):
+            os.dup2(savedFd, fd)
+            os.close(savedFd)
+
+
+def run_manifest_entry(entry):
+    """
+    Run bampe_rm_orphan() for one manifest line, sending anything it prints and any traceback to its own log file
+    next to the output BAM file. Returns the input and output BAM files, an exit status and an error message.
+    """
+    BAMOut = entry["BAMOut"]
+    makedir(os.path.dirname(BAMOut))
+    LogFile = os.path.join(os.path.dirname(BAMOut), "%s_bampe_rm_orphan.batch.log" % (os.path.basename(BAMOut[:-4])))
+    status, message = 0, ""
+    with open(LogFile, "w") as fout:
+        with redirect_output(fout):
+            try:
+                bampe_rm_orphan(**entry)
+            except Exception as exception:
+                traceback.print_exc()
+                status, message = 1, "%s: %s" % (type(exception).__name__, exception)
+    return entry["BAMIn"], BAMOut, status, message
+
+
+def bampe_rm_orphan_manifest(manifestFile, workers=1, **kwargs):
+    """
+    Run bampe_rm_orphan() with the same options for every line of manifestFile using a pool of worker processes,
+    one process per line. A failing line does not stop the others. Returns a list of (BAMIn, BAMOut, status,
+    message) tuples in manifest order.
+    """
+    entries = []
+    for entry in read_manifest(manifestFile):
+        entry.update(kwargs)
+        entries.append(entry)
+
+    ## POOL WORKERS CANNOT START THEIR OWN POOL OF SHARD PROCESSES
+    if workers > 1 and kwargs.get("processes", 1) > 1:
+        print("WARNING: --processes is not used with more than one worker. Running each line in a single process.")
+        for entry in entries:
+            entry["processes"] = 1
+
+    if workers > 1 and len(entries) > 1:
+        pool = multiprocessing.get_context("fork").Pool(processes=min(workers, len(entries)), maxtasksperchild=1)
+        try:
+            results = pool.map(run_manifest_entry, entries, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_manifest_entry(x) for x in entries]
+    return results
+
+
+def main(args=None):
+    args = parse_args(args)
+    kwargs = {
+        "onlyFRPairs": args.ONLY_FR_PAIRS,
+        "threads": args.THREADS,
+        "compressionLevel": args.COMPRESSION_LEVEL,
+        "sortOrder": args.SORT_ORDER,
+        "maxBufferedReads": args.MAX_BUFFERED_READS,
+        "tmpDir": args.TMP_DIR,
+        "processes": args.PROCESSES,
+        "filterConfig": args.FILTER_CONFIG,
+        "includeRegions": args.INCLUDE_REGIONS,
+        "requireFlags": parse_flags(args.REQUIRE_FLAGS),
+        "excludeFlags": parse_flags(args.EXCLUDE_FLAGS),
+        "minMapQ": args.MIN_MAPQ,
+        "mitoName": args.MITO_NAME,
+        "markDuplicates": args.MARK_DUPLICATES,
+        "removeDuplicates": args.REMOVE_DUPLICATES,
+        "autoSort": args.AUTO_SORT,
+        "sortMemory": args.SORT_MEMORY,
+    }
+    if not args.MANIFEST:
+        bampe_rm_orphan(
+            BAMIn=args.BAM_INPUT_FILE,
+            BAMOut=args.BAM_OUTPUT_FILE,
+            fragmentsOut=args.FRAGMENTS_OUTPUT,
+            duplicateMetrics=args.DUPLICATE_METRICS,
+            **kwargs,
+        )
+        return 0
+
+    ## ONE TAB-SEPARATED STATUS LINE PER MANIFEST LINE. EXIT WITH AN ERROR IF ANY OF THEM FAILED
+    results = bampe_rm_orphan_manifest(args.MANIFEST, workers=args.WORKERS, **kwargs)
+    for BAMIn, BAMOut, status, message in results:
+        print("\t".join([BAMIn, BAMOut, "OK" if status == 0 else "FAILED", message]).rstrip("\t"))
+    return 1 if any([x[2] for x in results]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,8 +2,13 @@
 
 import os
 import sys
+import csv
+import json
+import errno
 import argparse
 
+from fastq_preflight import check_pair, scan_fastq_files
+
 
 def parse_args(args=None):
     Description = "Reformat nf-core/atacseq samplesheet file and check its contents."
@@ -13,6 +18,31 @@ def parse_args(args=None):
     parser.add_argument("FILE_IN", help="Input samplesheet file.")
     parser.add_argument("FILE_OUT", help="Output file.")
     parser.add_argument("--with_control", action="store_true", help="shows output")
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Check that the FastQ files in the samplesheet are readable, intact and paired, with relative paths resolved against the current directory.",
+    )
+    parser.add_argument(
+        "--preflight_mode",
+        choices=["full", "fast"],
+        default="full",
+        help="'full' decompresses every file to check the gzip stream and compare R1/R2 read counts. 'fast' only checks the gzip header, the BGZF end-of-file block and the first reads (default: 'full').",
+    )
+    parser.add_argument(
+        "--preflight_report",
+        default="samplesheet.preflight.json",
+        help="JSON report of the pre-flight checks (default: 'samplesheet.preflight.json').",
+    )
+    parser.add_argument(
+        "--preflight_threads", type=int, default=1, help="Number of FastQ files to check at a time (default: 1)."
+    )
+    parser.add_argument(
+        "--preflight_reads",
+        type=int,
+        default=10000,
+        help="Number of reads at the start of R1 and R2 whose read IDs have to match (default: 10000).",
+    )
     return parser.parse_args(args)
 
 
@@ -209,9 +239,61 @@ def check_samplesheet(file_in, file_out, with_control=False):
         print_error(f"No entries to process!", "Samplesheet: {file_in}")
 
 
+def preflight_samplesheet(file_in, file_out, mode="full", threads=1, num_ids=10000):
+    """
+    Check the FastQ files of a validated samplesheet with fastq_preflight.py and write the results to a JSON report.
+    This is for checking a samplesheet by hand before a run, the pipeline checks the files it has staged for each
+    sample with FASTQ_PREFLIGHT instead. Every file is read once even if it is listed on more than one row, and
+    remote files are listed in the report but not checked.
+    """
+    with open(file_in, "r") as fin:
+        rows = list(csv.DictReader(fin))
+    fastq_files = []
+    for row in rows:
+        for fastq in [row["fastq_1"], row["fastq_2"]]:
+            if fastq and fastq not in fastq_files:
+                fastq_files.append(fastq)
+
+    local_files = [x for x in fastq_files if "://" not in x]
+    scans = scan_fastq_files(local_files, num_ids, mode == "full", threads)
+    report = {"mode": mode, "passed": True, "files": {}, "samples": []}
+    errors = []
+    for fastq in fastq_files:
+        report["files"][fastq] = dict(scans[fastq][0], checked=True) if fastq in scans else {"checked": False}
+        if fastq in scans:
+            errors += ["{}: {}".format(fastq, x) for x in scans[fastq][0]["errors"]]
+
+    for row in rows:
+        sample = {"sample": row["sample"], "fastq_1": row["fastq_1"], "fastq_2": row["fastq_2"], "errors": []}
+        if row["fastq_2"] and row["fastq_1"] in scans and row["fastq_2"] in scans:
+            sample["errors"] = check_pair(scans[row["fastq_1"]], scans[row["fastq_2"]])
+        sample["passed"] = not sample["errors"] and not any(
+            [report["files"][x].get("errors") for x in [row["fastq_1"], row["fastq_2"]] if x]
+        )
+        report["passed"] = report["passed"] and sample["passed"]
+        report["samples"].append(sample)
+        errors += ["{}: {}".format(row["sample"], x) for x in sample["errors"]]
+
+    make_dir(os.path.dirname(file_out))
+    with open(file_out, "w") as fout:
+        json.dump(report, fout, indent=4)
+
+    if errors:
+        print("ERROR: FastQ pre-flight check failed ->\n{}".format("\n".join(errors)))
+        sys.exit(1)
+
+
 def main(args=None):
     args = parse_args(args)
     check_samplesheet(args.FILE_IN, args.FILE_OUT, args.with_control)
+    if args.preflight:
+        preflight_samplesheet(
+            args.FILE_OUT,
+            args.preflight_report,
+            mode=args.preflight_mode,
+            threads=args.preflight_threads,
+            num_ids=args.preflight_reads,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+#######################################################################
+#######################################################################
+## Check that the FastQ files of a sample are intact and paired before
+## they are trimmed and aligned
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import zlib
+import gzip
+import json
+import errno
+import argparse
+import concurrent.futures
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Check that the gzipped FastQ files of a sample exist, that their gzip streams are intact, that R1 and R2 have the same number of reads and that the read IDs of their first reads match, and write the results to a JSON report."
+    Epilog = """Example usage: python fastq_preflight.py <SAMPLE_ID> <REPORT_FILE> <FASTQ_1> <FASTQ_2> --mode full"""
+
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    parser.add_argument("SAMPLE_ID", help="Sample identifier written to the report.")
+    parser.add_argument("REPORT_FILE", help="Output JSON report.")
+    parser.add_argument(
+        "FASTQ_FILES", nargs="+", help="Gzipped FastQ file for single-end, or R1 and R2 for paired-end reads."
+    )
+
+    ## OPTIONAL PARAMETERS
+    parser.add_argument(
+        "-m",
+        "--mode",
+        dest="MODE",
+        choices=["full", "fast"],
+        default="full",
+        help="'full' decompresses every file to check the gzip stream and compare R1/R2 read counts. 'fast' only checks the gzip header, the BGZF end-of-file block and the first reads (default: 'full').",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of FastQ files to check at a time (default: 1).",
+    )
+    parser.add_argument(
+        "-r",
+        "--reads",
+        type=int,
+        dest="READS",
+        default=10000,
+        help="Number of reads at the start of R1 and R2 whose read IDs have to match (default: 10000).",
+    )
+    return parser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## LAST BLOCK OF EVERY COMPLETE BGZF FILE, SEE THE SAM SPECIFICATION
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+READ_BLOCK_SIZE = 1 << 20
+READ_TAIL_SIZE = 1 << 16
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def read_id(header):
+    """
+    Read name without the '@', the comment and any /1 or /2 mate suffix, so that R1 and R2 IDs can be compared.
+    """
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else b""
+    if name.endswith((b"/1", b"/2")):
+        name = name[:-2]
+    return name.decode("utf-8", "replace")
+
+
+def scan_fastq(path, numIds, full=True):
+    """
+    Check a gzipped FastQ file and return a dict with its gzip format, whether the gzip stream is intact and its
+    number of reads, and the IDs of its first numIds reads. In fast mode only the first reads are decompressed, so
+    the stream is only known to be intact for BGZF files with an end-of-file block and reads are not counted.
+    """
+    result = {"exists": False, "format": None, "intact": None, "reads": None, "errors": []}
+    ids = []
+    if not os.path.isfile(path):
+        result["errors"].append("File does not exist.")
+        return result, ids
+    result["exists"] = True
+
+    with open(path, "rb") as fin:
+        header = fin.read(18)
+        if header[:2] != b"\x1f\x8b":
+            result["intact"] = False
+            result["errors"].append("File is not gzip compressed.")
+            return result, ids
+        isBGZF = len(header) >= 14 and header[3] & 4 and header[12:14] == b"BC"
+        result["format"] = "bgzf" if isBGZF else "gzip"
+        if isBGZF:
+            fin.seek(max(os.path.getsize(path) - len(BGZF_EOF), 0))
+            if fin.read() != BGZF_EOF:
+                result["intact"] = False
+                result["errors"].append("BGZF end-of-file block is missing, the file is truncated.")
+                if not full:
+                    return result, ids
+
+    ## ONLY THE LINES NEEDED FOR THE READ IDS ARE SPLIT, THE REST OF THE FILE IS COUNTED A BLOCK AT A TIME
+    numLines = 0
+    sampledLines = 0
+    partial = b""
+    tail = b""
+    try:
+        with gzip.open(path, "rb") as fin:
+            while True:
+                block = fin.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                if len(ids) < numIds:
+                    lines = (partial + block).split(b"\n")
+                    partial = lines.pop()
+                    for line in lines:
+                        if sampledLines % 4 == 0:
+                            if not line.startswith(b"@"):
+                                result["errors"].append("Read {} does not start with '@'.".format(len(ids) + 1))
+                                return result, ids
+                            ids.append(read_id(line.rstrip(b"\r")))
+                        elif sampledLines % 4 == 2 and not line.startswith(b"+"):
+                            result["errors"].append("Read {} has no '+' separator line.".format(len(ids)))
+                            return result, ids
+                        sampledLines += 1
+                        if len(ids) == numIds and sampledLines % 4 == 0:
+                            break
+                if not full and len(ids) >= numIds:
+                    break
+                numLines += block.count(b"\n")
+                tail = (tail + block)[-READ_TAIL_SIZE:] if len(block) < READ_TAIL_SIZE else block[-READ_TAIL_SIZE:]
+    except (OSError, EOFError, zlib.error) as e:
+        result["intact"] = False
+        result["errors"].append("Gzip stream is corrupt or truncated: {}".format(e))
+        return result, ids
+
+    if full:
+        if tail and not tail.endswith(b"\n"):
+            numLines += 1
+        if result["intact"] is None:
+            result["intact"] = True
+        result["reads"] = numLines // 4
+        lastRead = tail.rstrip(b"\r\n").split(b"\n")[-4:]
+        if numLines % 4:
+            result["errors"].append("Number of lines is not a multiple of 4, the last read is truncated.")
+        elif len(lastRead) == 4 and len(lastRead[1].rstrip(b"\r")) != len(lastRead[3].rstrip(b"\r")):
+            result["errors"].append(
+                "Sequence and quality of the last read differ in length, the last read is truncated."
+            )
+    elif isBGZF:
+        result["intact"] = True
+    if result["reads"] == 0 or (not full and numIds and not ids):
+        result["errors"].append("File contains no reads.")
+    return result, ids
+
+
+def check_pair(scan1, scan2):
+    """
+    Return the errors from comparing the read counts and the first read IDs of the (result, ids) scans of R1 and R2.
+    """
+    (result1, ids1), (result2, ids2) = scan1, scan2
+    errors = []
+    if result1["reads"] is not None and result2["reads"] is not None and result1["reads"] != result2["reads"]:
+        errors.append("fastq_1 has {} reads but fastq_2 has {} reads.".format(result1["reads"], result2["reads"]))
+    for idx, (id1, id2) in enumerate(zip(ids1, ids2)):
+        if id1 != id2:
+            errors.append("Read IDs differ at read {}: '{}' != '{}'.".format(idx + 1, id1, id2))
+            break
+    return errors
+
+
+def scan_fastq_files(FastqFiles, numIds=10000, full=True, threads=1):
+    """
+    Scan FastQ files in a thread pool and return the (result, ids) scan of each file in a dict. Files are
+    decompressed with zlib, which releases the GIL, so the files are read in parallel.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        return dict(zip(FastqFiles, executor.map(lambda x: scan_fastq(x, numIds, full), FastqFiles)))
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def fastq_preflight(sampleId, FastqFiles, ReportFile, mode="full", threads=1, numIds=10000):
+    if len(FastqFiles) not in [1, 2]:
+        raise ValueError("Expected one or two FastQ files but got {}.".format(len(FastqFiles)))
+    scans = scan_fastq_files(FastqFiles, numIds, mode == "full", threads)
+
+    report = {"sample": sampleId, "mode": mode, "files": {}, "errors": []}
+    errors = []
+    for FastqFile in FastqFiles:
+        report["files"][FastqFile] = scans[FastqFile][0]
+        errors += ["{}: {}".format(FastqFile, x) for x in scans[FastqFile][0]["errors"]]
+    if len(FastqFiles) == 2:
+        report["errors"] = check_pair(scans[FastqFiles[0]], scans[FastqFiles[1]])
+        errors += ["{}: {}".format(sampleId, x) for x in report["errors"]]
+    report["passed"] = not errors
+
+    makedir(os.path.dirname(ReportFile))
+    fout = open(ReportFile, "w")
+    json.dump(report, fout, indent=4)
+    fout.close()
+
+    if errors:
+        print("ERROR: FastQ pre-flight check failed ->\n{}".format("\n".join(errors)))
+        sys.exit(1)
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    fastq_preflight(
+        args.SAMPLE_ID, args.FASTQ_FILES, args.REPORT_FILE, mode=args.MODE, threads=args.THREADS, numIds=args.READS
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
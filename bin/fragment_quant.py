@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+
+#######################################################################
+#######################################################################
+## Compute FRiP scores, coverage tracks and consensus peak counts from
+## BGZF-compressed, tabix-indexed fragment files instead of BAM files
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import heapq
+import array
+import pysam
+import argparse
+import itertools
+import collections
+import multiprocessing
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Compute FRiP scores, bedGraph coverage and consensus peak counts from fragment files (chrom, start, end, count) as written by bampe_rm_orphan.py --fragments_output. A fragment file is derived from a paired-end BAM file if a BAM file is given instead."
+    Epilog = """Example usage: python fragment_quant.py frip <FRAGMENTS_FILE> <PEAK_FILE> <OUTFILE> --sample_name <SAMPLE_NAME>"""
+
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of chromosomes, or chromosomes of each sample with count, to process in parallel (default: 1).",
+    )
+    subparsers = parser.add_subparsers(dest="COMMAND")
+    subparsers.required = True
+
+    fragmentsParser = subparsers.add_parser("fragments", help="Write the fragment file for a paired-end BAM file.")
+    fragmentsParser.add_argument("BAM_FILE", help="Coordinate-sorted and indexed paired-end BAM file.")
+    fragmentsParser.add_argument("FRAGMENTS_FILE", help="Output fragment file e.g. 'sample.fragments.tsv.gz'.")
+
+    fripParser = subparsers.add_parser("frip", help="Fraction of Tn5 insertions in peaks.")
+    fripParser.add_argument("INPUT_FILE", help="Fragment file or paired-end BAM file.")
+    fripParser.add_argument("PEAK_FILE", help="Peaks in BED format e.g. MACS2 narrowPeak or broadPeak file.")
+    fripParser.add_argument("OUTFILE", help="Output file with the sample name and FRiP score.")
+    fripParser.add_argument(
+        "-sn", "--sample_name", dest="SAMPLE_NAME", default=None, help="Sample name written to OUTFILE."
+    )
+
+    genomecovParser = subparsers.add_parser(
+        "genomecov", help="bedGraph of fragment coverage, the same as 'bedtools genomecov -bg -pc'."
+    )
+    genomecovParser.add_argument("INPUT_FILE", help="Fragment file or paired-end BAM file.")
+    genomecovParser.add_argument("OUTFILE", help="Output bedGraph file sorted by chromosome name and start.")
+    genomecovParser.add_argument(
+        "-s", "--scale", type=float, dest="SCALE", default=1.0, help="Scale coverage by this factor (default: 1)."
+    )
+
+    countParser = subparsers.add_parser(
+        "count",
+        help="Count Tn5 insertions or fragments in consensus peaks. Output is in the same format as featureCounts.",
+    )
+    countParser.add_argument("SAF_FILE", help="Consensus peaks in SAF format.")
+    countParser.add_argument(
+        "OUTFILE", help="Output count table. A featureCounts-style summary is written to OUTFILE.summary."
+    )
+    countParser.add_argument("INPUT_FILES", nargs="+", help="Fragment files or paired-end BAM files, one per sample.")
+    countParser.add_argument(
+        "-u",
+        "--unit",
+        dest="UNIT",
+        default="insertions",
+        choices=["insertions", "fragments"],
+        help="Count Tn5 insertions, or fragments overlapping each peak as with 'featureCounts -p -O'. Fragments are read straight from coordinate-sorted BAM files without writing fragment files (default: 'insertions').",
+    )
+    countParser.add_argument(
+        "-fo",
+        "--frac_overlap",
+        type=float,
+        dest="FRAC_OVERLAP",
+        default=0.0,
+        help="Minimum fraction of a fragment that has to overlap a peak for it to be counted with '--unit fragments', as with 'featureCounts --fracOverlap' (default: 0).",
+    )
+    countParser.add_argument(
+        "-so",
+        "--sparse_output",
+        dest="SPARSE_OUTPUT",
+        default="",
+        help="Also write the non-zero counts to this file in Matrix Market coordinate format, with peaks and samples in the same order as OUTFILE (default: '').",
+    )
+    return parser.parse_args(args)
+
+
+############################################
+############################################
+## FRAGMENT FILES
+############################################
+############################################
+
+## SHIFTS APPLIED TO FRAGMENT ENDS TO GIVE THE CENTRE OF THE TN5 INSERTION
+TN5_SHIFT_START = 4
+TN5_SHIFT_END = -5
+
+FRAGMENTS_SUFFIX = ".fragments.tsv.gz"
+
+
+def fragments_for(inputFile, threads=1):
+    """
+    Return the fragment file for inputFile. A BAM file is converted once to a fragment file of the same name in the
+    working directory, which is reused on later calls.
+    """
+    if not inputFile.endswith(".bam"):
+        return inputFile
+    fragmentsFile = os.path.basename(inputFile)[:-4] + FRAGMENTS_SUFFIX
+    if not (os.path.exists(fragmentsFile) and os.path.exists(fragmentsFile + ".tbi")):
+        write_fragments(inputFile, fragmentsFile, threads=threads)
+    return fragmentsFile
+
+
+def sample_column(inputFile):
+    ## SAME COLUMN NAME FEATURECOUNTS WOULD USE FOR THE BAM FILE THE FRAGMENTS CAME FROM
+    name = os.path.basename(inputFile)
+    if name.endswith(FRAGMENTS_SUFFIX):
+        return name[: -len(FRAGMENTS_SUFFIX)] + ".bam"
+    return name
+
+
+def iter_bam_fragments(bamFile, contig):
+    """
+    Yield (start, end, count) of the unshifted fragments of one contig of a paired-end BAM file in order of start.
+    One fragment is taken per pair from the primary first mate, spanning the leftmost start to the rightmost end.
+    """
+    fragments = array.array("q")
+    with pysam.AlignmentFile(bamFile, "rb") as SAMFin:
+        for read in SAMFin.fetch(contig):
+            flag = read.flag
+            if flag & 0x40 and not flag & 0x90C:
+                tlen = read.template_length
+                if tlen and read.next_reference_id == read.reference_id:
+                    start = min(read.reference_start, read.next_reference_start)
+                    fragments.append((start << 32) | (start + abs(tlen)))
+    for key, group in itertools.groupby(sorted(fragments)):
+        yield key >> 32, key & 0xFFFFFFFF, sum(1 for x in group)
+
+
+def bam_contig_fragments(task):
+    ## RETURN THE SORTED, TN5-SHIFTED FRAGMENTS OF ONE CONTIG OF A PAIRED-END BAM FILE AS LINES OF A FRAGMENT FILE
+    bamFile, contig = task
+    lines = []
+    for start, end, count in iter_bam_fragments(bamFile, contig):
+        start += TN5_SHIFT_START
+        end += TN5_SHIFT_END
+        if end > start:
+            lines.append("%s\t%d\t%d\t%d\n" % (contig, start, end, count))
+    return "".join(lines)
+
+
+def bam_contigs(bamFile):
+    ## CONTIGS WITH MAPPED READS IN A BAM FILE, WHICH IS INDEXED FIRST IF IT HAS NO INDEX
+    with pysam.AlignmentFile(bamFile, "rb") as SAMFin:
+        hasIndex = SAMFin.has_index()
+    if not hasIndex:
+        pysam.index(bamFile)
+    with pysam.AlignmentFile(bamFile, "rb") as SAMFin:
+        return [x.contig for x in SAMFin.get_index_statistics() if x.mapped > 0]
+
+
+def write_fragments(bamFile, fragmentsFile, threads=1):
+    contigs = bam_contigs(bamFile)
+    with pysam.BGZFile(fragmentsFile, "wb") as fout:
+        for lines in map_contigs(bam_contig_fragments, [(bamFile, x) for x in contigs], threads):
+            fout.write(lines.encode())
+    pysam.tabix_index(fragmentsFile, preset="bed", force=True)
+
+
+def iter_fragments(fragmentsFile, contig):
+    ## YIELD (START, END, COUNT) OF EACH FRAGMENT ON A CONTIG IN ORDER OF START
+    with pysam.TabixFile(fragmentsFile) as tbx:
+        for line in tbx.fetch(contig):
+            lspl = line.split("\t")
+            yield int(lspl[1]), int(lspl[2]), int(lspl[3])
+
+
+def iter_insertions(fragments):
+    """
+    Yield (position, count) for both Tn5 insertions of each fragment in order of position. Fragment starts are
+    already sorted so only fragment ends are held back, until the sweep has moved past them.
+    """
+    ends = []
+    for start, end, count in fragments:
+        while ends and ends[0][0] <= start:
+            yield heapq.heappop(ends)
+        yield start, count
+        heapq.heappush(ends, (end - 1, count))
+    while ends:
+        yield heapq.heappop(ends)
+
+
+def fragment_contigs(fragmentsFile):
+    with pysam.TabixFile(fragmentsFile) as tbx:
+        return list(tbx.contigs)
+
+
+def input_contigs(inputFile):
+    return bam_contigs(inputFile) if inputFile.endswith(".bam") else fragment_contigs(inputFile)
+
+
+def map_contigs(func, tasks, threads):
+    ## RESULTS ARE RETURNED IN THE SAME ORDER AS TASKS
+    if threads > 1 and len(tasks) > 1:
+        pool = multiprocessing.get_context("fork").Pool(processes=min(threads, len(tasks)))
+        try:
+            for result in pool.imap(func, tasks):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            yield func(task)
+
+
+############################################
+############################################
+## SWEEP-LINE OVERLAP
+############################################
+############################################
+
+
+def sweep_peaks(insertions, peaks, peakCounts=None):
+    """
+    Sweep sorted insertions against peaks sorted by start, which may overlap. peaks is a list of tuples starting with
+    start and end.
+    The count of each insertion is added to peakCounts for every peak containing it when peakCounts is given.
+    Returns the total number of insertions, the number of insertion-peak overlaps and the number of insertions
+    in at least one peak.
+    """
+    active = []
+    nextPeak = 0
+    numPeaks = len(peaks)
+    total = overlaps = assigned = 0
+    for pos, count in insertions:
+        total += count
+        while nextPeak < numPeaks and peaks[nextPeak][0] <= pos:
+            heapq.heappush(active, (peaks[nextPeak][1], nextPeak))
+            nextPeak += 1
+        while active and active[0][0] <= pos:
+            heapq.heappop(active)
+        if active:
+            overlaps += count * len(active)
+            assigned += count
+            if peakCounts is not None:
+                for end, idx in active:
+                    peakCounts[idx] += count
+    return total, overlaps, assigned
+
+
+def sweep_fragments(fragments, peaks, peakCounts, fracOverlap=0.0):
+    """
+    Sweep fragments sorted by start against peaks sorted by start, adding the count of each fragment to peakCounts
+    for every peak it overlaps by at least one base and fracOverlap of its length. Peaks are kept in a heap by end
+    until the sweep has moved past them. Returns the total number of fragments and the number in at least one peak.
+    """
+    active = []
+    nextPeak = 0
+    numPeaks = len(peaks)
+    total = assigned = 0
+    for start, end, count in fragments:
+        total += count
+        while nextPeak < numPeaks and peaks[nextPeak][0] < end:
+            heapq.heappush(active, (peaks[nextPeak][1], nextPeak))
+            nextPeak += 1
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        minOverlap = max(fracOverlap * (end - start), 1)
+        inPeaks = False
+        for peakEnd, idx in active:
+            if min(peakEnd, end) - max(peaks[idx][0], start) >= minOverlap:
+                peakCounts[idx] += count
+                inPeaks = True
+        if inPeaks:
+            assigned += count
+    return total, assigned
+
+
+def sweep_coverage(fragments, contig, scale):
+    """
+    Return bedGraph lines of the coverage of fragments on a contig. Fragments are shifted back to the ends of the
+    read pair so that the coverage is the same as 'bedtools genomecov -bg -pc'.
+    """
+    lines = []
+    ends = []
+    depth = 0
+    pos = 0
+    run = None
+
+    def step(nextPos, delta):
+        nonlocal depth, pos, run
+        if nextPos > pos and depth > 0:
+            if run and run[1] == pos and run[2] == depth:
+                run[1] = nextPos
+            else:
+                if run:
+                    lines.append("%s\t%d\t%d\t%g\n" % (contig, run[0], run[1], run[2] * scale))
+                run = [pos, nextPos, depth]
+        depth += delta
+        pos = nextPos
+
+    for start, end, count in fragments:
+        start -= TN5_SHIFT_START
+        while ends and ends[0][0] <= start:
+            end0, count0 = heapq.heappop(ends)
+            step(end0, -count0)
+        step(start, count)
+        heapq.heappush(ends, (end - TN5_SHIFT_END, count))
+    while ends:
+        end0, count0 = heapq.heappop(ends)
+        step(end0, -count0)
+    if run:
+        lines.append("%s\t%d\t%d\t%g\n" % (contig, run[0], run[1], run[2] * scale))
+    return "".join(lines)
+
+
+############################################
+############################################
+## COMMANDS
+############################################
+############################################
+
+
+def read_peaks(peakFile, saf=False):
+    """
+    Return an ordered dict of contig to lists of (start, end, idx) from a BED or SAF file, sorted by start, and the
+    number of peaks. SAF starts are 1-based as in featureCounts.
+    """
+    peaks = collections.OrderedDict()
+    numPeaks = 0
+    with open(peakFile, "r") as fin:
+        for line in fin:
+            lspl = line.rstrip("\n").split("\t")
+            if saf:
+                if lspl[0] == "GeneID" or len(lspl) < 4:
+                    continue
+                chrom, start, end = lspl[1], int(lspl[2]) - 1, int(lspl[3])
+            else:
+                if len(lspl) < 3 or lspl[0].startswith(("#", "track", "browser")):
+                    continue
+                chrom, start, end = lspl[0], int(lspl[1]), int(lspl[2])
+            peaks.setdefault(chrom, []).append((start, end, numPeaks))
+            numPeaks += 1
+    for chrom in peaks:
+        peaks[chrom].sort()
+    return peaks, numPeaks
+
+
+def contig_frip(task):
+    ## AN INSERTION IS COUNTED ONCE HOWEVER MANY PEAKS IT IS IN, THE SAME AS 'bedtools intersect -u'
+    fragmentsFile, contig, peaks = task
+    total, overlaps, assigned = sweep_peaks(iter_insertions(iter_fragments(fragmentsFile, contig)), peaks)
+    return total, assigned
+
+
+def frip(inputFile, peakFile, outFile, sampleName=None, threads=1):
+    fragmentsFile = fragments_for(inputFile, threads)
+    peaks, numPeaks = read_peaks(peakFile)
+    tasks = [(fragmentsFile, x, peaks.get(x, [])) for x in fragment_contigs(fragmentsFile)]
+    total = inPeaks = 0
+    for contigTotal, contigInPeaks in map_contigs(contig_frip, tasks, threads):
+        total += contigTotal
+        inPeaks += contigInPeaks
+
+    ## SAME OUTPUT AS THE AWK COMMAND IN FRIP_SCORE
+    sampleName = sampleName if sampleName else os.path.basename(inputFile).split(".")[0]
+    with open(outFile, "w") as fout:
+        fout.write("%s\t%.6g\n" % (sampleName, inPeaks / float(total) if total else 0))
+
+
+def contig_coverage(task):
+    fragmentsFile, contig, scale = task
+    return sweep_coverage(iter_fragments(fragmentsFile, contig), contig, scale)
+
+
+def genomecov(inputFile, outFile, scale=1.0, threads=1):
+    fragmentsFile = fragments_for(inputFile, threads)
+
+    ## SORTED BY CHROMOSOME NAME FOR BEDGRAPHTOBIGWIG, AS AFTER 'bedtools sort'
+    tasks = [(fragmentsFile, x, scale) for x in sorted(fragment_contigs(fragmentsFile))]
+    with open(outFile, "w") as fout:
+        for lines in map_contigs(contig_coverage, tasks, threads):
+            fout.write(lines)
+
+
+def iter_unshifted_fragments(fragmentsFile, contig):
+    ## FRAGMENTS OF A FRAGMENT FILE SHIFTED BACK TO THE ENDS OF THE READ PAIR
+    for start, end, count in iter_fragments(fragmentsFile, contig):
+        yield start - TN5_SHIFT_START, end - TN5_SHIFT_END, count
+
+
+def contig_counts(task):
+    inputFile, contig, peaks, unit, fracOverlap = task
+    peakCounts = [0] * len(peaks)
+    if unit == "fragments":
+        if inputFile.endswith(".bam"):
+            fragments = iter_bam_fragments(inputFile, contig)
+        else:
+            fragments = iter_unshifted_fragments(inputFile, contig)
+        total, assigned = sweep_fragments(fragments, peaks, peakCounts, fracOverlap)
+    else:
+        total, overlaps, assigned = sweep_peaks(iter_insertions(iter_fragments(inputFile, contig)), peaks, peakCounts)
+    return total, assigned, [(peaks[x][2], peakCounts[x]) for x in range(len(peaks)) if peakCounts[x]]
+
+
+def count(safFile, outFile, inputFiles, unit="insertions", fracOverlap=0.0, sparseFile="", threads=1):
+    """
+    Count Tn5 insertions or fragments in each consensus peak of each sample, writing the table and summary in the
+    same format as 'featureCounts -F SAF -O' so that they can be used by deseq2_qc.r and MultiQC. Every chromosome
+    of every sample is counted as a separate task so samples and chromosomes are processed in parallel.
+    """
+    with open(safFile, "r") as fin:
+        safRows = [x.rstrip("\n").split("\t") for x in fin if x.strip() and not x.startswith("GeneID")]
+    peaks, numPeaks = read_peaks(safFile, saf=True)
+
+    ## FRAGMENTS ARE COUNTED STRAIGHT FROM BAM FILES SO THEY ARE ONLY CONVERTED TO FRAGMENT FILES FOR INSERTIONS
+    if unit == "fragments":
+        countFiles = inputFiles
+    else:
+        countFiles = [fragments_for(x, threads) for x in inputFiles]
+    ## BAM FILES WITHOUT AN INDEX ARE INDEXED IN PARALLEL WHILE THEIR CONTIGS ARE LISTED
+    tasks = []
+    for idx, contigs in enumerate(map_contigs(input_contigs, countFiles, threads)):
+        countFile = countFiles[idx]
+        for contig in contigs:
+            tasks.append((idx, (countFile, contig, peaks.get(contig, []), unit, fracOverlap)))
+
+    counts = [[0] * len(inputFiles) for x in range(numPeaks)]
+    totals = [0] * len(inputFiles)
+    assigned = [0] * len(inputFiles)
+    results = map_contigs(contig_counts, [x[1] for x in tasks], threads)
+    for (idx, task), (contigTotal, contigAssigned, peakCounts) in zip(tasks, results):
+        totals[idx] += contigTotal
+        assigned[idx] += contigAssigned
+        for peakIdx, peakCount in peakCounts:
+            counts[peakIdx][idx] = peakCount
+
+    columns = [sample_column(x) for x in inputFiles]
+    with open(outFile, "w") as fout:
+        fout.write('# Program:fragment_quant.py; Command:"%s"\n' % (" ".join(sys.argv)))
+        fout.write("\t".join(["Geneid", "Chr", "Start", "End", "Strand", "Length"] + columns) + "\n")
+        for row, peakCounts in zip(safRows, counts):
+            length = int(row[3]) - int(row[2]) + 1
+            fout.write("\t".join(row[:5] + [str(length)] + [str(x) for x in peakCounts]) + "\n")
+
+    with open(outFile + ".summary", "w") as fout:
+        fout.write("\t".join(["Status"] + columns) + "\n")
+        fout.write("\t".join(["Assigned"] + [str(x) for x in assigned]) + "\n")
+        fout.write("\t".join(["Unassigned_NoFeatures"] + [str(x - y) for x, y in zip(totals, assigned)]) + "\n")
+
+    if sparseFile:
+        write_sparse_counts(sparseFile, counts, len(inputFiles))
+
+
+def write_sparse_counts(sparseFile, counts, numSamples):
+    ## MATRIX MARKET COORDINATE FORMAT, READ WITH Matrix::readMM IN R OR scipy.io.mmread IN PYTHON
+    entries = [(row, col, x) for row, peakCounts in enumerate(counts) for col, x in enumerate(peakCounts) if x]
+    with open(sparseFile, "w") as fout:
+        fout.write("%%MatrixMarket matrix coordinate integer general\n")
+        fout.write("% Rows are peaks and columns are samples in the same order as the count table\n")
+        fout.write("%d %d %d\n" % (len(counts), numSamples, len(entries)))
+        fout.write("".join(["%d %d %d\n" % (row + 1, col + 1, x) for row, col, x in entries]))
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.COMMAND == "fragments":
+        write_fragments(args.BAM_FILE, args.FRAGMENTS_FILE, threads=args.THREADS)
+    elif args.COMMAND == "frip":
+        frip(args.INPUT_FILE, args.PEAK_FILE, args.OUTFILE, sampleName=args.SAMPLE_NAME, threads=args.THREADS)
+    elif args.COMMAND == "genomecov":
+        genomecov(args.INPUT_FILE, args.OUTFILE, scale=args.SCALE, threads=args.THREADS)
+    elif args.COMMAND == "count":
+        count(
+            args.SAF_FILE,
+            args.OUTFILE,
+            args.INPUT_FILES,
+            unit=args.UNIT,
+            fracOverlap=args.FRAC_OVERLAP,
+            sparseFile=args.SPARSE_OUTPUT,
+            threads=args.THREADS,
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+#######################################################################
+#######################################################################
+## Share prepared genome files between pipeline runs in a directory
+## keyed by the checksums of the files they were made from
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import json
+import fcntl
+import errno
+import shutil
+import hashlib
+import argparse
+import tempfile
+import datetime
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Fetch prepared genome files from, or store them in, a cache directory shared between pipeline runs. Each bundle of files is keyed by the SHA-256 checksums of the input files and the parameters used to make it."
+    Epilog = """Example usage: python genome_cache.py fetch <CACHE_DIR> <OUTDIR> --input fai=genome.fa.fai --param keep_mito=false --artefact autosomes"""
+
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+    subparsers = parser.add_subparsers(dest="COMMAND")
+    subparsers.required = True
+
+    fetchParser = subparsers.add_parser(
+        "fetch", help="Write the cache key to OUTDIR/genome_cache.json and copy the bundle for the key if it is cached."
+    )
+    fetchParser.add_argument("CACHE_DIR", help="Cache directory shared between runs.")
+    fetchParser.add_argument("OUTDIR", help="Output directory. Cached files are copied to OUTDIR/<ARTEFACT>/.")
+    fetchParser.add_argument(
+        "-i",
+        "--input",
+        dest="INPUTS",
+        action="append",
+        default=[],
+        help="NAME=FILE of an input file whose checksum is part of the key. Can be given more than once.",
+    )
+    fetchParser.add_argument(
+        "-p",
+        "--param",
+        dest="PARAMS",
+        action="append",
+        default=[],
+        help="NAME=VALUE of a parameter that is part of the key. Can be given more than once.",
+    )
+    fetchParser.add_argument(
+        "-a",
+        "--artefact",
+        dest="ARTEFACTS",
+        action="append",
+        default=[],
+        help="Name of a file that the bundle has to contain. Can be given more than once.",
+    )
+
+    storeParser = subparsers.add_parser("store", help="Store prepared files in the cache under the key in KEY_FILE.")
+    storeParser.add_argument("CACHE_DIR", help="Cache directory shared between runs.")
+    storeParser.add_argument("KEY_FILE", help="genome_cache.json written by fetch.")
+    storeParser.add_argument(
+        "-a",
+        "--artefact",
+        dest="ARTEFACTS",
+        action="append",
+        default=[],
+        help="NAME=FILE of a prepared file to store. Can be given more than once.",
+    )
+    return parser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## BUMP WHEN THE FILES MADE FROM THE SAME INPUTS CHANGE SO THAT OLD BUNDLES ARE NOT REUSED
+CACHE_VERSION = 2
+
+MANIFEST_FILE = "manifest.json"
+KEY_FILE = "genome_cache.json"
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def file_checksum(path, blockSize=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(blockSize), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def parse_pairs(pairs):
+    pairDict = {}
+    for pair in pairs:
+        if "=" not in pair:
+            raise ValueError("Expected NAME=VALUE but got '{}'.".format(pair))
+        name, value = pair.split("=", 1)
+        pairDict[name] = value
+    return pairDict
+
+
+def cache_key(inputs, params, artefacts):
+    """
+    Return the key of a bundle as the SHA-256 checksum of the checksums of its input files, its parameters and the
+    names of the files it contains. The names of the input files are not part of the key, so renamed or moved
+    copies of the same files share a bundle.
+    """
+    keyData = {
+        "version": CACHE_VERSION,
+        "inputs": dict([(name, file_checksum(path)) for name, path in inputs.items()]),
+        "params": params,
+        "artefacts": sorted(artefacts),
+    }
+    return hashlib.sha256(json.dumps(keyData, sort_keys=True).encode()).hexdigest(), keyData
+
+
+class CacheLock:
+    """
+    Advisory lock on a key, held exclusively while a bundle is written and shared while it is read.
+    """
+
+    def __init__(self, cacheDir, key, shared=False):
+        self.path = os.path.join(cacheDir, ".{}.lock".format(key))
+        self.shared = shared
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o664)
+        fcntl.flock(self.fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+
+def read_bundle(bundleDir, artefacts):
+    """
+    Return the manifest of a bundle if it contains all of artefacts and their checksums match, otherwise None.
+    """
+    manifestFile = os.path.join(bundleDir, MANIFEST_FILE)
+    if not os.path.exists(manifestFile):
+        return None
+    with open(manifestFile) as fin:
+        manifest = json.load(fin)
+    for name in artefacts:
+        entry = manifest["artefacts"].get(name)
+        if not entry:
+            return None
+        path = os.path.join(bundleDir, name, entry["file"])
+        if not os.path.exists(path) or file_checksum(path) != entry["sha256"]:
+            return None
+    return manifest
+
+
+############################################
+############################################
+## MAIN FUNCTIONS
+############################################
+############################################
+
+
+def fetch(cacheDir, outDir, inputs, params, artefacts):
+    makedir(cacheDir)
+    makedir(outDir)
+    key, keyData = cache_key(inputs, params, artefacts)
+    bundleDir = os.path.join(cacheDir, key)
+    with CacheLock(cacheDir, key, shared=True):
+        manifest = read_bundle(bundleDir, artefacts)
+        if manifest:
+            for name in artefacts:
+                fileName = manifest["artefacts"][name]["file"]
+                makedir(os.path.join(outDir, name))
+                shutil.copyfile(os.path.join(bundleDir, name, fileName), os.path.join(outDir, name, fileName))
+
+    keyData.update({"key": key, "hit": manifest is not None})
+    with open(os.path.join(outDir, KEY_FILE), "w") as fout:
+        json.dump(keyData, fout, indent=4, sort_keys=True)
+    return keyData["hit"]
+
+
+def store(cacheDir, keyFile, artefacts):
+    with open(keyFile) as fin:
+        keyData = json.load(fin)
+    key = keyData["key"]
+    if sorted(artefacts) != keyData["artefacts"]:
+        raise ValueError(
+            "Files to store do not match the files in the key: {}.".format(", ".join(keyData["artefacts"]))
+        )
+
+    makedir(cacheDir)
+    bundleDir = os.path.join(cacheDir, key)
+    with CacheLock(cacheDir, key):
+        ## ANOTHER RUN STORED THE SAME BUNDLE FIRST
+        if read_bundle(bundleDir, artefacts):
+            return
+
+        ## THE BUNDLE ONLY APPEARS UNDER ITS KEY ONCE IT IS COMPLETE, SO READERS NEVER SEE A PARTIAL COPY
+        tmpDir = tempfile.mkdtemp(prefix=".{}.".format(key), dir=cacheDir)
+        try:
+            manifest = dict(keyData)
+            del manifest["hit"]
+            manifest["created"] = datetime.datetime.now().isoformat()
+            manifest["artefacts"] = {}
+            for name, path in sorted(artefacts.items()):
+                fileName = os.path.basename(path)
+                makedir(os.path.join(tmpDir, name))
+                shutil.copyfile(path, os.path.join(tmpDir, name, fileName))
+                manifest["artefacts"][name] = {"file": fileName, "sha256": file_checksum(path)}
+            with open(os.path.join(tmpDir, MANIFEST_FILE), "w") as fout:
+                json.dump(manifest, fout, indent=4, sort_keys=True)
+            os.chmod(tmpDir, 0o775)
+
+            ## AN INCOMPLETE OR CORRUPT BUNDLE IS MOVED ASIDE BEFORE IT IS REPLACED
+            if os.path.exists(bundleDir):
+                staleDir = tempfile.mkdtemp(prefix=".{}.".format(key), dir=cacheDir)
+                os.rename(bundleDir, os.path.join(staleDir, key))
+                shutil.rmtree(staleDir)
+            os.rename(tmpDir, bundleDir)
+        except BaseException:
+            ## A FAILED COPY MUST NOT LEAVE A PARTIAL BUNDLE BEHIND IN THE SHARED CACHE
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.COMMAND == "fetch":
+        fetch(args.CACHE_DIR, args.OUTDIR, parse_pairs(args.INPUTS), parse_pairs(args.PARAMS), args.ARTEFACTS)
+    elif args.COMMAND == "store":
+        store(args.CACHE_DIR, args.KEY_FILE, parse_pairs(args.ARTEFACTS))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
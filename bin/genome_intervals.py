@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+#######################################################################
+#######################################################################
+## Interval arithmetic on genome regions e.g. to make the regions
+## left after removing blacklisted and mitochondrial regions
+#######################################################################
+#######################################################################
+
+import os
+import re
+import sys
+import errno
+import bisect
+import argparse
+from array import array
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Make the regions of a genome to include in the analysis from its chromosome sizes and a blacklist, or filter BED records by their overlap with a set of regions."
+    Epilog = """Example usage: python genome_intervals.py include_regions <SIZES_FILE> <OUT_FILE> --blacklist <BLACKLIST_FILE> --mito_name chrM"""
+
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+    subparsers = parser.add_subparsers(dest="COMMAND")
+    subparsers.required = True
+
+    includeParser = subparsers.add_parser(
+        "include_regions",
+        help="Regions of the genome that are not blacklisted, the same as 'sortBed | complementBed' on the blacklist.",
+    )
+    includeParser.add_argument("SIZES_FILE", help="Chromosome sizes file e.g. from 'cut -f 1,2 genome.fa.fai'.")
+    includeParser.add_argument("OUT_FILE", help="Output BED file in the chromosome order of SIZES_FILE.")
+    includeParser.add_argument(
+        "-b", "--blacklist", dest="BLACKLIST", default="", help="BED file of regions to remove (default: '')."
+    )
+    includeParser.add_argument(
+        "-mn",
+        "--mito_name",
+        dest="MITO_NAME",
+        default="",
+        help="Regular expression matching the mitochondrial and other chromosomes to remove e.g. 'chrM' (default: '').",
+    )
+    includeParser.add_argument(
+        "-cf",
+        "--chromosome_file",
+        dest="CHROMOSOME_FILE",
+        default="",
+        help="Only keep the chromosomes listed one per line in this file e.g. as written by get_autosomes.py (default: '').",
+    )
+
+    filterParser = subparsers.add_parser("filter", help="Keep the BED records that overlap a set of regions.")
+    filterParser.add_argument("BED_FILE", help="BED file of records to filter e.g. MACS2 peaks.")
+    filterParser.add_argument("REGIONS_FILE", help="BED file of regions.")
+    filterParser.add_argument("OUT_FILE", help="Output BED file with the records in the same order as BED_FILE.")
+    filterParser.add_argument(
+        "-v",
+        "--invert",
+        dest="INVERT",
+        action="store_true",
+        help="Keep the records that do not overlap any of the regions instead, the same as 'intersectBed -v'.",
+    )
+    return parser.parse_args(args)
+
+
+############################################
+############################################
+## INTERVAL SETS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def merge_sorted(intervals):
+    """
+    Merge overlapping and book-ended intervals of a list sorted by start into start and end arrays.
+    """
+    starts = array("q")
+    ends = array("q")
+    for start, end in intervals:
+        if end <= start:
+            continue
+        if ends and start <= ends[-1]:
+            if end > ends[-1]:
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+class IntervalSet:
+    """
+    Set of half-open intervals on each chromosome, kept merged in sorted start and end arrays so that overlap
+    queries take O(log n) with bisect and set operations take a single sweep over both sets.
+    """
+
+    def __init__(self, chromIntervals=None):
+        self.chroms = {}
+        for chrom, intervals in (chromIntervals or {}).items():
+            starts, ends = merge_sorted(sorted(intervals))
+            if starts:
+                self.chroms[chrom] = (starts, ends)
+
+    @classmethod
+    def from_bed(cls, BedFile):
+        chromIntervals = {}
+        fin = open(BedFile, "r")
+        for line in fin:
+            if line.startswith(("#", "track", "browser")):
+                continue
+            lspl = line.split("\t")
+            if len(lspl) < 3:
+                continue
+            chromIntervals.setdefault(lspl[0], []).append((int(lspl[1]), int(lspl[2])))
+        fin.close()
+        return cls(chromIntervals)
+
+    @classmethod
+    def from_sizes(cls, sizes):
+        return cls(dict([(chrom, [(0, size)]) for chrom, size in sizes.items()]))
+
+    @classmethod
+    def from_arrays(cls, chromArrays):
+        intervalSet = cls()
+        intervalSet.chroms = dict([(x, y) for x, y in chromArrays.items() if y[0]])
+        return intervalSet
+
+    def __len__(self):
+        return sum([len(x[0]) for x in self.chroms.values()])
+
+    def intervals(self, chrom):
+        starts, ends = self.chroms.get(chrom, ([], []))
+        return zip(starts, ends)
+
+    def overlaps(self, chrom, start, end):
+        """
+        Whether any interval overlaps [start, end), or contains start if the query is empty.
+        """
+        if chrom not in self.chroms:
+            return False
+        starts, ends = self.chroms[chrom]
+        idx = bisect.bisect_right(ends, start)
+        return idx < len(starts) and starts[idx] < max(end, start + 1)
+
+    def contains(self, chrom, pos):
+        return self.overlaps(chrom, pos, pos + 1)
+
+    def union(self, other):
+        chromIntervals = {}
+        for chrom in set(self.chroms) | set(other.chroms):
+            chromIntervals[chrom] = list(self.intervals(chrom)) + list(other.intervals(chrom))
+        return IntervalSet(chromIntervals)
+
+    def intersect(self, other):
+        chromArrays = {}
+        for chrom in set(self.chroms) & set(other.chroms):
+            (aStarts, aEnds), (bStarts, bEnds) = self.chroms[chrom], other.chroms[chrom]
+            starts, ends = array("q"), array("q")
+            i, j = 0, 0
+            while i < len(aStarts) and j < len(bStarts):
+                start = max(aStarts[i], bStarts[j])
+                end = min(aEnds[i], bEnds[j])
+                if start < end:
+                    starts.append(start)
+                    ends.append(end)
+                if aEnds[i] < bEnds[j]:
+                    i += 1
+                else:
+                    j += 1
+            chromArrays[chrom] = (starts, ends)
+        return IntervalSet.from_arrays(chromArrays)
+
+    def subtract(self, other):
+        chromArrays = {}
+        for chrom, (aStarts, aEnds) in self.chroms.items():
+            bStarts, bEnds = other.chroms.get(chrom, ([], []))
+            starts, ends = array("q"), array("q")
+            j = 0
+            for start, end in zip(aStarts, aEnds):
+                while j < len(bStarts) and bEnds[j] <= start:
+                    j += 1
+                k = j
+                while k < len(bStarts) and bStarts[k] < end:
+                    if bStarts[k] > start:
+                        starts.append(start)
+                        ends.append(bStarts[k])
+                    start = max(start, bEnds[k])
+                    k += 1
+                if start < end:
+                    starts.append(start)
+                    ends.append(end)
+            chromArrays[chrom] = (starts, ends)
+        return IntervalSet.from_arrays(chromArrays)
+
+    def complement(self, sizes):
+        return IntervalSet.from_sizes(sizes).subtract(self)
+
+    def write_bed(self, OutFile, chromOrder=None):
+        makedir(os.path.dirname(OutFile))
+        fout = open(OutFile, "w")
+        for chrom in chromOrder if chromOrder is not None else sorted(self.chroms):
+            fout.write("".join(["%s\t%d\t%d\n" % (chrom, start, end) for start, end in self.intervals(chrom)]))
+        fout.close()
+
+
+def read_sizes(SizesFile):
+    """
+    Return the chromosome sizes in a dict in the order of the file.
+    """
+    sizes = {}
+    fin = open(SizesFile, "r")
+    for line in fin:
+        lspl = line.strip().split("\t")
+        if len(lspl) >= 2:
+            sizes[lspl[0]] = int(lspl[1])
+    fin.close()
+    return sizes
+
+
+############################################
+############################################
+## MAIN FUNCTIONS
+############################################
+############################################
+
+
+def include_regions(SizesFile, OutFile, blacklistFile="", mitoName="", chromosomeFile=""):
+    sizes = read_sizes(SizesFile)
+    if mitoName:
+        sizes = dict([(x, y) for x, y in sizes.items() if not re.search(mitoName, x)])
+    if chromosomeFile:
+        keepChroms = set([x.strip() for x in open(chromosomeFile, "r") if x.strip()])
+        sizes = dict([(x, y) for x, y in sizes.items() if x in keepChroms])
+
+    regions = IntervalSet.from_sizes(sizes)
+    if blacklistFile:
+        regions = regions.subtract(IntervalSet.from_bed(blacklistFile))
+    regions.write_bed(OutFile, chromOrder=list(sizes))
+
+
+def filter_bed(BedFile, RegionsFile, OutFile, invert=False):
+    regions = IntervalSet.from_bed(RegionsFile)
+    makedir(os.path.dirname(OutFile))
+    fin = open(BedFile, "r")
+    fout = open(OutFile, "w")
+    for line in fin:
+        lspl = line.split("\t")
+        if len(lspl) < 3 or line.startswith(("#", "track", "browser")):
+            continue
+        if regions.overlaps(lspl[0], int(lspl[1]), int(lspl[2])) != invert:
+            fout.write(line)
+    fin.close()
+    fout.close()
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.COMMAND == "include_regions":
+        include_regions(
+            args.SIZES_FILE,
+            args.OUT_FILE,
+            blacklistFile=args.BLACKLIST,
+            mitoName=args.MITO_NAME,
+            chromosomeFile=args.CHROMOSOME_FILE,
+        )
+    elif args.COMMAND == "filter":
+        filter_bed(args.BED_FILE, args.REGIONS_FILE, args.OUT_FILE, invert=args.INVERT)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+#######################################################################
+#######################################################################
+## Split a genome into balanced work units for parallel processing
+#######################################################################
+#######################################################################
+
+import os
+import re
+import sys
+import json
+import errno
+import argparse
+
+from genome_intervals import IntervalSet
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Split the chromosomes in a FAI file into work units of roughly equal size, cutting large chromosomes in blacklisted gaps where possible and bundling small contigs together, and write the plan as BED and JSON."
+    Epilog = """Example usage: python genome_shards.py <FAI_FILE> <BED_FILE> <JSON_FILE> --num_shards 32 --blacklist <BLACKLIST_FILE>"""
+
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    parser.add_argument("FAI_FILE", help="FAI or chromosome sizes file for the assembly.")
+    parser.add_argument(
+        "BED_FILE", help="Output BED file with the regions of each shard and the shard name in column 4."
+    )
+    parser.add_argument("JSON_FILE", help="Output JSON file with the regions, chromosomes and size of each shard.")
+
+    ## OPTIONAL PARAMETERS
+    parser.add_argument(
+        "-n", "--num_shards", type=int, dest="NUM_SHARDS", default=32, help="Number of shards to make (default: 32)."
+    )
+    parser.add_argument(
+        "-b",
+        "--blacklist",
+        dest="BLACKLIST",
+        default="",
+        help="BED file of regions left out of the shards. Chromosomes are preferably cut in these gaps (default: '').",
+    )
+    parser.add_argument(
+        "-mn",
+        "--mito_name",
+        dest="MITO_NAME",
+        default="",
+        help="Regular expression matching the mitochondrial and other chromosomes to leave out e.g. 'chrM' (default: '').",
+    )
+    parser.add_argument(
+        "-to",
+        "--tolerance",
+        type=float,
+        dest="TOLERANCE",
+        default=0.05,
+        help="Fraction of the shard size by which a shard may differ from it to be cut in a gap or between contigs instead of inside a region (default: 0.05).",
+    )
+    return parser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def read_fai(FAIFile):
+    sizes = {}
+    fin = open(FAIFile, "r")
+    for line in fin:
+        lspl = line.strip().split("\t")
+        if len(lspl) >= 2:
+            sizes[lspl[0]] = int(lspl[1])
+    fin.close()
+    return sizes
+
+
+def plan_shards(regions, chromOrder, numShards, tolerance=0.05):
+    """
+    Return numShards lists of (chrom, start, end) regions of roughly equal total size, walking the regions in
+    chromosome order. A shard is closed between two regions, i.e. in a blacklisted gap or between contigs, if
+    that brings it within tolerance of the target size, otherwise the region that crosses the target is cut.
+    Contigs smaller than the tolerance are therefore never split, and runs of them share a shard.
+    """
+    remaining = sum([end - start for chrom in chromOrder for start, end in regions.intervals(chrom)])
+    ## A SHARD HAS TO HOLD AT LEAST ONE BASE
+    numShards = max(min(numShards, remaining), 1)
+
+    ## THE TARGET IS SPREAD OVER THE SHARDS LEFT EACH TIME ONE IS OPENED SO THE LAST ONE DOES NOT COLLECT THE SLACK
+    def open_shard():
+        shards.append([])
+        target = float(remaining) / max(numShards - len(shards) + 1, 1)
+        return target, target * tolerance
+
+    shards = []
+    target, slack = open_shard()
+    size = 0
+    for chrom in chromOrder:
+        for start, end in regions.intervals(chrom):
+            while len(shards) < numShards and size + (end - start) > target + slack:
+                need = int(round(target - size))
+                if need > 0:
+                    shards[-1].append((chrom, start, start + need))
+                    remaining -= need
+                    start += need
+                target, slack = open_shard()
+                size = 0
+            if start < end:
+                shards[-1].append((chrom, start, end))
+            remaining -= end - start
+            size += end - start
+            if len(shards) < numShards and size >= target - slack:
+                target, slack = open_shard()
+                size = 0
+    return [x for x in shards if x]
+
+
+def shard_name(index, numShards):
+    return "shard_{}".format(str(index + 1).zfill(len(str(numShards))))
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def genome_shards(FAIFile, BedFile, JsonFile, numShards=32, blacklistFile="", mitoName="", tolerance=0.05):
+    sizes = read_fai(FAIFile)
+    if mitoName:
+        sizes = dict([(x, y) for x, y in sizes.items() if not re.search(mitoName, x)])
+    regions = IntervalSet.from_sizes(sizes)
+    if blacklistFile:
+        regions = regions.subtract(IntervalSet.from_bed(blacklistFile))
+    shards = plan_shards(regions, list(sizes), numShards, tolerance)
+
+    makedir(os.path.dirname(BedFile))
+    fout = open(BedFile, "w")
+    for idx, shard in enumerate(shards):
+        name = shard_name(idx, len(shards))
+        fout.write("".join(["%s\t%d\t%d\t%s\n" % (chrom, start, end, name) for chrom, start, end in shard]))
+    fout.close()
+
+    plan = {"num_shards": len(shards), "genome_size": sum(sizes.values()), "shards": []}
+    for idx, shard in enumerate(shards):
+        chroms = []
+        for chrom, start, end in shard:
+            if chrom not in chroms:
+                chroms.append(chrom)
+        plan["shards"].append(
+            {
+                "name": shard_name(idx, len(shards)),
+                "size": sum([end - start for chrom, start, end in shard]),
+                "chromosomes": chroms,
+                "regions": [list(x) for x in shard],
+            }
+        )
+    makedir(os.path.dirname(JsonFile))
+    fout = open(JsonFile, "w")
+    json.dump(plan, fout, indent=4)
+    fout.close()
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    genome_shards(
+        args.FAI_FILE,
+        args.BED_FILE,
+        args.JSON_FILE,
+        numShards=args.NUM_SHARDS,
+        blacklistFile=args.BLACKLIST,
+        mitoName=args.MITO_NAME,
+        tolerance=args.TOLERANCE,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+#######################################################################
+#######################################################################
+## Convert a GTF file to BED12 transcript models and TSS files in a
+## single streaming pass, replacing the gtf2bed Perl script
+#######################################################################
+#######################################################################
+
+import os
+import re
+import sys
+import gzip
+import heapq
+import errno
+import shutil
+import argparse
+import tempfile
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Convert a plain or gzipped GTF file to BED12 transcript models, in the same format as the gtf2bed Perl script, and optionally write TSS files in the same pass. Transcripts are written out once the file moves past their chromosome, so only the models of one chromosome and the IDs of the transcripts already written are held in memory. A transcript ID that appears again on a later chromosome is written as a separate transcript named <ID>_dup<N> with a warning."
+    Epilog = """Example usage: python gtf2bed.py <GTF_FILE> <BED_FILE> --tss_bed <TSS_BED> --gene_tss <GENE_TSS>"""
+
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    parser.add_argument(
+        "GTF_FILE", help="GTF file, or GFF3 file with exons linked to transcripts by Parent. Can be gzipped."
+    )
+    parser.add_argument("BED_FILE", help="Output BED12 file sorted by chromosome name and transcript position.")
+
+    ## OPTIONAL PARAMETERS
+    parser.add_argument(
+        "-tb",
+        "--tss_bed",
+        dest="TSS_BED",
+        default="",
+        help="Output BED6 file of transcript start sites, with one record per position and strand sorted by chromosome name and position (default: '').",
+    )
+    parser.add_argument(
+        "-gt",
+        "--gene_tss",
+        dest="GENE_TSS",
+        default="",
+        help="Output tab-delimited file with the span, name, strand, number of transcripts and 0-based start sites of the transcripts of each gene (default: '').",
+    )
+    parser.add_argument(
+        "-x",
+        "--extended",
+        dest="EXTENDED",
+        action="store_true",
+        help="Add the gene name, or gene ID if there is no name, as a 13th column as with 'gtf2bed -x'.",
+    )
+    return parser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## FEATURES THAT MAKE UP TRANSCRIPT MODELS, ALL OTHER LINES ARE SKIPPED BEFORE THEIR ATTRIBUTES ARE PARSED
+MODEL_FEATURES = set(["exon", "miRNA", "start_codon", "stop_codon"])
+
+GTF_TRANSCRIPT_ID = re.compile(r'transcript_id "([^"]+)"')
+GFF_PARENT = re.compile(r"\bParent=([^;,]+)")
+GENE_ID = re.compile(r'gene_id "([^"]+)"')
+GENE_NAME = re.compile(r'gene_name "([^"]+)"')
+
+GENE_TSS_HEADER = ["chrom", "start", "end", "gene_id", "gene_name", "strand", "num_transcripts", "tss"]
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def open_input(FileName):
+    if FileName.endswith(".gz"):
+        return gzip.open(FileName, "rt")
+    return open(FileName, "r")
+
+
+class Transcript:
+    """
+    Exons and codons of a transcript, with the chromosome, strand and attributes of its first exon.
+    """
+
+    __slots__ = ["order", "chrom", "start", "strand", "attributes", "exons", "codonStart", "codonEnd"]
+
+    def __init__(self, order):
+        self.order = order
+        self.chrom = None
+        self.exons = []
+        self.codonStart = 0
+        self.codonEnd = 0
+
+    def add_exon(self, fields):
+        if self.chrom is None:
+            self.chrom, self.start, self.strand, self.attributes = fields[0], int(fields[3]), fields[6], fields[8]
+        self.exons.append((int(fields[3]), int(fields[4])))
+
+    def bed_fields(self, transcriptId):
+        exons = sorted(self.exons, key=lambda x: x[0])
+        beg, end = exons[0][0], exons[-1][1]
+        cds, cde = self.codonStart, self.codonEnd
+        if self.strand == "-":
+            cds, cde = cde, cds
+            cds = cds - 2 if cds else cds
+            cde = cde + 2 if cde else cde
+        cds = cds or beg
+        cde = cde or end
+        return [
+            self.chrom,
+            str(beg - 1),
+            str(end),
+            transcriptId,
+            "0",
+            self.strand,
+            str(cds - 1),
+            str(cde),
+            "0",
+            str(len(exons)),
+            "".join(["%d," % (x[1] - x[0] + 1) for x in exons]),
+            "".join(["%d," % (x[0] - beg) for x in exons]),
+        ]
+
+
+class ChromosomeChunks:
+    """
+    Lines of each chromosome kept in a temporary file in the order the chromosomes are flushed, so that they can be
+    written sorted by chromosome name at the end without holding them in memory. Each line starts with two integer
+    sort keys that are dropped when it is written.
+    """
+
+    def __init__(self, tmpDir):
+        self.fout = tempfile.TemporaryFile("w+", dir=tmpDir)
+        self.chunks = {}
+
+    def add(self, chrom, lines):
+        self.chunks.setdefault(chrom, []).append((self.fout.tell(), len(lines)))
+        self.fout.write("".join(lines))
+
+    def read(self, offset, numLines):
+        self.fout.seek(offset)
+        return [self.fout.readline() for x in range(numLines)]
+
+    def write_sorted(self, fout):
+        """
+        Write the chunks sorted by chromosome name, merging the blocks of a chromosome that appears more than once
+        in the file on their sort keys.
+        """
+        self.fout.flush()
+        for chrom in sorted(self.chunks):
+            blocks = [[x.split("\t", 2) for x in self.read(*y)] for y in self.chunks[chrom]]
+            fout.write("".join([x[2] for x in heapq.merge(*blocks, key=sort_key)]))
+
+    def close(self):
+        self.fout.close()
+
+
+def sort_key(fields):
+    return int(fields[0]), int(fields[1])
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def gtf2bed(GTFFile, BedFile, tssBedFile="", geneTSSFile="", extended=False):
+    tmpDir = tempfile.mkdtemp(prefix="gtf2bed.")
+    bedChunks = ChromosomeChunks(tmpDir)
+    tssChunks = ChromosomeChunks(tmpDir) if tssBedFile else None
+    geneChunks = ChromosomeChunks(tmpDir) if geneTSSFile else None
+    flushedIds = set()
+
+    def flush(transcripts):
+        ## SORTED BY THE START OF THE FIRST EXON IN THE FILE, AS IN gtf2bed, THEN BY THE ORDER OF THE TRANSCRIPTS
+        byChrom = {}
+        for transcriptId, transcript in transcripts.items():
+            if transcript.chrom is not None:
+                byChrom.setdefault(transcript.chrom, []).append((transcript.start, transcript.order, transcriptId))
+        for chrom, keys in byChrom.items():
+            keys.sort()
+            bedLines = []
+            tssSites = set()
+            genes = {}
+            for start, order, transcriptId in keys:
+                transcript = transcripts[transcriptId]
+                fields = transcript.bed_fields(transcriptId)
+                geneId = GENE_ID.search(transcript.attributes)
+                geneName = GENE_NAME.search(transcript.attributes)
+                geneId = geneId.group(1) if geneId else transcriptId
+                geneName = geneName.group(1) if geneName else geneId
+                if extended:
+                    fields.append(geneName)
+                bedLines.append("%d\t%d\t%s\n" % (start, order, "\t".join(fields)))
+
+                ## THE SAME AS TSS_EXTRACT, WHICH TAKES THE END FOR ANY STRAND OTHER THAN "+"
+                tss = int(fields[1]) if transcript.strand == "+" else int(fields[2]) - 1
+                tssSites.add((tss, transcript.strand, transcriptId))
+                gene = genes.setdefault(geneId, [int(fields[1]), int(fields[2]), geneName, transcript.strand, 0, set()])
+                gene[0] = min(gene[0], int(fields[1]))
+                gene[1] = max(gene[1], int(fields[2]))
+                gene[4] += 1
+                gene[5].add(tss)
+            bedChunks.add(chrom, bedLines)
+
+            if tssChunks:
+                ## ONE RECORD PER POSITION AND STRAND, NAMED AFTER THE FIRST TRANSCRIPT STARTING THERE
+                sites = {}
+                for tss, strand, transcriptId in sorted(tssSites, key=lambda x: (x[0], x[1], transcripts[x[2]].order)):
+                    sites.setdefault((tss, strand), transcriptId)
+                tssChunks.add(
+                    chrom,
+                    [
+                        "%d\t0\t%s\t%d\t%d\t%s\t0\t%s\n" % (tss, chrom, tss, tss + 1, x, strand)
+                        for (tss, strand), x in sorted(sites.items())
+                    ],
+                )
+            if geneChunks:
+                geneLines = []
+                for geneId, (start, end, geneName, strand, numTranscripts, sites) in sorted(
+                    genes.items(), key=lambda x: (x[1][0], x[1][1], x[0])
+                ):
+                    tss = ",".join([str(x) for x in sorted(sites)])
+                    geneLines.append(
+                        "%d\t%d\t%s\t%d\t%d\t%s\t%s\t%s\t%d\t%s\n"
+                        % (start, end, chrom, start, end, geneId, geneName, strand, numTranscripts, tss)
+                    )
+                geneChunks.add(chrom, geneLines)
+        flushedIds.update(transcripts)
+
+    ## TRANSCRIPTS ARE FLUSHED WHEN THE FILE MOVES ON TO ANOTHER CHROMOSOME
+    transcripts = {}
+    renamedIds = {}
+    duplicateCounts = {}
+    lchrom = None
+    order = 0
+    fin = open_input(GTFFile)
+    for line in fin:
+        if line.startswith("#"):
+            continue
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) < 9 or fields[2] not in MODEL_FEATURES or not fields[0]:
+            continue
+        match = GTF_TRANSCRIPT_ID.search(fields[8]) or GFF_PARENT.search(fields[8])
+        if not match:
+            continue
+        transcriptId = match.group(1)
+
+        if fields[0] != lchrom:
+            flush(transcripts)
+            transcripts = {}
+            renamedIds = {}
+            lchrom = fields[0]
+
+        ## A TRANSCRIPT ALREADY WRITTEN FOR AN EARLIER CHROMOSOME CANNOT BE MERGED, SO IT IS WRITTEN UNDER A NEW NAME
+        if transcriptId in renamedIds:
+            transcriptId = renamedIds[transcriptId]
+        elif transcriptId in flushedIds and transcriptId not in transcripts:
+            duplicateCounts[transcriptId] = duplicateCounts.get(transcriptId, 0) + 1
+            renamedIds[transcriptId] = "{}_dup{}".format(transcriptId, duplicateCounts[transcriptId])
+            print(
+                "WARNING: Transcript {} appears again on {} after an earlier chromosome, writing it as {}.".format(
+                    transcriptId, fields[0], renamedIds[transcriptId]
+                )
+            )
+            transcriptId = renamedIds[transcriptId]
+        if transcriptId not in transcripts:
+            transcripts[transcriptId] = Transcript(order)
+            order += 1
+
+        transcript = transcripts[transcriptId]
+        if fields[2] == "start_codon":
+            transcript.codonStart = int(fields[3])
+        elif fields[2] == "stop_codon":
+            transcript.codonEnd = int(fields[4])
+        else:
+            transcript.add_exon(fields)
+    fin.close()
+    flush(transcripts)
+
+    for FileName, chunks, header in [
+        (BedFile, bedChunks, None),
+        (tssBedFile, tssChunks, None),
+        (geneTSSFile, geneChunks, GENE_TSS_HEADER),
+    ]:
+        if chunks:
+            makedir(os.path.dirname(FileName))
+            fout = open(FileName, "w")
+            if header:
+                fout.write("%s\n" % ("\t".join(header)))
+            chunks.write_sorted(fout)
+            fout.close()
+            chunks.close()
+    shutil.rmtree(tmpDir)
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    gtf2bed(args.GTF_FILE, args.BED_FILE, tssBedFile=args.TSS_BED, geneTSSFile=args.GENE_TSS, extended=args.EXTENDED)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
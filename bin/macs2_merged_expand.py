@@ -7,8 +7,17 @@
 #######################################################################
 
 import os
+import gzip
+import heapq
 import errno
+import shutil
 import argparse
+import bisect
+import tempfile
+import itertools
+import collections
+import multiprocessing
+from array import array
 
 ############################################
 ############################################
@@ -16,13 +25,16 @@ import argparse
 ############################################
 ############################################
 
-Description = "Add sample boolean files and aggregate columns from merged MACS narrow or broad peak file."
-Epilog = """Example usage: python macs2_merged_expand.py <MERGED_INTERVAL_FILE> <SAMPLE_NAME_LIST> <OUTFILE> --is_narrow_peak --min_replicates 1"""
+Description = "Merge MACS narrow or broad peak files across samples and add sample boolean files and aggregate columns."
+Epilog = """Example usage: python macs2_merged_expand.py <PEAK_FILE_LIST> <SAMPLE_NAME_LIST> <OUTFILE> --is_narrow_peak --min_replicates 1"""
 
 argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
 
 ## REQUIRED PARAMETERS
-argParser.add_argument("MERGED_INTERVAL_FILE", help="Merged MACS2 interval file created using linux sort and mergeBed.")
+argParser.add_argument(
+    "PEAK_FILE_LIST",
+    help="Comma-separated list of MACS2 broadPeak/narrowPeak files, one per sample, to merge into consensus intervals.",
+)
 argParser.add_argument(
     "SAMPLE_NAME_LIST",
     help="Comma-separated list of sample names as named in individual MACS2 broadPeak/narrowPeak output file e.g. SAMPLE_R1 for SAMPLE_R1_peak_1.",
@@ -45,6 +57,62 @@ argParser.add_argument(
     default=1,
     help="Minumum number of replicates per sample required to contribute to merged peak (default: 1).",
 )
+argParser.add_argument(
+    "-t",
+    "--threads",
+    type=int,
+    dest="THREADS",
+    default=1,
+    help="Number of processes used to sort peak files that are not already sorted and to build consensus intervals for each chromosome in parallel (default: 1).",
+)
+argParser.add_argument(
+    "-bm",
+    "--binary_matrix",
+    dest="BINARY_MATRIX",
+    help="Also write interval coordinates and per-sample boolean, fc, qval, pval (and summit) matrices to a compressed NumPy bundle named after OUTFILE with a '.npz' extension (default: False).",
+    action="store_true",
+)
+argParser.add_argument(
+    "-pc",
+    "--previous_consensus",
+    type=str,
+    dest="PREVIOUS_CONSENSUS",
+    default="",
+    help="Boolean table of a previous consensus, which may be gzip or BGZF compressed, to add the samples in PEAK_FILE_LIST to. Only the intervals the new peaks overlap are rebuilt, so --min_replicates has to be 1, and the previous ID of each interval is written to a file named after OUTFILE with an '.interval_map.txt' extension (default: '').",
+)
+argParser.add_argument(
+    "-bf",
+    "--bed_file",
+    type=str,
+    dest="BED_FILE",
+    default="",
+    help="Also write the consensus intervals in BED format to this file while the boolean table is written (default: '').",
+)
+argParser.add_argument(
+    "-sf",
+    "--saf_file",
+    type=str,
+    dest="SAF_FILE",
+    default="",
+    help="Also write the consensus intervals in SAF format for featureCounts to this file while the boolean table is written (default: '').",
+)
+argParser.add_argument(
+    "-cp",
+    "--compression",
+    type=str,
+    dest="COMPRESSION",
+    default="none",
+    choices=["none", "gzip", "bgzf"],
+    help="Compress the boolean table, BED and SAF files with gzip or BGZF and add a '.gz' extension to their names (default: 'none').",
+)
+argParser.add_argument(
+    "-sw",
+    "--summit_width",
+    type=int,
+    dest="SUMMIT_WIDTH",
+    default=0,
+    help="Instead of merging overlapping peaks, extend the summit of each narrowPeak to an interval of this width and keep the best of overlapping intervals, first within each sample by p-value and then across samples by p-value score per million, as in Corces et al. 2018 (default: 0).",
+)
 args = argParser.parse_args()
 
 ############################################
@@ -63,27 +131,779 @@ def makedir(path):
                 raise
 
 
+## BUFFER SIZE OF UNCOMPRESSED OUTPUT FILES
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+class BgzfTextFile(object):
+    ## TEXT WRITES TO A BGZF FILE FROM BIOPYTHON, WHICH IS ONLY NEEDED IF BGZF COMPRESSION IS REQUESTED
+    def __init__(self, FileName):
+        from Bio import bgzf
+
+        self.fout = bgzf.BgzfWriter(FileName, "wb")
+
+    def write(self, text):
+        self.fout.write(text.encode())
+
+    def close(self):
+        self.fout.close()
+
+
+def open_output(FileName, compression="none"):
+    ## OPEN A TEXT FILE FOR WRITING, ADDING A '.gz' EXTENSION IF IT IS COMPRESSED
+    if compression == "gzip":
+        return gzip.open(FileName + ".gz", "wt", compresslevel=6)
+    if compression == "bgzf":
+        return BgzfTextFile(FileName + ".gz")
+    return open(FileName, "w", buffering=OUTPUT_BUFFER_SIZE)
+
+
+def open_input(FileName):
+    ## BGZF FILES ARE ALSO GZIP FILES
+    if FileName.endswith(".gz"):
+        return gzip.open(FileName, "rt")
+    return open(FileName, "r")
+
+
+class ConsensusOutput(object):
+    """
+    The boolean table and, if they are requested, BED and SAF files of the consensus. The BED and SAF lines of each
+    chunk of rows are made from the first four fields of the rows as they are written, so the table does not have
+    to be read again to make them.
+    """
+
+    def __init__(self, OutFile, bedFile="", safFile="", compression="none"):
+        self.fout = open_output(OutFile, compression)
+        self.bed = open_output(bedFile, compression) if bedFile else None
+        self.saf = open_output(safFile, compression) if safFile else None
+        if self.saf:
+            self.saf.write("GeneID\tChr\tStart\tEnd\tStrand\n")
+
+    def write(self, text):
+        self.fout.write(text)
+
+    def writelines(self, lines):
+        self.fout.write("".join(lines))
+        if self.bed or self.saf:
+            intervals = [x.split("\t", 4)[:4] for x in lines]
+            if self.bed:
+                self.bed.write("".join(["%s\t%s\t%s\t%s\t0\t+\n" % tuple(x) for x in intervals]))
+            if self.saf:
+                self.saf.write("".join(["%s\t%s\t%s\t%s\t+\n" % (x[3], x[0], x[1], x[2]) for x in intervals]))
+
+    def close(self):
+        for fout in [self.fout, self.bed, self.saf]:
+            if fout:
+                fout.close()
+
+
+## MAXIMUM NUMBER OF SORTED PEAK FILES OPENED AT ONCE WHEN MERGING
+MAX_MERGE_FILES = 256
+
+
+def peak_sort_key(line):
+    ## SAME ORDER AS 'LC_ALL=C sort -k1,1 -k2,2n' WHICH FALLS BACK TO COMPARING WHOLE LINES
+    fields = line.split("\t", 2)
+    return (fields[0], int(fields[1]), line)
+
+
+def iter_peak_file(PeakFile, start=0, end=None):
+    ## YIELD (CHROM, START, LINE) AND THE BYTE OFFSET AFTER EACH PEAK FROM THE START UP TO THE END OFFSET
+    with open(PeakFile, "rb") as fin:
+        fin.seek(start)
+        offset = start
+        while end is None or offset < end:
+            line = fin.readline()
+            if not line:
+                break
+            offset += len(line)
+            line = line.decode().rstrip("\n")
+            if line:
+                yield peak_sort_key(line), offset
+
+
+def index_peaks(keys):
+    """
+    Consume (key, offset) pairs of a sorted peak file and return the byte offsets of the first and after the
+    last peak of each chromosome, or None if the peaks are not sorted.
+    """
+    chromOffsets = collections.OrderedDict()
+    prevKey = None
+    prevOffset = 0
+    for key, offset in keys:
+        if prevKey is not None and key < prevKey:
+            return None
+        if prevKey is None or key[0] != prevKey[0]:
+            chromOffsets[key[0]] = [prevOffset, offset]
+        chromOffsets[key[0]][1] = offset
+        prevKey = key
+        prevOffset = offset
+    return chromOffsets
+
+
+def write_peaks(keys, PeakFile):
+    ## WRITE SORTED (CHROM, START, LINE) KEYS AND YIELD THEM BACK WITH THE BYTE OFFSET AFTER EACH LINE
+    with open(PeakFile, "wb") as fout:
+        offset = 0
+        for key in keys:
+            line = (key[2] + "\n").encode()
+            fout.write(line)
+            offset += len(line)
+            yield key, offset
+
+
+def sort_peak_file(PeakFile, tmpDir):
+    """
+    Return PeakFile and the byte offsets of each chromosome in it if it is already sorted, otherwise write a
+    sorted copy to tmpDir and return that instead. Only one peak file is held in memory at a time.
+    """
+    chromOffsets = index_peaks(iter_peak_file(PeakFile))
+    if chromOffsets is not None:
+        return PeakFile, chromOffsets
+
+    fd, SortedFile = tempfile.mkstemp(prefix=os.path.basename(PeakFile) + ".", suffix=".sorted", dir=tmpDir)
+    os.close(fd)
+    keys = sorted([x[0] for x in iter_peak_file(PeakFile)])
+    return SortedFile, index_peaks(write_peaks(keys, SortedFile))
+
+
+def sort_peak_file_star(args):
+    return sort_peak_file(*args)
+
+
+def reduce_peak_files(SortedFiles, tmpDir):
+    ## MERGE SORTED PEAK FILES A BATCH AT A TIME INTO tmpDir UNTIL THERE ARE NO MORE THAN MAX_MERGE_FILES
+    while len(SortedFiles) > MAX_MERGE_FILES:
+        batch, SortedFiles = SortedFiles[:MAX_MERGE_FILES], SortedFiles[MAX_MERGE_FILES:]
+        fd, MergedFile = tempfile.mkstemp(suffix=".merged", dir=tmpDir)
+        os.close(fd)
+        keys = heapq.merge(*[(x[0] for x in iter_peak_file(y[0])) for y in batch])
+        SortedFiles.append((MergedFile, index_peaks(write_peaks(keys, MergedFile))))
+    return SortedFiles
+
+
+def merge_peak_files(SortedFiles, chrom=None):
+    """
+    Yield (chrom, start, line) for every peak across the SortedFiles, or only those on chrom, in the order of a
+    global sort with a k-way heap merge.
+    """
+    peakIters = []
+    for PeakFile, chromOffsets in SortedFiles:
+        if chrom is None:
+            peakIters.append(x[0] for x in iter_peak_file(PeakFile))
+        elif chrom in chromOffsets:
+            peakIters.append(x[0] for x in iter_peak_file(PeakFile, *chromOffsets[chrom]))
+    return heapq.merge(*peakIters)
+
+
+def merge_peaks(sortedPeaks):
+    """
+    Merge overlapping and book-ended peaks as with mergeBed, yielding the chromosome, start and end of each
+    merged interval with the fields of the peaks it contains in sorted order.
+    """
+    peaks = []
+    for chrom, start, line in sortedPeaks:
+        fields = line.split("\t")
+        end = int(fields[2])
+        if peaks and chrom == mchrom and start <= mend:
+            mend = max(mend, end)
+            peaks.append(fields)
+        else:
+            if peaks:
+                yield mchrom, mstart, mend, peaks
+            mchrom, mstart, mend, peaks = chrom, start, end, [fields]
+    if peaks:
+        yield mchrom, mstart, mend, peaks
+
+
+def remove_overlaps(order, chromIds, starts, width):
+    """
+    Return the intervals in order, best first, that do not overlap a better interval kept before them. All intervals
+    have the same width so kept starts are indexed in buckets of that width and only the neighbouring buckets of an
+    interval have to be checked.
+    """
+    buckets = {}
+    kept = []
+    for idx in order:
+        chromId, start = chromIds[idx], starts[idx]
+        bucket = start // width
+        overlaps = False
+        for key in [(chromId, bucket - 1), (chromId, bucket), (chromId, bucket + 1)]:
+            if any([abs(x - start) < width for x in buckets.get(key, [])]):
+                overlaps = True
+                break
+        if not overlaps:
+            buckets.setdefault((chromId, bucket), []).append(start)
+            kept.append(idx)
+    return kept
+
+
+def summit_peaks(sortedPeaks, width):
+    """
+    Yield the chromosome, start and end of fixed-width intervals centred on narrowPeak summits that are kept by
+    iterative overlap removal, with the fields of every peak whose summit interval overlaps it in sorted order.
+    Overlaps are removed within each sample by the p-value score of the peaks, then across samples by the
+    p-value score divided by the sum of the scores kept in the sample, per million.
+    """
+    chroms = []
+    chromIndex = {}
+    sampleIndex = {}
+    peaks = []
+    chromIds = array("l")
+    starts = array("q")
+    sampleIds = array("l")
+    scores = array("d")
+    for chrom, start, line in sortedPeaks:
+        fields = line.split("\t")
+        if chrom not in chromIndex:
+            chromIndex[chrom] = len(chroms)
+            chroms.append(chrom)
+        peaks.append(fields)
+        chromIds.append(chromIndex[chrom])
+        starts.append(max(start + int(fields[9]) - width // 2, 0))
+        sampleIds.append(sampleIndex.setdefault(peak_sample_name(fields[3]), len(sampleIndex)))
+        scores.append(float(fields[7]))
+
+    ## TIES ARE BROKEN BY THE ORDER OF THE PEAKS IN THE GLOBAL SORT
+    kept = []
+    order = sorted(range(len(peaks)), key=lambda x: (sampleIds[x], -scores[x], x))
+    for sampleId, group in itertools.groupby(order, key=lambda x: sampleIds[x]):
+        kept += remove_overlaps(group, chromIds, starts, width)
+    totals = collections.Counter()
+    for idx in kept:
+        totals[sampleIds[idx]] += scores[idx]
+    spm = dict([(x, scores[x] / totals[sampleIds[x]] * 1e6 if totals[sampleIds[x]] else 0) for x in kept])
+    kept = remove_overlaps(sorted(kept, key=lambda x: (-spm[x], x)), chromIds, starts, width)
+
+    ## ALL SUMMIT INTERVALS OF EACH CHROMOSOME BY START TO FIND THOSE OVERLAPPING EACH KEPT INTERVAL
+    chromStarts = collections.defaultdict(list)
+    for idx in sorted(range(len(peaks)), key=lambda x: (chromIds[x], starts[x], x)):
+        chromStarts[chromIds[idx]].append((starts[idx], idx))
+    for idx in sorted(kept, key=lambda x: (chroms[chromIds[x]], starts[x], x)):
+        chromId, start = chromIds[idx], starts[idx]
+        intervals = chromStarts[chromId]
+        first = bisect.bisect_right(intervals, (start - width, len(peaks)))
+        last = bisect.bisect_left(intervals, (start + width, -1))
+        members = sorted([x[1] for x in intervals[first:last]])
+        yield chroms[chromId], start, start + width, [peaks[x] for x in members]
+
+
+def peak_sample_name(peakName):
+    ## SAME AS "_".join(peakName.split("_")[:-2]) e.g. SAMPLE_R1 FOR SAMPLE_R1_peak_1
+    fields = peakName.rsplit("_", 2)
+    return fields[0] if len(fields) == 3 else ""
+
+
+class ConsensusSamples(object):
+    """
+    Samples named in the peaks, each with an index, its replicate group made by removing the trailing *_R* and its
+    bit in the sample membership masks. Samples in the sample name list use their output column as the bit and any
+    others are given the bits after them in the order they are first seen. Sample names are worked out once for each
+    sample rather than for every peak of every merged interval.
+    """
+
+    def __init__(self, SampleNameList):
+        self.sampleColumns = dict([(x, idx) for idx, x in enumerate(SampleNameList)])
+        self.sampleIndex = {}
+        self.groupIndex = {}
+        self.names = []
+        self.groups = []
+        self.bits = []
+        self.extras = []
+
+    def index(self, peakName):
+        sID = peak_sample_name(peakName)
+        idx = self.sampleIndex.get(sID)
+        if idx is None:
+            idx = self.sampleIndex[sID] = len(self.names)
+            gID = "_".join(sID.split("_")[:-1])
+            self.names.append(sID)
+            self.groups.append(self.groupIndex.setdefault(gID, len(self.groupIndex)))
+            bit = self.sampleColumns.get(sID)
+            if bit is None:
+                bit = len(self.sampleColumns) + len(self.extras)
+                self.extras.append(sID)
+            self.bits.append(bit)
+        return idx
+
+
+def mask_bits(mask):
+    ## SET BITS OF A SAMPLE MEMBERSHIP MASK FROM LOWEST TO HIGHEST
+    bits = []
+    while mask:
+        low = mask & -mask
+        bits.append(low.bit_length() - 1)
+        mask ^= low
+    return bits
+
+
+def merge_comb_counts(combCounts, extras, chromCombCounts, chromExtras, numSamples):
+    """
+    Add the interval counts of each sample membership mask of a worker to combCounts. Bits of samples that are not
+    in the sample name list are moved to where those samples are in extras, which is extended with any new ones.
+    """
+    bitMap = {}
+    for idx, sID in enumerate(chromExtras):
+        if sID not in extras:
+            extras.append(sID)
+        bitMap[numSamples + idx] = numSamples + extras.index(sID)
+    remap = any([x != y for x, y in bitMap.items()])
+    columnMask = (1 << numSamples) - 1
+    for mask, count in chromCombCounts.items():
+        if remap and mask > columnMask:
+            extraMask = mask & ~columnMask
+            mask &= columnMask
+            for bit in mask_bits(extraMask):
+                mask |= 1 << bitMap[bit]
+        combCounts[mask] += count
+
+
+class ConsensusMatrix(object):
+    """
+    Interval coordinates and the sample cells of the consensus as numbers, collected as sparse (row, column) entries
+    while the rows are written. Where a sample has more than one peak in an interval the maximum fc, qval and pval
+    and the summit of the first peak are kept. Saved as dense matrices with NaN, or -1 for summits, where a sample
+    has no peaks.
+    """
+
+    def __init__(self):
+        self.chroms = []
+        self.chromIndex = {}
+        self.intervalChroms = array("l")
+        self.starts = array("q")
+        self.ends = array("q")
+        self.rows = array("q")
+        self.columns = array("l")
+        self.fc = array("d")
+        self.qval = array("d")
+        self.pval = array("d")
+        self.summit = array("q")
+
+    def add(self, chrom, start, end, columns, columnPeaks):
+        row = len(self.starts)
+        self.intervalChroms.append(self.chromIndex.setdefault(chrom, len(self.chromIndex)))
+        if len(self.chromIndex) > len(self.chroms):
+            self.chroms.append(chrom)
+        self.starts.append(int(start))
+        self.ends.append(int(end))
+        for column in columns:
+            peaks = columnPeaks[column]
+            self.rows.append(row)
+            self.columns.append(column)
+            self.fc.append(max([float(x[6]) for x in peaks]))
+            self.pval.append(max([float(x[7]) for x in peaks]))
+            self.qval.append(max([float(x[8]) for x in peaks]))
+            self.summit.append(int(peaks[0][9]) if len(peaks[0]) > 9 else -1)
+
+    def extend(self, other):
+        ## APPEND THE INTERVALS OF ANOTHER MATRIX, E.G. ONE BUILT FOR A CHROMOSOME IN A WORKER
+        rowOffset = len(self.starts)
+        for chrom in other.chroms:
+            if chrom not in self.chromIndex:
+                self.chromIndex[chrom] = len(self.chroms)
+                self.chroms.append(chrom)
+        self.intervalChroms.extend([self.chromIndex[other.chroms[x]] for x in other.intervalChroms])
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+        self.rows.extend([x + rowOffset for x in other.rows])
+        for field in ["columns", "fc", "qval", "pval", "summit"]:
+            getattr(self, field).extend(getattr(other, field))
+
+    def save(self, MatrixFile, SampleNameList, isNarrow=False):
+        import numpy as np
+
+        shape = (len(self.starts), len(SampleNameList))
+        rows = np.frombuffer(self.rows, dtype=np.int64)
+        columns = np.frombuffer(self.columns, dtype=np.dtype("l"))
+        arrays = {
+            "chroms": np.array(self.chroms, dtype=str),
+            "chrom": np.frombuffer(self.intervalChroms, dtype=np.dtype("l")).astype(np.int32),
+            "start": np.frombuffer(self.starts, dtype=np.int64),
+            "end": np.frombuffer(self.ends, dtype=np.int64),
+            "interval_id": np.array(["Interval_" + str(x + 1) for x in range(shape[0])], dtype=str),
+            "samples": np.array(SampleNameList, dtype=str),
+            "bool": np.zeros(shape, dtype=bool),
+        }
+        arrays["bool"][rows, columns] = True
+        for field in ["fc", "qval", "pval"]:
+            arrays[field] = np.full(shape, np.nan, dtype=np.float32)
+            arrays[field][rows, columns] = np.frombuffer(getattr(self, field), dtype=np.float64)
+        if isNarrow:
+            arrays["summit"] = np.full(shape, -1, dtype=np.int64)
+            arrays["summit"][rows, columns] = np.frombuffer(self.summit, dtype=np.int64)
+        np.savez_compressed(MatrixFile, **arrays)
+
+
+## NUMBER OF MERGED INTERVALS HELD IN MEMORY BEFORE THEY ARE WRITTEN
+WRITE_CHUNK_SIZE = 1000
+
+
+class ConsensusWriter(object):
+    """
+    Write merged intervals in chunks. Each row is assembled column block by column block from the samples set in
+    the sample membership mask of the interval, in sample column order, with the runs of "FALSE" and "NA" cells of
+    the samples in between taken from a cache. The work per interval then depends on the number of peaks rather
+    than samples.
+    """
+
+    def __init__(self, fout, numSamples, isNarrow=False, matrix=None):
+        self.fout = fout
+        self.matrix = matrix
+        self.numSamples = numSamples
+        self.columnMask = (1 << numSamples) - 1
+        ## FC, QVAL, PVAL, START AND END (AND SUMMIT) COLUMNS OF EACH SAMPLE AS NARROWPEAK FIELD INDICES
+        self.valueFields = [6, 8, 7, 1, 2] + ([9] if isNarrow else [])
+        self.valueFormats = [float, float, float, int, int, int]
+        self.runs = {"FALSE\t": {}, "NA\t": {}}
+        self.lines = []
+
+    def run(self, cell, length):
+        cache = self.runs[cell]
+        if length not in cache:
+            cache[length] = cell * length
+        return cache[length]
+
+    def add(self, fixedFields, mask, columnPeaks):
+        ## THE BOOLEAN AND VALUE CELLS OF A SAMPLE ARE FILLED IN WHERE ITS COLUMN BIT IS SET IN THE MASK
+        columns = mask_bits(mask & self.columnMask)
+        if self.matrix is not None:
+            self.matrix.add(fixedFields[0], fixedFields[1], fixedFields[2], columns, columnPeaks)
+        blocks = [["TRUE"] * len(columns)]
+        for field, fmt in zip(self.valueFields, self.valueFormats):
+            blocks.append([";".join([str(fmt(x[field])) for x in columnPeaks[column]]) for column in columns])
+
+        parts = ["\t".join(fixedFields), "\t"]
+        for cells, emptyCell in zip(blocks, ["FALSE\t"] + ["NA\t"] * (len(blocks) - 1)):
+            prevColumn = 0
+            for column, cell in zip(columns, cells):
+                parts += [self.run(emptyCell, column - prevColumn), cell, "\t"]
+                prevColumn = column + 1
+            parts.append(self.run(emptyCell, self.numSamples - prevColumn))
+        ## EVERY CELL IS FOLLOWED BY A TAB SO REPLACE THE LAST ONE WITH A NEW LINE
+        self.write("".join(parts)[:-1] + "\n")
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) == WRITE_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.fout.writelines(self.lines)
+        self.lines = []
+
+
+def sample_membership(samples, peaks, minReplicates=1):
+    """
+    Return the sample membership mask of a merged interval and the peaks of each sample keyed by its bit, for the
+    samples that pass the replicate threshold, or None if there are none.
+    """
+    ## PEAK INDICES FOR EACH SAMPLE IN THE ORDER THE SAMPLES ARE FIRST SEEN
+    samplePeaks = collections.OrderedDict()
+    for idx, peak in enumerate(peaks):
+        samplePeaks.setdefault(samples.index(peak[3]), []).append(idx)
+
+    ## GET SAMPLES THAT PASS REPLICATE THRESHOLD
+    passSamples = list(samplePeaks)
+    if minReplicates > 1:
+        groupCounts = collections.Counter([samples.groups[x] for x in passSamples])
+        passSamples = [x for x in passSamples if groupCounts[samples.groups[x]] >= minReplicates]
+    if not passSamples:
+        return None
+
+    mask = 0
+    columnPeaks = {}
+    for x in passSamples:
+        mask |= 1 << samples.bits[x]
+        columnPeaks[samples.bits[x]] = [peaks[idx] for idx in samplePeaks[x]]
+    return mask, columnPeaks
+
+
+def expand_merged_peaks(
+    sortedPeaks,
+    SampleNameList,
+    fout,
+    isNarrow=False,
+    minReplicates=1,
+    firstInterval=None,
+    matrix=None,
+    summitWidth=0,
+):
+    """
+    Write a row to fout for each merged interval of sortedPeaks, or each summit interval if summitWidth is given,
+    with samples that pass the replicate threshold, and add it to matrix if one is given. Intervals are numbered from firstInterval, or the interval_id column is
+    left out if it is None so it can be added when the rows of each chromosome are concatenated. Returns the number
+    of rows written, the number of intervals for each sample membership mask and the names of the samples given
+    bits after the sample name list.
+    """
+    combCounts = collections.Counter()
+    masks = []
+    numIntervals = 0
+    samples = ConsensusSamples(SampleNameList)
+    writer = ConsensusWriter(fout, len(SampleNameList), isNarrow=isNarrow, matrix=matrix)
+    intervals = summit_peaks(sortedPeaks, summitWidth) if summitWidth else merge_peaks(sortedPeaks)
+    for chromID, mstart, mend, peaks in intervals:
+        membership = sample_membership(samples, peaks, minReplicates)
+        if membership is None:
+            continue
+
+        mask, columnPeaks = membership
+        fixedFields = [chromID, str(mstart), str(mend)]
+        if firstInterval is not None:
+            fixedFields.append("Interval_" + str(firstInterval + numIntervals))
+        writer.add(fixedFields + [str(len(peaks)), str(len(columnPeaks))], mask, columnPeaks)
+
+        ## COUNT THE MASKS A CHUNK AT A TIME RATHER THAN LOOKING EACH ONE UP AS IT IS MADE
+        masks.append(mask)
+        if len(masks) == WRITE_CHUNK_SIZE:
+            combCounts.update(masks)
+            masks = []
+        numIntervals += 1
+
+    combCounts.update(masks)
+    writer.flush()
+    return numIntervals, combCounts, samples.extras
+
+
+def expand_chromosome(args):
+    ## BUILD THE ROWS OF ONE CHROMOSOME IN A TEMPORARY FILE, WITHOUT INTERVAL IDS, IN A WORKER PROCESS
+    chrom, SortedFiles, SampleNameList, isNarrow, minReplicates, tmpDir, binaryMatrix = args
+    matrix = ConsensusMatrix() if binaryMatrix else None
+    fd, ChromFile = tempfile.mkstemp(suffix=".rows", dir=tmpDir)
+    with os.fdopen(fd, "w") as fout:
+        numIntervals, combCounts, extras = expand_merged_peaks(
+            merge_peak_files(SortedFiles, chrom),
+            SampleNameList,
+            fout,
+            isNarrow=isNarrow,
+            minReplicates=minReplicates,
+            matrix=matrix,
+        )
+    return ChromFile, numIntervals, combCounts, extras, matrix
+
+
+def read_consensus_header(ConsensusFile):
+    ## SAMPLE NAMES OF A PREVIOUS CONSENSUS TABLE AND WHETHER IT WAS BUILT FROM NARROW PEAKS
+    with open_input(ConsensusFile) as fin:
+        header = fin.readline().rstrip("\n").split("\t")
+    return [x[:-5] for x in header if x.endswith(".bool")], any([x.endswith(".summit") for x in header])
+
+
+class ConsensusRows(object):
+    """
+    Rows of a previous consensus table laid out again for a sample name list with samples added to it. The cells of
+    each column block are copied a slice of old samples at a time with "FALSE" or "NA" cells for the added samples
+    in between, and the peaks of each old sample can be rebuilt from its cells to merge them with new peaks.
+    """
+
+    def __init__(self, oldNames, SampleNameList, isNarrow=False):
+        self.oldNames = oldNames
+        self.numOld = len(oldNames)
+        self.numBlocks = 7 if isNarrow else 6
+        self.isNarrow = isNarrow
+        newColumns = dict([(x, idx) for idx, x in enumerate(SampleNameList)])
+        self.columns = [newColumns[x] for x in oldNames]
+
+        ## [FIRST, LAST] OLD CELLS COPIED AND THE NUMBER OF ADDED SAMPLE CELLS AFTER THEM
+        oldColumns = dict([(x, idx) for idx, x in enumerate(oldNames)])
+        self.segments = [[0, 0, 0]]
+        for sID in SampleNameList:
+            idx = oldColumns.get(sID)
+            if idx is None:
+                self.segments[-1][2] += 1
+            elif self.segments[-1][2] == 0 and self.segments[-1][1] == idx:
+                self.segments[-1][1] = idx + 1
+            else:
+                self.segments.append([idx, idx + 1, 0])
+
+    def cells(self, fields):
+        cells = fields[6:]
+        parts = []
+        for block in range(self.numBlocks):
+            offset = block * self.numOld
+            emptyCell = "FALSE" if block == 0 else "NA"
+            for first, last, numAdded in self.segments:
+                parts += cells[offset + first : offset + last] + [emptyCell] * numAdded
+        return parts
+
+    def mask(self, fields):
+        mask = 0
+        for idx, cell in enumerate(fields[6 : 6 + self.numOld]):
+            if cell == "TRUE":
+                mask |= 1 << self.columns[idx]
+        return mask
+
+    def peaks(self, fields):
+        ## PEAK FIELDS OF EACH OLD SAMPLE IN THE ROW KEYED BY ITS NEW COLUMN, IN THE SAME LAYOUT AS A NARROWPEAK LINE
+        cells = fields[6:]
+        columnPeaks = collections.OrderedDict()
+        for idx in range(self.numOld):
+            if cells[idx] != "TRUE":
+                continue
+            fc, qval, pval, starts, ends = [cells[x * self.numOld + idx].split(";") for x in range(1, 6)]
+            summits = cells[6 * self.numOld + idx].split(";") if self.isNarrow else []
+            columnPeaks[self.columns[idx]] = [
+                [fields[0], starts[x], ends[x], "%s_peak_%d" % (self.oldNames[idx], x + 1), ".", ".", fc[x], pval[x]]
+                + [qval[x]]
+                + summits[x : x + 1]
+                for x in range(len(starts))
+            ]
+        return columnPeaks
+
+
+def cluster_consensus_rows(oldRows, sortedPeaks):
+    """
+    Sweep the rows of a previous consensus table and sorted new peaks together, yielding the chromosome, start and
+    end of each group of overlapping or book-ended rows and peaks with the rows and peak keys in it.
+    """
+    items = heapq.merge(
+        ((x[0], int(x[1]), int(x[2]), x, None) for x in oldRows),
+        ((x[0], x[1], int(x[2].split("\t", 3)[2]), None, x) for x in sortedPeaks),
+        key=lambda x: x[:2],
+    )
+    rows, keys = [], []
+    for chrom, start, end, row, key in items:
+        if (rows or keys) and chrom == cchrom and start <= cend:
+            cend = max(cend, end)
+        else:
+            if rows or keys:
+                yield cchrom, cstart, cend, rows, keys
+            cchrom, cstart, cend, rows, keys = chrom, start, end, [], []
+        if row is not None:
+            rows.append(row)
+        else:
+            keys.append(key)
+    if rows or keys:
+        yield cchrom, cstart, cend, rows, keys
+
+
+def update_merged_peaks(
+    ConsensusFile, sortedPeaks, SampleNameList, fout, fmap, isNarrow=False, minReplicates=1, matrix=None
+):
+    """
+    Write the rows of a previous consensus table updated with sortedPeaks of added samples to fout and the interval
+    ID each previous one has in the update to fmap. Rows that no new peak overlaps or book-ends are copied with
+    cells added for the new samples. Rows that do are rebuilt together with the new peaks, fusing rows that a new
+    peak bridges, and new peaks away from any row make new intervals. Returns the same as expand_merged_peaks.
+    """
+    oldNames, _ = read_consensus_header(ConsensusFile)
+    rows = ConsensusRows(oldNames, SampleNameList, isNarrow=isNarrow)
+    combCounts = collections.Counter()
+    masks = []
+    numIntervals = 0
+    samples = ConsensusSamples(SampleNameList)
+    writer = ConsensusWriter(fout, len(SampleNameList), isNarrow=isNarrow, matrix=matrix)
+    fin = open_input(ConsensusFile)
+    fin.readline()
+    oldRows = (line.rstrip("\n").split("\t") for line in fin)
+    for chromID, mstart, mend, clusterRows, keys in cluster_consensus_rows(oldRows, sortedPeaks):
+        intervalID = "Interval_" + str(numIntervals + 1)
+        if len(clusterRows) == 1 and not keys:
+            fields = clusterRows[0]
+            mask = rows.mask(fields)
+            writer.write("\t".join(fields[:3] + [intervalID] + fields[4:6] + rows.cells(fields)) + "\n")
+            if matrix is not None:
+                columnPeaks = rows.peaks(fields)
+                matrix.add(chromID, mstart, mend, sorted(columnPeaks), columnPeaks)
+        else:
+            ## PEAKS OF SAMPLES THAT FAILED THE REPLICATE THRESHOLD BEFORE ARE NOT IN THE ROWS BUT STILL COUNTED
+            numPeaks = sum([int(x[4]) for x in clusterRows]) + len(keys)
+            for fields in clusterRows:
+                for peaks in rows.peaks(fields).values():
+                    keys.extend([peak_sort_key("\t".join(x)) for x in peaks])
+            ## PEAKS OF A SAMPLE ALL COME FROM THE OLD ROWS OR THE NEW PEAKS SO A STABLE SORT ON THE START KEEPS THEIR ORDER
+            peaks = [x[2].split("\t") for x in sorted(keys, key=lambda x: x[:2])]
+            membership = sample_membership(samples, peaks, minReplicates)
+            if membership is None:
+                for fields in clusterRows:
+                    fmap.write(fields[3] + "\tNA\n")
+                continue
+
+            mask, columnPeaks = membership
+            fixedFields = [chromID, str(mstart), str(mend), intervalID, str(numPeaks), str(len(columnPeaks))]
+            writer.add(fixedFields, mask, columnPeaks)
+
+        for fields in clusterRows:
+            fmap.write(fields[3] + "\t" + intervalID + "\n")
+        masks.append(mask)
+        if len(masks) == WRITE_CHUNK_SIZE:
+            combCounts.update(masks)
+            masks = []
+        numIntervals += 1
+
+    fin.close()
+    combCounts.update(masks)
+    writer.flush()
+    return numIntervals, combCounts, samples.extras
+
+
 ############################################
 ############################################
 ## MAIN FUNCTION
 ############################################
 ############################################
 
-## MergedIntervalTxtFile is file created using commands below:
-## 1) broadPeak
-## sort -k1,1 -k2,2n <MACS_BROADPEAK_FILES_LIST> | mergeBed -c 2,3,4,5,6,7,8,9 -o collapse,collapse,collapse,collapse,collapse,collapse,collapse,collapse > merged_peaks.txt
-## 2) narrowPeak
-## sort -k1,1 -k2,2n <MACS_NARROWPEAK_FILE_LIST> | mergeBed -c 2,3,4,5,6,7,8,9,10 -o collapse,collapse,collapse,collapse,collapse,collapse,collapse,collapse,collapse > merged_peaks.txt
 
+def macs2_merged_expand(
+    PeakFileList,
+    SampleNameList,
+    OutFile,
+    isNarrow=False,
+    minReplicates=1,
+    threads=1,
+    binaryMatrix=False,
+    previousConsensus=None,
+    bedFile="",
+    safFile="",
+    compression="none",
+    summitWidth=0,
+):
+    if summitWidth and not isNarrow:
+        raise ValueError("Summit intervals can only be made from narrowPeak files.")
+    if summitWidth and previousConsensus:
+        raise ValueError("Summit intervals cannot be added to a previous consensus.")
+    ## PEAKS BELOW --min_replicates ARE NOT IN THE TABLE, SO A NEW REPLICATE COULD NOT BRING THEM BACK
+    if minReplicates > 1 and previousConsensus:
+        raise ValueError("Samples can only be added to a previous consensus with a --min_replicates of 1.")
+
+    ## ADDED SAMPLES ARE MERGED INTO THE PREVIOUS CONSENSUS WITH THEIR COLUMNS IN SAMPLE NAME ORDER AMONG THE OLD ONES
+    if previousConsensus:
+        oldNames, oldIsNarrow = read_consensus_header(previousConsensus)
+        if oldIsNarrow != isNarrow:
+            raise ValueError(
+                "Previous consensus '%s' was built from %s peaks."
+                % (previousConsensus, "narrow" if oldIsNarrow else "broad")
+            )
+        addedNames = set(oldNames) & set(SampleNameList)
+        if addedNames:
+            raise ValueError(
+                "Samples already in previous consensus '%s': %s" % (previousConsensus, ",".join(sorted(addedNames)))
+            )
+        SampleNameList = oldNames + SampleNameList
 
-def macs2_merged_expand(MergedIntervalTxtFile, SampleNameList, OutFile, isNarrow=False, minReplicates=1):
     makedir(os.path.dirname(OutFile))
+    tmpDir = tempfile.mkdtemp(prefix="macs2_merged_expand.", dir=os.path.dirname(OutFile) or ".")
+    pool = multiprocessing.get_context("fork").Pool(processes=threads) if threads > 1 else None
+
+    ## SORT EACH PEAK FILE ON ITS OWN, IN PARALLEL IF REQUESTED, RATHER THAN SORTING THEM ALL TOGETHER
+    tasks = [(x, tmpDir) for x in PeakFileList]
+    if pool:
+        SortedFileList = pool.map(sort_peak_file_star, tasks, chunksize=1)
+    else:
+        SortedFileList = [sort_peak_file_star(x) for x in tasks]
+    SortedFileList = reduce_peak_files(SortedFileList, tmpDir)
 
-    combFreqDict = {}
+    ## SCORES OF SUMMIT INTERVALS ARE NORMALISED ACROSS CHROMOSOMES SO ONLY MERGED INTERVALS ARE BUILT IN PARALLEL
+    if pool and (previousConsensus or summitWidth):
+        pool.close()
+        pool.join()
+        pool = None
+
+    combCounts = collections.Counter()
+    extras = []
+    matrix = ConsensusMatrix() if binaryMatrix else None
     totalOutIntervals = 0
     SampleNameList = sorted(SampleNameList)
-    fin = open(MergedIntervalTxtFile, "r")
-    fout = open(OutFile, "w")
+    fout = ConsensusOutput(OutFile, bedFile=bedFile, safFile=safFile, compression=compression)
     oFields = (
         ["chr", "start", "end", "interval_id", "num_peaks", "num_samples"]
         + [x + ".bool" for x in SampleNameList]
@@ -96,107 +916,75 @@ def macs2_merged_expand(MergedIntervalTxtFile, SampleNameList, OutFile, isNarrow
     if isNarrow:
         oFields += [x + ".summit" for x in SampleNameList]
     fout.write("\t".join(oFields) + "\n")
-    while True:
-        line = fin.readline()
-        if line:
-            lspl = line.strip().split("\t")
-
-            chromID = lspl[0]
-            mstart = int(lspl[1])
-            mend = int(lspl[2])
-            starts = [int(x) for x in lspl[3].split(",")]
-            ends = [int(x) for x in lspl[4].split(",")]
-            names = lspl[5].split(",")
-            fcs = [float(x) for x in lspl[8].split(",")]
-            pvals = [float(x) for x in lspl[9].split(",")]
-            qvals = [float(x) for x in lspl[10].split(",")]
-            summits = []
-            if isNarrow:
-                summits = [int(x) for x in lspl[11].split(",")]
-
-            ## GROUP SAMPLES BY REMOVING TRAILING *_R*
-            groupDict = {}
-            for sID in ["_".join(x.split("_")[:-2]) for x in names]:
-                gID = "_".join(sID.split("_")[:-1])
-                if gID not in groupDict:
-                    groupDict[gID] = []
-                if sID not in groupDict[gID]:
-                    groupDict[gID].append(sID)
-
-            ## GET SAMPLES THAT PASS REPLICATE THRESHOLD
-            passRepThreshList = []
-            for gID, sIDs in groupDict.items():
-                if len(sIDs) >= minReplicates:
-                    passRepThreshList += sIDs
-
-            ## GET VALUES FROM INDIVIDUAL PEAK SETS
-            fcDict = {}
-            qvalDict = {}
-            pvalDict = {}
-            startDict = {}
-            endDict = {}
-            summitDict = {}
-            for idx in range(len(names)):
-                sample = "_".join(names[idx].split("_")[:-2])
-                if sample in passRepThreshList:
-                    if sample not in fcDict:
-                        fcDict[sample] = []
-                    fcDict[sample].append(str(fcs[idx]))
-                    if sample not in qvalDict:
-                        qvalDict[sample] = []
-                    qvalDict[sample].append(str(qvals[idx]))
-                    if sample not in pvalDict:
-                        pvalDict[sample] = []
-                    pvalDict[sample].append(str(pvals[idx]))
-                    if sample not in startDict:
-                        startDict[sample] = []
-                    startDict[sample].append(str(starts[idx]))
-                    if sample not in endDict:
-                        endDict[sample] = []
-                    endDict[sample].append(str(ends[idx]))
-                    if isNarrow:
-                        if sample not in summitDict:
-                            summitDict[sample] = []
-                        summitDict[sample].append(str(summits[idx]))
-
-            samples = sorted(fcDict.keys())
-            if samples != []:
-                numSamples = len(samples)
-                boolList = ["TRUE" if x in samples else "FALSE" for x in SampleNameList]
-                fcList = [";".join(fcDict[x]) if x in samples else "NA" for x in SampleNameList]
-                qvalList = [";".join(qvalDict[x]) if x in samples else "NA" for x in SampleNameList]
-                pvalList = [";".join(pvalDict[x]) if x in samples else "NA" for x in SampleNameList]
-                startList = [";".join(startDict[x]) if x in samples else "NA" for x in SampleNameList]
-                endList = [";".join(endDict[x]) if x in samples else "NA" for x in SampleNameList]
-                oList = [
-                    str(x)
-                    for x in [chromID, mstart, mend, "Interval_" + str(totalOutIntervals + 1), len(names), numSamples]
-                    + boolList
-                    + fcList
-                    + qvalList
-                    + pvalList
-                    + startList
-                    + endList
-                ]
-                if isNarrow:
-                    oList += [";".join(summitDict[x]) if x in samples else "NA" for x in SampleNameList]
-                fout.write("\t".join(oList) + "\n")
-
-                tsamples = tuple(sorted(samples))
-                if tsamples not in combFreqDict:
-                    combFreqDict[tsamples] = 0
-                combFreqDict[tsamples] += 1
-                totalOutIntervals += 1
 
-        else:
-            fin.close()
-            fout.close()
-            break
+    if previousConsensus:
+        with open(OutFile[:-4] + ".interval_map.txt", "w") as fmap:
+            fmap.write("previous_interval_id\tinterval_id\n")
+            totalOutIntervals, combCounts, extras = update_merged_peaks(
+                previousConsensus,
+                merge_peak_files(SortedFileList),
+                SampleNameList,
+                fout,
+                fmap,
+                isNarrow=isNarrow,
+                minReplicates=minReplicates,
+                matrix=matrix,
+            )
+    elif pool:
+        ## MERGED INTERVALS NEVER SPAN CHROMOSOMES SO BUILD EACH ONE IN A WORKER. ROWS ARE CONCATENATED IN THE SAME
+        ## CHROMOSOME ORDER AS A GLOBAL SORT WITH INTERVAL IDS NUMBERED ACROSS THEM
+        chroms = sorted(set([chrom for x in SortedFileList for chrom in x[1]]))
+        tasks = [
+            (chrom, [(x[0], {chrom: x[1][chrom]}) for x in SortedFileList if chrom in x[1]])
+            + (SampleNameList, isNarrow, minReplicates, tmpDir, binaryMatrix)
+            for chrom in chroms
+        ]
+        try:
+            for ChromFile, numIntervals, chromCombCounts, chromExtras, chromMatrix in pool.imap(
+                expand_chromosome, tasks
+            ):
+                with open(ChromFile, "r") as fin:
+                    lines = []
+                    for line in fin:
+                        chromID, mstart, mend, rest = line.split("\t", 3)
+                        totalOutIntervals += 1
+                        lines.append("\t".join([chromID, mstart, mend, "Interval_" + str(totalOutIntervals), rest]))
+                        if len(lines) == WRITE_CHUNK_SIZE:
+                            fout.writelines(lines)
+                            lines = []
+                    fout.writelines(lines)
+                os.remove(ChromFile)
+                merge_comb_counts(combCounts, extras, chromCombCounts, chromExtras, len(SampleNameList))
+                if matrix is not None:
+                    matrix.extend(chromMatrix)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        totalOutIntervals, combCounts, extras = expand_merged_peaks(
+            merge_peak_files(SortedFileList),
+            SampleNameList,
+            fout,
+            isNarrow=isNarrow,
+            minReplicates=minReplicates,
+            firstInterval=1,
+            matrix=matrix,
+            summitWidth=summitWidth,
+        )
+
+    fout.close()
+    shutil.rmtree(tmpDir)
+    if matrix is not None:
+        matrix.save(OutFile[:-4] + ".npz", SampleNameList, isNarrow=isNarrow)
 
     ## WRITE FILE FOR INTERVAL INTERSECT ACROSS SAMPLES.
     ## COMPATIBLE WITH UPSETR PACKAGE.
+    ## SAMPLE NAMES ARE ONLY WORKED OUT ONCE FOR EACH DISTINCT MASK
+    bitNames = SampleNameList + extras
     fout = open(OutFile[:-4] + ".intersect.txt", "w")
-    combFreqItems = sorted([(combFreqDict[x], x) for x in combFreqDict.keys()], reverse=True)
+    combFreqItems = sorted(
+        [(v, tuple(sorted([bitNames[x] for x in mask_bits(k)]))) for k, v in combCounts.items()], reverse=True
+    )
     for k, v in combFreqItems:
         fout.write("%s\t%s\n" % ("&".join(v), k))
     fout.close()
@@ -209,11 +997,18 @@ def macs2_merged_expand(MergedIntervalTxtFile, SampleNameList, OutFile, isNarrow
 ############################################
 
 macs2_merged_expand(
-    MergedIntervalTxtFile=args.MERGED_INTERVAL_FILE,
+    PeakFileList=args.PEAK_FILE_LIST.split(","),
     SampleNameList=args.SAMPLE_NAME_LIST.split(","),
     OutFile=args.OUTFILE,
     isNarrow=args.IS_NARROW_PEAK,
     minReplicates=args.MIN_REPLICATES,
+    threads=args.THREADS,
+    binaryMatrix=args.BINARY_MATRIX,
+    previousConsensus=args.PREVIOUS_CONSENSUS,
+    bedFile=args.BED_FILE,
+    safFile=args.SAF_FILE,
+    compression=args.COMPRESSION,
+    summitWidth=args.SUMMIT_WIDTH,
 )
 
 ############################################
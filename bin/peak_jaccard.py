@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Created to compare peak sets across samples
+#######################################################################
+#######################################################################
+
+import os
+import heapq
+import errno
+import argparse
+import collections
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+Description = "Calculate the base-pair overlap and Jaccard index between the peak sets of every pair of samples in a single sweep across all of the peak files."
+Epilog = """Example usage: python peak_jaccard.py <PEAK_FILE_LIST> <SAMPLE_NAME_LIST> <OUTFILE> --overlap_file <OVERLAP_FILE>"""
+
+argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+## REQUIRED PARAMETERS
+argParser.add_argument(
+    "PEAK_FILE_LIST",
+    help="Comma-separated list of MACS2 broadPeak/narrowPeak files, one per sample.",
+)
+argParser.add_argument(
+    "SAMPLE_NAME_LIST",
+    help="Comma-separated list of sample names in the same order as PEAK_FILE_LIST.",
+)
+argParser.add_argument("OUTFILE", help="Output file for the sample x sample matrix of Jaccard indices.")
+
+## OPTIONAL PARAMETERS
+argParser.add_argument(
+    "-of",
+    "--overlap_file",
+    dest="OVERLAP_FILE",
+    default="",
+    help="Output file for the sample x sample matrix of overlapping base-pairs, with the base-pairs covered by each sample on the diagonal (default: '').",
+)
+args = argParser.parse_args()
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def read_peak_intervals(PeakFile):
+    """
+    Return the sorted intervals of a peak file with overlapping and book-ended peaks merged, so that every base
+    covered by the sample is only counted once.
+    """
+    peaks = []
+    fin = open(PeakFile, "r")
+    for line in fin:
+        lspl = line.split("\t")
+        if len(lspl) < 3 or line.startswith(("#", "track", "browser")):
+            continue
+        peaks.append((lspl[0], int(lspl[1]), int(lspl[2])))
+    fin.close()
+    peaks.sort()
+
+    intervals = []
+    for chrom, start, end in peaks:
+        if intervals and intervals[-1][0] == chrom and start <= intervals[-1][2]:
+            intervals[-1][2] = max(intervals[-1][2], end)
+        else:
+            intervals.append([chrom, start, end])
+    return intervals
+
+
+def iter_interval_edges(intervals, bit):
+    """
+    Yield the chromosome, position and change to the active sample mask at the start and end of each interval.
+    """
+    for chrom, start, end in intervals:
+        yield chrom, start, bit
+        yield chrom, end, -bit
+
+
+def sweep_masks(sampleIntervals):
+    """
+    Sweep the interval edges of all samples in order and return the number of base-pairs covered by each
+    combination of samples, as a Counter keyed by the bit mask of the samples.
+    """
+    maskLengths = collections.Counter()
+    edges = heapq.merge(*[iter_interval_edges(x, 1 << i) for i, x in enumerate(sampleIntervals)])
+    mask = 0
+    lchrom, lpos = None, 0
+    for chrom, pos, delta in edges:
+        if mask and chrom == lchrom and pos > lpos:
+            maskLengths[mask] += pos - lpos
+        mask += delta
+        lchrom, lpos = chrom, pos
+    return maskLengths
+
+
+def mask_bits(mask):
+    bits = []
+    while mask:
+        low = mask & -mask
+        bits.append(low.bit_length() - 1)
+        mask ^= low
+    return bits
+
+
+def write_matrix(OutFile, SampleNameList, matrix, fmt):
+    makedir(os.path.dirname(OutFile))
+    fout = open(OutFile, "w")
+    fout.write("sample\t%s\n" % ("\t".join(SampleNameList)))
+    for name, row in zip(SampleNameList, matrix):
+        fout.write("%s\t%s\n" % (name, "\t".join([fmt % (x) for x in row])))
+    fout.close()
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def peak_jaccard(PeakFileList, SampleNameList, OutFile, overlapFile=""):
+    if len(PeakFileList) != len(SampleNameList):
+        raise ValueError("Number of peak files and sample names differ.")
+
+    ## BASE-PAIRS SHARED BY EACH COMBINATION OF SAMPLES ARE ONLY SPLIT INTO PAIRS ONCE AT THE END
+    sampleIntervals = [read_peak_intervals(x) for x in PeakFileList]
+    numSamples = len(SampleNameList)
+    overlaps = [[0] * numSamples for x in range(numSamples)]
+    for mask, length in sweep_masks(sampleIntervals).items():
+        bits = mask_bits(mask)
+        for i in bits:
+            for j in bits:
+                overlaps[i][j] += length
+
+    jaccard = [[0.0] * numSamples for x in range(numSamples)]
+    for i in range(numSamples):
+        for j in range(numSamples):
+            union = overlaps[i][i] + overlaps[j][j] - overlaps[i][j]
+            if union:
+                jaccard[i][j] = overlaps[i][j] / union
+
+    write_matrix(OutFile, SampleNameList, jaccard, "%.6f")
+    if overlapFile:
+        write_matrix(overlapFile, SampleNameList, overlaps, "%d")
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+peak_jaccard(
+    PeakFileList=[x.strip() for x in args.PEAK_FILE_LIST.strip().split(",")],
+    SampleNameList=[x.strip() for x in args.SAMPLE_NAME_LIST.strip().split(",")],
+    OutFile=args.OUTFILE,
+    overlapFile=args.OVERLAP_FILE,
+)
+
+############################################
+############################################
+############################################
+############################################
@@ -8,11 +8,15 @@ process BAM_REMOVE_ORPHANS {
         'biocontainers/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0' }"
 
     input:
-    tuple val(meta), path(bam)
+    tuple val(meta), path(bam), path(bai)
+    path bed
+    path bamtools_filter_config
 
     output:
-    tuple val(meta), path("*.bam"), emit: bam
-    path "versions.yml"           , emit: versions
+    tuple val(meta), path("*.bam")                                          , emit: bam
+    tuple val(meta), path("*.json")                                         , emit: stats    , optional: true
+    tuple val(meta), path("*.fragments.tsv.gz"), path("*.fragments.tsv.gz.tbi"), emit: fragments, optional: true
+    path "versions.yml"                                                     , emit: versions
 
     when:
     task.ext.when == null || task.ext.when
@@ -20,11 +24,18 @@ process BAM_REMOVE_ORPHANS {
     script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
     def args = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
+    def include_regions = bed ? "--include_regions $bed" : ''
+    def filter_config = bamtools_filter_config ? "--filter_config $bamtools_filter_config" : ''
     if (!meta.single_end) {
         """
         bampe_rm_orphan.py \\
             $bam \\
             ${prefix}.bam \\
+            --threads $task.cpus \\
+            --processes $task.cpus \\
+            $include_regions \\
+            $filter_config \\
+            --fragments_output ${prefix}.fragments.tsv.gz \\
             $args
 
         cat <<-END_VERSIONS > versions.yml
@@ -22,8 +22,12 @@ process BEDTOOLS_GENOMECOV {
     def args = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
     def pe     = meta.single_end ? '' : '-pc'
+    // Mapped reads from a samtools flagstat file, or from the flagstat section of a bampe_rm_orphan.py JSON file
+    def mapped_reads = flagstat.name.endsWith('.json') ?
+        "awk '/\"QC-passed reads\"/ { qc = 1 } qc && /\"mapped\":/ { gsub(/[^0-9]/, \"\", \$2); print \$2; exit }' $flagstat" :
+        "grep '[0-9] mapped (' $flagstat | awk '{ print \$1 }'"
     """
-    SCALE_FACTOR=\$(grep '[0-9] mapped (' $flagstat | awk '{print 1000000/\$1}')
+    SCALE_FACTOR=\$($mapped_reads | awk '{print 1000000/\$1}')
     echo \$SCALE_FACTOR > ${prefix}.scale_factor.txt
 
     bedtools \\
@@ -0,0 +1,41 @@
+process FEATURECOUNTS_FRAGMENTS {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda "bioconda::pysam=0.19.0 bioconda::samtools=1.15.1"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0' :
+        'biocontainers/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0' }"
+
+    input:
+    tuple val(meta), path(fragments), path(tbi), path(saf)
+
+    output:
+    tuple val(meta), path("*featureCounts.txt")        , emit: counts
+    tuple val(meta), path("*featureCounts.txt.summary"), emit: summary
+    tuple val(meta), path("*featureCounts.mtx")        , emit: mtx
+    path "versions.yml"                                 , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def args   = task.ext.args   ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    fragment_quant.py \\
+        --threads $task.cpus \\
+        count \\
+        $saf \\
+        ${prefix}.featureCounts.txt \\
+        $fragments \\
+        --sparse_output ${prefix}.featureCounts.mtx \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
+    END_VERSIONS
+    """
+}
@@ -8,7 +8,7 @@ process FRIP_SCORE {
         'biocontainers/mulled-v2-8186960447c5cb2faa697666dc1e6d919ad23f3e:3127fcae6b6bdaf8181e21a26ae61231030a9fcb-0' }"
 
     input:
-    tuple val(meta), path(bam), path(peak)
+    tuple val(meta), path(bam), path(peak), path(flagstat)
 
     output:
     tuple val(meta), path("*.txt"), emit: txt
@@ -20,10 +20,14 @@ process FRIP_SCORE {
     script:
     def args   = task.ext.args   ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
+    // Mapped reads from a samtools flagstat file, or from the flagstat section of a bampe_rm_orphan.py JSON file
+    def mapped_reads = flagstat.name.endsWith('.json') ?
+        "awk '/\"QC-passed reads\"/ { qc = 1 } qc && /\"mapped\":/ { gsub(/[^0-9]/, \"\", \$2); print \$2; exit }' $flagstat" :
+        "grep '[0-9] mapped (' $flagstat | awk '{ print \$1 }'"
     """
     READS_IN_PEAKS=\$(intersectBed -a $bam -b $peak $args | awk -F '\t' '{sum += \$NF} END {print sum}')
-    samtools flagstat $bam > ${bam}.flagstat
-    grep 'mapped (' ${bam}.flagstat | grep -v "primary" | awk -v a="\$READS_IN_PEAKS" -v OFS='\t' '{print "${prefix}", a/\$1}' > ${prefix}.FRiP.txt
+    MAPPED_READS=\$($mapped_reads)
+    awk -v a="\$READS_IN_PEAKS" -v m="\$MAPPED_READS" -v OFS='\t' 'BEGIN {print "${prefix}", a/m}' > ${prefix}.FRiP.txt
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
@@ -1,10 +1,10 @@
 process GENOME_BLACKLIST_REGIONS {
     tag "$sizes"
 
-    conda "bioconda::bedtools=2.30.0"
+    conda "conda-forge::python=3.8.3"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
-        'https://depot.galaxyproject.org/singularity/bedtools:2.30.0--hc088bd4_0':
-        'biocontainers/bedtools:2.30.0--hc088bd4_0' }"
+        'https://depot.galaxyproject.org/singularity/python:3.8.3' :
+        'biocontainers/python:3.8.3' }"
 
     input:
     path sizes
@@ -19,27 +19,21 @@ process GENOME_BLACKLIST_REGIONS {
     when:
     task.ext.when == null || task.ext.when
 
-    script:
-    def file_out = "${sizes.simpleName}.include_regions.bed"
-    def name_filter = mito_name ? "| awk '\$1 !~ /${params.mito_name}/ {print \$0}'": ''
-    def mito_filter = keep_mito ? '' : name_filter
-    if (blacklist) {
-        """
-        sortBed -i $blacklist -g $sizes | complementBed -i stdin -g $sizes $mito_filter > $file_out
+    script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def file_out         = "${sizes.simpleName}.include_regions.bed"
+    def mito_filter      = mito_name && !keep_mito ? "--mito_name '${mito_name}'" : ''
+    def blacklist_filter = blacklist ? "--blacklist $blacklist" : ''
+    """
+    genome_intervals.py \\
+        include_regions \\
+        $sizes \\
+        $file_out \\
+        $blacklist_filter \\
+        $mito_filter
 
-        cat <<-END_VERSIONS > versions.yml
-        "${task.process}":
-            bedtools: \$(bedtools --version | sed -e "s/bedtools v//g")
-        END_VERSIONS
-        """
-    } else {
-        """
-        awk '{print \$1, '0' , \$2}' OFS='\t' $sizes $mito_filter > $file_out
-
-        cat <<-END_VERSIONS > versions.yml
-        "${task.process}":
-            bedtools: \$(bedtools --version | sed -e "s/bedtools v//g")
-        END_VERSIONS
-        """
-    }
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
 }
@@ -0,0 +1,53 @@
+process GENOME_CACHE_FETCH {
+    tag "$fai"
+    label 'process_single'
+
+    conda "conda-forge::python=3.8.3"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/python:3.8.3' :
+        'biocontainers/python:3.8.3' }"
+
+    input:
+    path fai
+    path gtf
+    path gene_bed
+    path blacklist
+    val mito_name
+    val keep_mito
+    val artefacts
+    val cache_dir
+
+    output:
+    path 'genome_cache.json', emit: json
+    path 'autosomes/*'      , optional:true, emit: autosomes
+    path 'filtered_bed/*'   , optional:true, emit: filtered_bed
+    path 'gene_bed/*'       , optional:true, emit: gene_bed
+    path 'tss_bed/*'        , optional:true, emit: tss_bed
+    path "versions.yml"     , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def inputs = [
+        "--input fai=$fai",
+        gtf       ? "--input gtf=$gtf"             : '',
+        gene_bed  ? "--input gene_bed=$gene_bed"   : '',
+        blacklist ? "--input blacklist=$blacklist" : ''
+    ].join(' ').trim()
+    """
+    genome_cache.py \\
+        fetch \\
+        $cache_dir \\
+        ./ \\
+        $inputs \\
+        --param mito_name=$mito_name \\
+        --param keep_mito=$keep_mito \\
+        ${artefacts.collect { "--artefact $it" }.join(' ')}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
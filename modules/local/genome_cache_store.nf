@@ -0,0 +1,42 @@
+process GENOME_CACHE_STORE {
+    label 'process_single'
+
+    conda "conda-forge::python=3.8.3"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/python:3.8.3' :
+        'biocontainers/python:3.8.3' }"
+
+    input:
+    path json
+    path autosomes   , stageAs: 'autosomes/*'
+    path filtered_bed, stageAs: 'filtered_bed/*'
+    path gene_bed    , stageAs: 'gene_bed/*'
+    path tss_bed     , stageAs: 'tss_bed/*'
+    val cache_dir
+
+    output:
+    path "versions.yml", emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def artefacts = [
+        "--artefact autosomes=$autosomes",
+        "--artefact filtered_bed=$filtered_bed",
+        gene_bed ? "--artefact gene_bed=$gene_bed" : '',
+        tss_bed  ? "--artefact tss_bed=$tss_bed"   : ''
+    ].join(' ').trim()
+    """
+    genome_cache.py \\
+        store \\
+        $cache_dir \\
+        $json \\
+        $artefacts
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,43 @@
+process GENOME_SHARDS {
+    tag "$fai"
+
+    conda "conda-forge::python=3.8.3"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/python:3.8.3' :
+        'biocontainers/python:3.8.3' }"
+
+    input:
+    path fai
+    path blacklist
+    val num_shards
+    val mito_name
+    val keep_mito
+
+    output:
+    path '*.shards.bed' , emit: bed
+    path '*.shards.json', emit: json
+    path "versions.yml" , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def args             = task.ext.args ?: ''
+    def mito_filter      = mito_name && !keep_mito ? "--mito_name '${mito_name}'" : ''
+    def blacklist_filter = blacklist ? "--blacklist $blacklist" : ''
+    """
+    genome_shards.py \\
+        $fai \\
+        ${fai.baseName}.shards.bed \\
+        ${fai.baseName}.shards.json \\
+        --num_shards $num_shards \\
+        $blacklist_filter \\
+        $mito_filter \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
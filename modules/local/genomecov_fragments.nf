@@ -0,0 +1,46 @@
+process GENOMECOV_FRAGMENTS {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda "bioconda::pysam=0.19.0 bioconda::samtools=1.15.1"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0' :
+        'biocontainers/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0' }"
+
+    input:
+    tuple val(meta), path(fragments), path(tbi), path(flagstat)
+
+    output:
+    tuple val(meta), path("*.bedGraph"), emit: bedgraph
+    tuple val(meta), path("*.txt")     , emit: scale_factor
+    path "versions.yml"                , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def args   = task.ext.args   ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    // Mapped reads from a samtools flagstat file, or from the flagstat section of a bampe_rm_orphan.py JSON file
+    def mapped_reads = flagstat.name.endsWith('.json') ?
+        "awk '/\"QC-passed reads\"/ { qc = 1 } qc && /\"mapped\":/ { gsub(/[^0-9]/, \"\", \$2); print \$2; exit }' $flagstat" :
+        "grep '[0-9] mapped (' $flagstat | awk '{ print \$1 }'"
+    """
+    SCALE_FACTOR=\$($mapped_reads | awk '{print 1000000/\$1}')
+    echo \$SCALE_FACTOR > ${prefix}.scale_factor.txt
+
+    fragment_quant.py \\
+        --threads $task.cpus \\
+        genomecov \\
+        $fragments \\
+        ${prefix}.bedGraph \\
+        --scale \$SCALE_FACTOR \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
+    END_VERSIONS
+    """
+}
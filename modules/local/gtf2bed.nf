@@ -2,30 +2,36 @@ process GTF2BED {
     tag "$gtf"
     label 'process_low'
 
-    conda "conda-forge::perl=5.26.2"
+    conda "conda-forge::python=3.8.3"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
-        'https://depot.galaxyproject.org/singularity/perl:5.26.2':
-        'biocontainers/perl:5.26.2' }"
+        'https://depot.galaxyproject.org/singularity/python:3.8.3' :
+        'biocontainers/python:3.8.3' }"
 
     input:
     path gtf
 
     output:
-    path '*.bed'       , emit: bed
-    path "versions.yml", emit: versions
+    path "${gtf.baseName}.bed"         , emit: bed
+    path "${gtf.baseName}.tss.bed"     , emit: tss
+    path "${gtf.baseName}.gene_tss.txt", emit: gene_tss
+    path "versions.yml"                , emit: versions
 
     when:
     task.ext.when == null || task.ext.when
 
     script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def args = task.ext.args ?: ''
     """
-    gtf2bed \\
+    gtf2bed.py \\
         $gtf \\
-        > ${gtf.baseName}.bed
+        ${gtf.baseName}.bed \\
+        --tss_bed ${gtf.baseName}.tss.bed \\
+        --gene_tss ${gtf.baseName}.gene_tss.txt \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
-        perl: \$(echo \$(perl --version 2>&1) | sed 's/.*v\\(.*\\)) built.*/\\1/')
+        python: \$(python --version | sed 's/Python //g')
     END_VERSIONS
     """
 }
@@ -1,5 +1,6 @@
 process MACS2_CONSENSUS {
     tag "$meta.id"
+    label 'process_low'
     label 'process_long'
 
     conda "conda-forge::biopython conda-forge::r-optparse=1.7.1 conda-forge::r-upsetr=1.4.0 bioconda::bedtools=2.30.0"
@@ -16,6 +17,7 @@ process MACS2_CONSENSUS {
     tuple val(meta), path("*.saf")          , emit: saf
     tuple val(meta), path("*.pdf")          , emit: pdf
     tuple val(meta), path("*.boolean.txt")  , emit: boolean_txt
+    tuple val(meta), path("*.boolean.npz")  , optional:true, emit: boolean_npz
     tuple val(meta), path("*.intersect.txt"), emit: intersect_txt
     path "versions.yml"                     , emit: versions
 
@@ -23,33 +25,27 @@ process MACS2_CONSENSUS {
     task.ext.when == null || task.ext.when
 
     script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
-    def args         = task.ext.args   ?: ''
-    def prefix       = task.ext.prefix ?: "${meta.id}"
-    def peak_type    = is_narrow_peak  ? 'narrowPeak' : 'broadPeak'
-    def mergecols    = is_narrow_peak  ? (2..10).join(',') : (2..9).join(',')
-    def collapsecols = is_narrow_peak  ? (['collapse']*9).join(',') : (['collapse']*8).join(',')
-    def expandparam  = is_narrow_peak  ? '--is_narrow_peak' : ''
+    def args        = task.ext.args   ?: ''
+    def prefix      = task.ext.prefix ?: "${meta.id}"
+    def peak_type   = is_narrow_peak  ? 'narrowPeak' : 'broadPeak'
+    def expandparam = is_narrow_peak  ? '--is_narrow_peak' : ''
     """
-    sort -T '.' -k1,1 -k2,2n ${peaks.collect{it.toString()}.sort().join(' ')} \\
-        | mergeBed -c $mergecols -o $collapsecols > ${prefix}.txt
-
     macs2_merged_expand.py \\
-        ${prefix}.txt \\
+        ${peaks.collect{it.toString()}.sort().join(',')} \\
         ${peaks.collect{it.toString()}.sort().join(',').replaceAll("_peaks.${peak_type}","")} \\
         ${prefix}.boolean.txt \\
+        --threads $task.cpus \\
+        --bed_file ${prefix}.bed \\
+        --saf_file ${prefix}.saf \\
         $args \\
         $expandparam
 
-    awk -v FS='\t' -v OFS='\t' 'FNR > 1 { print \$1, \$2, \$3, \$4, "0", "+" }' ${prefix}.boolean.txt > ${prefix}.bed
-
-    echo -e "GeneID\tChr\tStart\tEnd\tStrand" > ${prefix}.saf
-    awk -v FS='\t' -v OFS='\t' 'FNR > 1 { print \$4, \$1, \$2, \$3,  "+" }' ${prefix}.boolean.txt >> ${prefix}.saf
-
     plot_peak_intersect.r -i ${prefix}.boolean.intersect.txt -o ${prefix}.boolean.intersect.plot.pdf
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
         python: \$(python --version | sed 's/Python //g')
+        numpy: \$(python -c "import numpy; print(numpy.__version__)")
         r-base: \$(echo \$(R --version 2>&1) | sed 's/^.*R version //; s/ .*\$//')
     END_VERSIONS
     """
@@ -38,6 +38,7 @@ process MULTIQC {
     path ('macs2/merged_library/peaks/*')
     path ('macs2/merged_library/peaks/*')
     path ('macs2/merged_library/annotation/*')
+    path ('macs2/merged_library/peaks/*')
     path ('macs2/merged_library/featurecounts/*')
 
     path ('alignment/merged_replicate/*')
@@ -48,6 +49,7 @@ process MULTIQC {
     path ('macs2/merged_replicate/peaks/*')
     path ('macs2/merged_replicate/peaks/*')
     path ('macs2/merged_replicate/annotation/*')
+    path ('macs2/merged_replicate/peaks/*')
     path ('macs2/merged_replicate/featurecounts/*')
 
     path ('deseq2_library/*')
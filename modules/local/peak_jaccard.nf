@@ -0,0 +1,42 @@
+process PEAK_JACCARD {
+    label 'process_low'
+
+    conda "conda-forge::python=3.8.3"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/python:3.8.3' :
+        'biocontainers/python:3.8.3' }"
+
+    input:
+    path peaks
+    path peak_jaccard_header
+    val is_narrow_peak
+
+    output:
+    path '*.jaccard.txt'    , emit: txt
+    path '*.overlap.txt'    , emit: overlap
+    path '*.jaccard_mqc.tsv', emit: multiqc
+    path "versions.yml"     , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/atacseq/bin/
+    def args      = task.ext.args   ?: ''
+    def prefix    = task.ext.prefix ?: 'macs2_peak'
+    def peak_type = is_narrow_peak  ? 'narrowPeak' : 'broadPeak'
+    """
+    peak_jaccard.py \\
+        ${peaks.collect{it.toString()}.sort().join(',')} \\
+        ${peaks.collect{it.toString()}.sort().join(',').replaceAll("_peaks.${peak_type}","")} \\
+        ${prefix}.jaccard.txt \\
+        --overlap_file ${prefix}.overlap.txt \\
+        $args
+
+    cat $peak_jaccard_header ${prefix}.jaccard.txt > ${prefix}.jaccard_mqc.tsv
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
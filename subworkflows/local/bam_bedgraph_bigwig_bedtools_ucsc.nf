@@ -4,37 +4,68 @@
 //
 
 include { BEDTOOLS_GENOMECOV    } from '../../modules/local/bedtools_genomecov'
+include { GENOMECOV_FRAGMENTS   } from '../../modules/local/genomecov_fragments'
 include { UCSC_BEDGRAPHTOBIGWIG } from '../../modules/nf-core/ucsc/bedgraphtobigwig/main'
 
 workflow BAM_BEDGRAPH_BIGWIG_BEDTOOLS_UCSC {
     take:
-    ch_bam_flagstat // channel: [ val(meta), [bam], [flagstat] ]
+    ch_bam_flagstat // channel: [ val(meta), [bam], [flagstat or bampe_rm_orphan.py json] ]
+    ch_fragments    // channel: [ val(meta), [fragments], [tbi] ]
     ch_chrom_sizes  // channel: [ bed ]
     
     main:
 
     ch_versions = Channel.empty()
 
+    // Create channels: [ meta, fragments, tbi, flagstat ] for samples with a fragment file, otherwise [ meta, bam, flagstat ]
+    ch_bam_flagstat
+        .join(ch_fragments, by: [0], remainder: true)
+        .filter { it[1] }
+        .branch {
+            fragments: it[3]
+                return [ it[0], it[3], it[4], it[2] ]
+            bam: true
+                return [ it[0], it[1], it[2] ]
+        }
+        .set { ch_genomecov_input }
+
     //
     // Create bedGraph coverage track
     //
     BEDTOOLS_GENOMECOV (
-        ch_bam_flagstat
+        ch_genomecov_input.bam
     )
     ch_versions = ch_versions.mix(BEDTOOLS_GENOMECOV.out.versions.first())
 
+    GENOMECOV_FRAGMENTS (
+        ch_genomecov_input.fragments
+    )
+    ch_versions = ch_versions.mix(GENOMECOV_FRAGMENTS.out.versions.first())
+
+    BEDTOOLS_GENOMECOV
+        .out
+        .bedgraph
+        .mix(GENOMECOV_FRAGMENTS.out.bedgraph)
+        .set { ch_bedgraph }
+
+    BEDTOOLS_GENOMECOV
+        .out
+        .scale_factor
+        .mix(GENOMECOV_FRAGMENTS.out.scale_factor)
+        .set { ch_scale_factor }
+
     //
     // Create bigWig coverage tracks
     //
     UCSC_BEDGRAPHTOBIGWIG (
-        BEDTOOLS_GENOMECOV.out.bedgraph,
+        ch_bedgraph,
         ch_chrom_sizes
     )
     ch_versions = ch_versions.mix(UCSC_BEDGRAPHTOBIGWIG.out.versions.first())
 
     emit:
-    bedgraph     = BEDTOOLS_GENOMECOV.out.bedgraph      // channel: [ val(meta), [ bedgraph ] ]
-    scale_factor = BEDTOOLS_GENOMECOV.out.scale_factor  // channel: [ val(meta), [ txt ] ]
+    bedgraph     = ch_bedgraph                          // channel: [ val(meta), [ bedgraph ] ]
+    scale_factor = ch_scale_factor                      // channel: [ val(meta), [ txt ] ]
 
     bigwig       = UCSC_BEDGRAPHTOBIGWIG.out.bigwig     // channel: [ val(meta), [ bigwig ] ]
 
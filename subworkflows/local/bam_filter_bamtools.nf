@@ -1,6 +1,4 @@
-include { SAMTOOLS_SORT           } from '../../modules/nf-core/samtools/sort/main'
 include { SAMTOOLS_INDEX          } from '../../modules/nf-core/samtools/index/main'
-include { BAM_SORT_STATS_SAMTOOLS } from '../nf-core/bam_sort_stats_samtools/main'
 include { BAM_STATS_SAMTOOLS      } from '../nf-core/bam_stats_samtools/main'
 
 include { BAMTOOLS_FILTER         } from '../../modules/local/bamtools_filter'
@@ -13,16 +11,28 @@ workflow BAM_FILTER_BAMTOOLS {
     ch_fasta                     // channel: [ fasta ]
     ch_bamtools_filter_se_config // channel: [ config_file ]
     ch_bamtools_filter_pe_config // channel: [ config_file ]
+    fuse_pe_filter               // boolean: filter PE BAM files and remove orphans in a single pass
 
     main:
 
     ch_versions = Channel.empty()
 
+    //
+    // PE BAM files skip BAMTools when filtering is fused with orphan removal
+    //
+    ch_bam_bai
+        .branch {
+            meta, bam, bai ->
+                fused: fuse_pe_filter && !meta.single_end
+                bamtools: true
+        }
+        .set { ch_bam_bai_filter }
+
     //
     // Filter BAM file with BAMTools
     //
     BAMTOOLS_FILTER (
-        ch_bam_bai,
+        ch_bam_bai_filter.bamtools,
         ch_bed,
         ch_bamtools_filter_se_config,
         ch_bamtools_filter_pe_config
@@ -37,58 +47,49 @@ workflow BAM_FILTER_BAMTOOLS {
                 single_end: meta.single_end
                     return [ meta, bam ]
                 paired_end: !meta.single_end
-                    return [ meta, bam ]
+                    return [ meta, bam, [] ]
         }
         .set { ch_bam }
 
     //
-    // Index SE BAM file
+    // Remove orphan reads from coordinate-sorted PE BAM file, applying the flag, region and BAMTools filters in the same pass when fused
     //
-    SAMTOOLS_INDEX {
-        ch_bam.single_end
-    }
-    ch_versions = ch_versions.mix(SAMTOOLS_INDEX.out.versions.first())
-
-    //
-    // Run samtools stats, flagstat and idxstats on SE BAM
-    //
-    BAM_STATS_SAMTOOLS (
-        ch_bam.single_end.join(SAMTOOLS_INDEX.out.bai),
-        ch_fasta
+    BAM_REMOVE_ORPHANS (
+        ch_bam.paired_end.mix(ch_bam_bai_filter.fused),
+        fuse_pe_filter ? ch_bed : [],
+        fuse_pe_filter ? ch_bamtools_filter_pe_config : []
     )
-    ch_versions = ch_versions.mix(BAM_STATS_SAMTOOLS.out.versions.first())
+    ch_versions = ch_versions.mix(BAM_REMOVE_ORPHANS.out.versions.first())
 
-    //
-    // Name sort PE BAM before filtering with pysam
-    //
-    SAMTOOLS_SORT (
-        ch_bam.paired_end
-    )
-    ch_versions = ch_versions.mix(SAMTOOLS_SORT.out.versions.first())
+    ch_bam
+        .single_end
+        .mix(BAM_REMOVE_ORPHANS.out.bam)
+        .set { ch_filtered_bam }
 
     //
-    // Remove orphan reads from PE BAM file
+    // Index BAM file
     //
-    BAM_REMOVE_ORPHANS (
-        SAMTOOLS_SORT.out.bam
+    SAMTOOLS_INDEX (
+        ch_filtered_bam
     )
-    ch_versions = ch_versions.mix(BAM_REMOVE_ORPHANS.out.versions.first())
+    ch_versions = ch_versions.mix(SAMTOOLS_INDEX.out.versions.first())
 
     //
-    // Sort, index PE BAM file and run samtools stats, flagstat and idxstats
+    // Run samtools stats, flagstat and idxstats
     //
-    BAM_SORT_STATS_SAMTOOLS (
-        BAM_REMOVE_ORPHANS.out.bam,
+    BAM_STATS_SAMTOOLS (
+        ch_filtered_bam.join(SAMTOOLS_INDEX.out.bai, by: [0]),
         ch_fasta
     )
-    ch_versions = ch_versions.mix(BAM_SORT_STATS_SAMTOOLS.out.versions.first())
+    ch_versions = ch_versions.mix(BAM_STATS_SAMTOOLS.out.versions.first())
 
     emit:
-    name_bam = SAMTOOLS_SORT.out.bam                                                     // channel: [ val(meta), [ bam ] ]
-    bam      = BAM_SORT_STATS_SAMTOOLS.out.bam.mix(ch_bam.single_end)                    // channel: [ val(meta), [ bam ] ]
-    bai      = BAM_SORT_STATS_SAMTOOLS.out.bai.mix(SAMTOOLS_INDEX.out.bai)               // channel: [ val(meta), [ bai ] ]
-    stats    = BAM_SORT_STATS_SAMTOOLS.out.stats.mix(BAM_STATS_SAMTOOLS.out.stats)       // channel: [ val(meta), [ stats ] ]
-    flagstat = BAM_SORT_STATS_SAMTOOLS.out.flagstat.mix(BAM_STATS_SAMTOOLS.out.flagstat) // channel: [ val(meta), [ flagstat ] ]
-    idxstats = BAM_SORT_STATS_SAMTOOLS.out.idxstats.mix(BAM_STATS_SAMTOOLS.out.idxstats) // channel: [ val(meta), [ idxstats ] ]
-    versions = ch_versions                                                               // channel: [ versions.yml ]
+    bam       = ch_filtered_bam                     // channel: [ val(meta), [ bam ] ]
+    bai       = SAMTOOLS_INDEX.out.bai              // channel: [ val(meta), [ bai ] ]
+    stats     = BAM_STATS_SAMTOOLS.out.stats        // channel: [ val(meta), [ stats ] ]
+    flagstat  = BAM_STATS_SAMTOOLS.out.flagstat     // channel: [ val(meta), [ flagstat ] ]
+    idxstats  = BAM_STATS_SAMTOOLS.out.idxstats     // channel: [ val(meta), [ idxstats ] ]
+    pe_stats  = BAM_REMOVE_ORPHANS.out.stats        // channel: [ val(meta), [ json ] ]
+    fragments = BAM_REMOVE_ORPHANS.out.fragments    // channel: [ val(meta), [ tsv.gz ], [ tbi ] ]
+    versions  = ch_versions                         // channel: [ versions.yml ]
 }
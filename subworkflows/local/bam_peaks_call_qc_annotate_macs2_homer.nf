@@ -6,13 +6,17 @@ include { MACS2_CALLPEAK           } from '../../modules/nf-core/macs2/callpeak/
 include { HOMER_ANNOTATEPEAKS      } from '../../modules/nf-core/homer/annotatepeaks/main'
 
 include { FRIP_SCORE               } from '../../modules/local/frip_score'
+include { FRIP_SCORE_FRAGMENTS     } from '../../modules/local/frip_score_fragments'
 include { MULTIQC_CUSTOM_PEAKS     } from '../../modules/local/multiqc_custom_peaks'
 include { PLOT_MACS2_QC            } from '../../modules/local/plot_macs2_qc'
+include { PEAK_JACCARD             } from '../../modules/local/peak_jaccard'
 include { PLOT_HOMER_ANNOTATEPEAKS } from '../../modules/local/plot_homer_annotatepeaks'
 
 workflow BAM_PEAKS_CALL_QC_ANNOTATE_MACS2_HOMER {
     take:
     ch_bam                            // channel: [ val(meta), [ ip_bam ], [ control_bam ] ]
+    ch_flagstat                       // channel: [ val(meta), [ flagstat or bampe_rm_orphan.py json ] ]
+    ch_fragments                      // channel: [ val(meta), [ fragments ], [ tbi ] ]
     ch_fasta                          // channel: [ fasta ]
     ch_gtf                            // channel: [ gtf ]
     macs_gsize                        // integer: value for --macs_gsize parameter
@@ -20,6 +24,7 @@ workflow BAM_PEAKS_CALL_QC_ANNOTATE_MACS2_HOMER {
     ch_peak_count_header_multiqc      // channel: [ header_file ]
     ch_frip_score_multiqc             // channel: [ header_file ]
     ch_peak_annotation_header_multiqc // channel: [ header_file ]
+    ch_peak_jaccard_header_multiqc    // channel: [ header_file ]
     is_narrow_peak                    // boolean: true/false
     skip_peak_annotation              // boolean: true/false
     skip_peak_qc                      // boolean: true/false
@@ -58,17 +63,40 @@ workflow BAM_PEAKS_CALL_QC_ANNOTATE_MACS2_HOMER {
         }
         .set { ch_bam_peaks }
 
+    // Create channels: [ meta, fragments, tbi, peaks ] for samples with a fragment file, otherwise [ meta, ip_bam, peaks ]
+    ch_bam_peaks
+        .join(ch_fragments, by: [0], remainder: true)
+        .filter { it[1] }
+        .branch {
+            fragments: it[3]
+                return [ it[0], it[3], it[4], it[2] ]
+            bam: true
+                return [ it[0], it[1], it[2] ]
+        }
+        .set { ch_frip_input }
+
     //
     // Calculate FRiP score
     //
     FRIP_SCORE (
-        ch_bam_peaks
+        ch_frip_input.bam.join(ch_flagstat, by: [0])
     )
     ch_versions = ch_versions.mix(FRIP_SCORE.out.versions.first())
 
+    FRIP_SCORE_FRAGMENTS (
+        ch_frip_input.fragments
+    )
+    ch_versions = ch_versions.mix(FRIP_SCORE_FRAGMENTS.out.versions.first())
+
+    FRIP_SCORE
+        .out
+        .txt
+        .mix(FRIP_SCORE_FRAGMENTS.out.txt)
+        .set { ch_frip_txt }
+
     // Create channels: [ meta, peaks, frip ]
     ch_bam_peaks
-        .join(FRIP_SCORE.out.txt, by: [0])
+        .join(ch_frip_txt, by: [0])
         .map {
             meta, ip_bam, peaks, frip ->
                 [ meta, peaks, frip ]
@@ -85,6 +113,22 @@ workflow BAM_PEAKS_CALL_QC_ANNOTATE_MACS2_HOMER {
     )
     ch_versions = ch_versions.mix(MULTIQC_CUSTOM_PEAKS.out.versions.first())
 
+    ch_peak_jaccard_txt     = Channel.empty()
+    ch_peak_jaccard_multiqc = Channel.empty()
+    if (!skip_peak_qc) {
+        //
+        // Pairwise overlap of the peak sets of all samples
+        //
+        PEAK_JACCARD (
+            ch_macs2_peaks.collect{it[1]}.filter { it.size() > 1 },
+            ch_peak_jaccard_header_multiqc,
+            is_narrow_peak
+        )
+        ch_peak_jaccard_txt     = PEAK_JACCARD.out.txt
+        ch_peak_jaccard_multiqc = PEAK_JACCARD.out.multiqc
+        ch_versions = ch_versions.mix(PEAK_JACCARD.out.versions)
+    }
+
     ch_homer_annotatepeaks          = Channel.empty()
     ch_plot_macs2_qc_txt            = Channel.empty()
     ch_plot_macs2_qc_pdf            = Channel.empty()
@@ -137,11 +181,14 @@ workflow BAM_PEAKS_CALL_QC_ANNOTATE_MACS2_HOMER {
     bed                          = MACS2_CALLPEAK.out.bed           // channel: [ val(meta), [ bed ] ]
     bedgraph                     = MACS2_CALLPEAK.out.bdg           // channel: [ val(meta), [ bedgraph ] ]
 
-    frip_txt                     = FRIP_SCORE.out.txt               // channel: [ val(meta), [ txt ] ]
+    frip_txt                     = ch_frip_txt                      // channel: [ val(meta), [ txt ] ]
     
     frip_multiqc                 = MULTIQC_CUSTOM_PEAKS.out.frip    // channel: [ val(meta), [ frip ] ]
     peak_count_multiqc           = MULTIQC_CUSTOM_PEAKS.out.count   // channel: [ val(meta), [ counts ] ]
 
+    peak_jaccard_txt             = ch_peak_jaccard_txt              // channel: [ txt ]
+    peak_jaccard_multiqc         = ch_peak_jaccard_multiqc          // channel: [ tsv ]
+
     homer_annotatepeaks          = ch_homer_annotatepeaks           // channel: [ val(meta), [ txt ] ]
 
     plot_macs2_qc_txt            = ch_plot_macs2_qc_txt             // channel: [ txt ]
@@ -1,17 +1,21 @@
 //
-// Call consensus peaks with BEDTools and custom scripts, annotate with HOMER, quantify with featureCounts and QC with DESeq2
+// Call consensus peaks with BEDTools and custom scripts, annotate with HOMER, quantify with featureCounts, from fragment files or with fragment_quant.py and QC with DESeq2
 //
 
-include { HOMER_ANNOTATEPEAKS    } from '../../modules/nf-core/homer/annotatepeaks/main'
-include { SUBREAD_FEATURECOUNTS  } from '../../modules/nf-core/subread/featurecounts/main'
+include { HOMER_ANNOTATEPEAKS     } from '../../modules/nf-core/homer/annotatepeaks/main'
+include { SUBREAD_FEATURECOUNTS   } from '../../modules/nf-core/subread/featurecounts/main'
 
-include { MACS2_CONSENSUS        } from '../../modules/local/macs2_consensus'
-include { DESEQ2_QC              } from '../../modules/local/deseq2_qc'
+include { MACS2_CONSENSUS         } from '../../modules/local/macs2_consensus'
+include { FEATURECOUNTS_FRAGMENTS                     } from '../../modules/local/featurecounts_fragments'
+include { FEATURECOUNTS_FRAGMENTS as FEATURECOUNTS_BAM } from '../../modules/local/featurecounts_fragments'
+include { DESEQ2_QC               } from '../../modules/local/deseq2_qc'
 
 workflow BED_CONSENSUS_QUANTIFY_QC_BEDTOOLS_FEATURECOUNTS_DESEQ2 {
     take:
     ch_peaks                            // channel: [ val(meta), [ peaks ] ]
     ch_bams                             // channel: [ val(meta), [ bams ] ]
+    ch_bais                             // channel: [ val(meta), [ bais ] ]
+    ch_fragments                        // channel: [ val(meta), [ fragments ], [ tbi ] ]
     ch_fasta                            // channel: [ fasta ]
     ch_gtf                              // channel: [ gtf ]
     ch_deseq2_pca_header_multiqc        // channel: [ header_file ]
@@ -19,6 +23,7 @@ workflow BED_CONSENSUS_QUANTIFY_QC_BEDTOOLS_FEATURECOUNTS_DESEQ2 {
     is_narrow_peak                      // boolean: true/false
     skip_peak_annotation                // boolean: true/false
     skip_deseq2_qc                      // boolean: true/false
+    native_counts                       // boolean: true/false
     
     main:
 
@@ -58,29 +63,81 @@ workflow BED_CONSENSUS_QUANTIFY_QC_BEDTOOLS_FEATURECOUNTS_DESEQ2 {
         ch_versions = ch_versions.mix(HOMER_ANNOTATEPEAKS.out.versions)
     }
 
-    // Create channels: [ meta, [ bams ], saf ]
+    // Create channels: [ [ fragments ], [ tbi ] ] if every sample has a fragment file, otherwise [ [ bams ], [ bais ] ]
     ch_bams
         .join(ch_peaks)
-        .collect { it[1] }
-        .filter { it.size() > 1 }
-        .map { [ it ] }
-        .concat(MACS2_CONSENSUS.out.saf)
-        .collect()
-        .filter { it.size() == 3 }
-        .map {
-            bam, meta, saf -> 
-                [ meta, bam , saf ]
+        .map { it[0..1] }
+        .join(ch_bais)
+        .join(ch_fragments, by: [0], remainder: true)
+        .filter { it[1] }
+        .collect(flat: false)
+        .filter { rows -> rows.collect { it[1] }.flatten().size() > 1 }
+        .branch {
+            rows ->
+                fragments: rows.every { it[3] }
+                    return [ rows.collect { it[3] }.flatten(), rows.collect { it[4] }.flatten() ]
+                native: native_counts && rows.every { !it[0].single_end }
+                    return [ rows.collect { it[1] }.flatten(), rows.collect { it[2] }.flatten() ]
+                bam: true
+                    return [ rows.collect { it[1] }.flatten() ]
         }
-        .set { ch_bam_saf }
+        .set { ch_quant }
 
     //
     // Quantify peaks across samples with featureCounts
     //
     SUBREAD_FEATURECOUNTS (
-        ch_bam_saf
+        ch_quant
+            .bam
+            .combine(MACS2_CONSENSUS.out.saf)
+            .map {
+                bam, meta, saf ->
+                    [ meta, bam, saf ]
+            }
     )
     ch_versions = ch_versions.mix(SUBREAD_FEATURECOUNTS.out.versions)
 
+    //
+    // Quantify peaks across samples from fragment files
+    //
+    FEATURECOUNTS_FRAGMENTS (
+        ch_quant
+            .fragments
+            .combine(MACS2_CONSENSUS.out.saf)
+            .map {
+                fragments, tbi, meta, saf ->
+                    [ meta, fragments, tbi, saf ]
+            }
+    )
+    ch_versions = ch_versions.mix(FEATURECOUNTS_FRAGMENTS.out.versions)
+
+    //
+    // Count fragments in peaks straight from paired-end BAM files instead of with featureCounts
+    // The BAM indices are staged so that the BAM files are not indexed again before counting
+    //
+    FEATURECOUNTS_BAM (
+        ch_quant
+            .native
+            .combine(MACS2_CONSENSUS.out.saf)
+            .map {
+                bams, bais, meta, saf ->
+                    [ meta, bams, bais, saf ]
+            }
+    )
+    ch_versions = ch_versions.mix(FEATURECOUNTS_BAM.out.versions)
+
+    SUBREAD_FEATURECOUNTS
+        .out
+        .counts
+        .mix(FEATURECOUNTS_FRAGMENTS.out.counts, FEATURECOUNTS_BAM.out.counts)
+        .set { ch_featurecounts_txt }
+
+    SUBREAD_FEATURECOUNTS
+        .out
+        .summary
+        .mix(FEATURECOUNTS_FRAGMENTS.out.summary, FEATURECOUNTS_BAM.out.summary)
+        .set { ch_featurecounts_summary }
+
     //
     // Generate QC plots with DESeq2
     //
@@ -95,7 +152,7 @@ workflow BED_CONSENSUS_QUANTIFY_QC_BEDTOOLS_FEATURECOUNTS_DESEQ2 {
     ch_deseq2_qc_size_factors  = Channel.empty()
     if (!skip_deseq2_qc) {
         DESEQ2_QC (
-            SUBREAD_FEATURECOUNTS.out.counts,
+            ch_featurecounts_txt,
             ch_deseq2_pca_header_multiqc,
             ch_deseq2_clustering_header_multiqc
         )
@@ -116,12 +173,13 @@ workflow BED_CONSENSUS_QUANTIFY_QC_BEDTOOLS_FEATURECOUNTS_DESEQ2 {
     consensus_saf           = MACS2_CONSENSUS.out.saf           // channel: [ saf ]
     consensus_pdf           = MACS2_CONSENSUS.out.pdf           // channel: [ pdf ]
     consensus_boolean_txt   = MACS2_CONSENSUS.out.boolean_txt   // channel: [ txt ]
+    consensus_boolean_npz   = MACS2_CONSENSUS.out.boolean_npz   // channel: [ npz ]
     consensus_intersect_txt = MACS2_CONSENSUS.out.intersect_txt // channel: [ txt ]
 
     homer_annotatepeaks     = ch_homer_annotatepeaks            // channel: [ txt ]
 
-    featurecounts_txt       = SUBREAD_FEATURECOUNTS.out.counts  // channel: [ txt ]
-    featurecounts_summary   = SUBREAD_FEATURECOUNTS.out.summary // channel: [ txt ]
+    featurecounts_txt       = ch_featurecounts_txt              // channel: [ txt ]
+    featurecounts_summary   = ch_featurecounts_summary          // channel: [ txt ]
 
     deseq2_qc_pdf           = ch_deseq2_qc_pdf                  // channel: [ pdf ]
     deseq2_qc_rdata         = ch_deseq2_qc_rdata                // channel: [ rdata ]
@@ -28,6 +28,9 @@ include { GTF2BED                  } from '../../modules/local/gtf2bed'
 include { GENOME_BLACKLIST_REGIONS } from '../../modules/local/genome_blacklist_regions'
 include { GET_AUTOSOMES            } from '../../modules/local/get_autosomes'
 include { TSS_EXTRACT              } from '../../modules/local/tss_extract'
+include { GENOME_CACHE_FETCH       } from '../../modules/local/genome_cache_fetch'
+include { GENOME_CACHE_STORE       } from '../../modules/local/genome_cache_store'
+include { GENOME_SHARDS            } from '../../modules/local/genome_shards'
 
 workflow PREPARE_GENOME {
     take:
@@ -81,6 +84,14 @@ workflow PREPARE_GENOME {
         }
     }
 
+    //
+    // Create chromosome sizes file
+    //
+    CUSTOM_GETCHROMSIZES ( ch_fasta.map { [ [:], it ] } )
+    ch_chrom_sizes = CUSTOM_GETCHROMSIZES.out.sizes.map { it[1] }
+    ch_fai         = CUSTOM_GETCHROMSIZES.out.fai.map{ it[1] }
+    ch_versions    = ch_versions.mix(CUSTOM_GETCHROMSIZES.out.versions)
+
     //
     // Uncompress gene BED annotation file or create from GTF if required
     //
@@ -96,21 +107,72 @@ workflow PREPARE_GENOME {
         }
     }
 
-    if (make_bed) {
-        ch_gene_bed = GTF2BED ( ch_gtf ).bed
-        ch_versions = ch_versions.mix(GTF2BED.out.versions)
-    } else {
+    ch_user_gene_bed = Channel.empty()
+    if (!make_bed) {
         if (params.gene_bed.endsWith('.gz')) {
-            ch_gene_bed = GUNZIP_GENE_BED ( [ [:], params.gene_bed ] ).gunzip.map{ it[1] }
-            ch_versions = ch_versions.mix(GUNZIP_GENE_BED.out.versions)
+            ch_user_gene_bed = GUNZIP_GENE_BED ( [ [:], params.gene_bed ] ).gunzip.map{ it[1] }
+            ch_versions      = ch_versions.mix(GUNZIP_GENE_BED.out.versions)
         } else {
-            ch_gene_bed = Channel.value(file(params.gene_bed))
+            ch_user_gene_bed = Channel.value(file(params.gene_bed))
+        }
+    }
+
+    //
+    // Fetch the files below from the shared genome cache if a previous run prepared them from the same inputs
+    //
+    def cache_miss = { ch -> ch }
+    ch_genome_cache_miss = Channel.empty()
+    if (params.genome_cache) {
+        // The cache is written in place, so it is passed to tasks as a path rather than staged
+        genome_cache_dir = file(params.genome_cache, type: 'dir')
+        if (genome_cache_dir.scheme != 'file') {
+            Nextflow.error "The genome cache has to be on a shared filesystem, not '${params.genome_cache}'."
+        }
+        genome_cache_dir.mkdirs()
+
+        GENOME_CACHE_FETCH (
+            ch_fai,
+            make_bed ? ch_gtf : [],
+            !make_bed && !params.tss_bed ? ch_user_gene_bed : [],
+            ch_blacklist.ifEmpty([]),
+            params.mito_name ?: '',
+            params.keep_mito,
+            [ 'autosomes', 'filtered_bed' ] + (make_bed ? [ 'gene_bed' ] : []) + (params.tss_bed ? [] : [ 'tss_bed' ]),
+            genome_cache_dir.toString()
+        )
+        ch_versions = ch_versions.mix(GENOME_CACHE_FETCH.out.versions)
+
+        // Only prepare the files below again if they were not in the cache
+        ch_genome_cache_miss = GENOME_CACHE_FETCH
+            .out
+            .json
+            .filter { !new groovy.json.JsonSlurper().parse(it).hit }
+        cache_miss = { ch -> ch.combine(ch_genome_cache_miss).map { it[0] } }
+    }
+
+    // GTF2BED writes the TSS BED in the same pass as the gene BED
+    ch_made_tss_bed = Channel.empty()
+    if (make_bed) {
+        GTF2BED ( cache_miss(ch_gtf) )
+        ch_gene_bed     = GTF2BED.out.bed
+        ch_made_tss_bed = GTF2BED.out.tss
+        ch_versions     = ch_versions.mix(GTF2BED.out.versions)
+        if (params.genome_cache) {
+            ch_gene_bed = ch_gene_bed.mix(GENOME_CACHE_FETCH.out.gene_bed).first()
         }
+    } else {
+        ch_gene_bed = ch_user_gene_bed
     }
 
     if (!params.tss_bed) {
-        ch_tss_bed = TSS_EXTRACT ( ch_gene_bed ).tss
-        ch_versions = ch_versions.mix(TSS_EXTRACT.out.versions)
+        if (!make_bed) {
+            ch_made_tss_bed = TSS_EXTRACT ( cache_miss(ch_gene_bed) ).tss
+            ch_versions     = ch_versions.mix(TSS_EXTRACT.out.versions)
+        }
+        ch_tss_bed = ch_made_tss_bed
+        if (params.genome_cache) {
+            ch_tss_bed = ch_tss_bed.mix(GENOME_CACHE_FETCH.out.tss_bed).first()
+        }
     } else {
         if (params.tss_bed.endsWith('.gz')) {
             ch_tss_bed = GUNZIP_TSS_BED ( [ [:], params.tss_bed ] ).gunzip.map{ it[1] }
@@ -120,20 +182,12 @@ workflow PREPARE_GENOME {
         }
     }
 
-    //
-    // Create chromosome sizes file
-    //
-    CUSTOM_GETCHROMSIZES ( ch_fasta.map { [ [:], it ] } )
-    ch_chrom_sizes = CUSTOM_GETCHROMSIZES.out.sizes.map { it[1] }
-    ch_fai         = CUSTOM_GETCHROMSIZES.out.fai.map{ it[1] }
-    ch_versions    = ch_versions.mix(CUSTOM_GETCHROMSIZES.out.versions)
-
     //
     // Create autosomal chromosome list for ataqv
     //
     ch_genome_autosomes = Channel.empty()
     GET_AUTOSOMES (
-        ch_fai
+        cache_miss(ch_fai)
     )
     ch_genome_autosomes = GET_AUTOSOMES.out.txt
     ch_versions = ch_versions.mix(GET_AUTOSOMES.out.versions)
@@ -144,7 +198,7 @@ workflow PREPARE_GENOME {
     //
     ch_genome_filtered_bed = Channel.empty()
     GENOME_BLACKLIST_REGIONS (
-        ch_chrom_sizes,
+        cache_miss(ch_chrom_sizes),
         ch_blacklist.ifEmpty([]),
         params.mito_name ?: '',
         params.keep_mito
@@ -152,6 +206,42 @@ workflow PREPARE_GENOME {
     ch_genome_filtered_bed = GENOME_BLACKLIST_REGIONS.out.bed
     ch_versions = ch_versions.mix(GENOME_BLACKLIST_REGIONS.out.versions)
 
+    //
+    // Store the files prepared by this run in the shared genome cache
+    //
+    if (params.genome_cache) {
+        ch_genome_autosomes    = ch_genome_autosomes.mix(GENOME_CACHE_FETCH.out.autosomes).first()
+        ch_genome_filtered_bed = ch_genome_filtered_bed.mix(GENOME_CACHE_FETCH.out.filtered_bed).first()
+
+        GENOME_CACHE_STORE (
+            ch_genome_cache_miss,
+            GET_AUTOSOMES.out.txt,
+            GENOME_BLACKLIST_REGIONS.out.bed,
+            make_bed ? GTF2BED.out.bed : [],
+            params.tss_bed ? [] : ch_made_tss_bed,
+            genome_cache_dir.toString()
+        )
+        ch_versions = ch_versions.mix(GENOME_CACHE_STORE.out.versions)
+    }
+
+    //
+    // Plan balanced work units across the genome for chromosome-parallel steps
+    //
+    ch_genome_shards_bed  = Channel.empty()
+    ch_genome_shards_json = Channel.empty()
+    if (params.genome_shards) {
+        GENOME_SHARDS (
+            ch_fai,
+            ch_blacklist.ifEmpty([]),
+            params.genome_shards,
+            params.mito_name ?: '',
+            params.keep_mito
+        )
+        ch_genome_shards_bed  = GENOME_SHARDS.out.bed
+        ch_genome_shards_json = GENOME_SHARDS.out.json
+        ch_versions = ch_versions.mix(GENOME_SHARDS.out.versions)
+    }
+
     //
     // Uncompress BWA index or generate from scratch if required
     //
@@ -245,6 +335,8 @@ workflow PREPARE_GENOME {
     tss_bed       = ch_tss_bed                    //    path: tss.bed
     chrom_sizes   = ch_chrom_sizes                //    path: genome.sizes
     filtered_bed  = ch_genome_filtered_bed        //    path: *.include_regions.bed
+    shards_bed    = ch_genome_shards_bed          //    path: *.shards.bed
+    shards_json   = ch_genome_shards_json         //    path: *.shards.json
     bwa_index     = ch_bwa_index                  //    path: bwa/index/
     bowtie2_index = ch_bowtie2_index              //    path: bowtie2/index/
     chromap_index = ch_chromap_index              //    path: genome.index
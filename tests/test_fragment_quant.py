@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pysam
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+import fragment_quant  # noqa: E402
+
+## FOUR FRAGMENTS I.E. EIGHT INSERTIONS, SEVEN OF WHICH ARE IN 100-400
+FRAGMENTS = [("chr1", 100, 200, 1), ("chr1", 150, 300, 1), ("chr1", 250, 350, 1), ("chr1", 390, 600, 1)]
+
+
+@pytest.fixture
+def fragments_file(tmp_path):
+    tsvFile = str(tmp_path / "A.fragments.tsv")
+    with open(tsvFile, "w") as fout:
+        for fragment in FRAGMENTS:
+            fout.write("%s\t%d\t%d\t%d\n" % fragment)
+    return pysam.tabix_index(tsvFile, preset="bed", force=True)
+
+
+def run_frip(tmp_path, fragmentsFile, peaks):
+    peakFile = str(tmp_path / "peaks.bed")
+    with open(peakFile, "w") as fout:
+        for peak in peaks:
+            fout.write("chr1\t%d\t%d\n" % peak)
+    outFile = str(tmp_path / "frip.txt")
+    fragment_quant.frip(fragmentsFile, peakFile, outFile, sampleName="A")
+    with open(outFile) as fin:
+        return float(fin.read().split("\t")[1])
+
+
+def test_frip(tmp_path, fragments_file):
+    assert run_frip(tmp_path, fragments_file, [(100, 400)]) == pytest.approx(7 / 8.0)
+
+
+def test_frip_overlapping_peaks(tmp_path, fragments_file):
+    assert run_frip(tmp_path, fragments_file, [(100, 400), (120, 380), (140, 360)]) == pytest.approx(7 / 8.0)
+
+
+def test_frip_duplicated_peaks(tmp_path, fragments_file):
+    assert run_frip(tmp_path, fragments_file, [(100, 400), (100, 400)]) == pytest.approx(7 / 8.0)
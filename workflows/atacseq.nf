@@ -45,12 +45,14 @@ ch_bamtools_filter_pe_config = file(params.bamtools_filter_pe_config)
 ch_multiqc_merged_library_peak_count_header        = file("$projectDir/assets/multiqc/merged_library_peak_count_header.txt", checkIfExists: true)
 ch_multiqc_merged_library_frip_score_header        = file("$projectDir/assets/multiqc/merged_library_frip_score_header.txt", checkIfExists: true)
 ch_multiqc_merged_library_peak_annotation_header   = file("$projectDir/assets/multiqc/merged_library_peak_annotation_header.txt", checkIfExists: true)
+ch_multiqc_merged_library_peak_jaccard_header      = file("$projectDir/assets/multiqc/merged_library_peak_jaccard_header.txt", checkIfExists: true)
 ch_multiqc_merged_library_deseq2_pca_header        = file("$projectDir/assets/multiqc/merged_library_deseq2_pca_header.txt", checkIfExists: true)
 ch_multiqc_merged_library_deseq2_clustering_header = file("$projectDir/assets/multiqc/merged_library_deseq2_clustering_header.txt", checkIfExists: true)
 
 ch_multiqc_merged_replicate_peak_count_header        = file("$projectDir/assets/multiqc/merged_replicate_peak_count_header.txt", checkIfExists: true)
 ch_multiqc_merged_replicate_frip_score_header        = file("$projectDir/assets/multiqc/merged_replicate_frip_score_header.txt", checkIfExists: true)
 ch_multiqc_merged_replicate_peak_annotation_header   = file("$projectDir/assets/multiqc/merged_replicate_peak_annotation_header.txt", checkIfExists: true)
+ch_multiqc_merged_replicate_peak_jaccard_header      = file("$projectDir/assets/multiqc/merged_replicate_peak_jaccard_header.txt", checkIfExists: true)
 ch_multiqc_merged_replicate_deseq2_pca_header        = file("$projectDir/assets/multiqc/merged_replicate_deseq2_pca_header.txt", checkIfExists: true)
 ch_multiqc_merged_replicate_deseq2_clustering_header = file("$projectDir/assets/multiqc/merged_replicate_deseq2_clustering_header.txt", checkIfExists: true)
 
@@ -103,6 +105,8 @@ include { PICARD_MERGESAMFILES as PICARD_MERGESAMFILES_REPLICATE } from '../modu
 //
 include { ATAC_QC_SUMMARY     } from '../modules/local/atac_qc_summary'
 include { ATAC_PIPELINE_REPORT } from '../modules/local/atac_pipeline_report'
+include { FASTQ_PREFLIGHT     } from '../modules/local/fastq_preflight'
+include { FRAGMENT_FILE as MERGED_REPLICATE_FRAGMENT_FILE } from '../modules/local/fragment_file'
 
 //
 // SUBWORKFLOW: Consisting entirely of nf-core/modules
@@ -149,6 +153,16 @@ workflow ATACSEQ {
     // See the documentation https://nextflow-io.github.io/nf-validation/samplesheets/fromSamplesheet/
     // ! There is currently no tooling to help you write a sample sheet schema
 
+    //
+    // MODULE: Check the staged FastQ files are intact and paired, failing the run early if they are not
+    //
+    if (params.preflight) {
+        FASTQ_PREFLIGHT (
+            INPUT_CHECK.out.reads
+        )
+        ch_versions = ch_versions.mix(FASTQ_PREFLIGHT.out.versions.first())
+    }
+
     //
     // SUBWORKFLOW: Read QC and trim adapters
     //
@@ -323,10 +337,14 @@ workflow ATACSEQ {
                 [ [:], it ]
             },
         ch_bamtools_filter_se_config,
-        ch_bamtools_filter_pe_config
+        ch_bamtools_filter_pe_config,
+        params.fused_bam_filter
     )
     ch_versions = ch_versions.mix(MERGED_LIBRARY_FILTER_BAM.out.versions)
 
+    // Fragment files are only written for paired-end samples; single-end samples fall back to the BAM-based tools
+    ch_fragments_library = params.fragment_engine ? MERGED_LIBRARY_FILTER_BAM.out.fragments : Channel.empty()
+
     //
     // MODULE: Preseq coverage analysis
     //
@@ -371,8 +389,18 @@ workflow ATACSEQ {
     //
     // SUBWORKFLOW: Normalised bigWig coverage tracks
     //
+    // Create channels: [ meta, flagstat ], taking the mapped reads of PE BAM files from the bampe_rm_orphan.py JSON
+    // file so that coverage and FRiP scores do not wait for samtools flagstat
+    MERGED_LIBRARY_FILTER_BAM
+        .out
+        .flagstat
+        .filter { meta, flagstat -> meta.single_end }
+        .mix(MERGED_LIBRARY_FILTER_BAM.out.pe_stats)
+        .set { ch_flagstat_library }
+
     MERGED_LIBRARY_BAM_TO_BIGWIG (
-        MERGED_LIBRARY_FILTER_BAM.out.bam.join(MERGED_LIBRARY_FILTER_BAM.out.flagstat, by: [0]),
+        MERGED_LIBRARY_FILTER_BAM.out.bam.join(ch_flagstat_library, by: [0]),
+        ch_fragments_library,
         PREPARE_GENOME.out.chrom_sizes
     )
     ch_versions = ch_versions.mix(MERGED_LIBRARY_BAM_TO_BIGWIG.out.versions)
@@ -450,6 +478,8 @@ workflow ATACSEQ {
     //
     MERGED_LIBRARY_CALL_ANNOTATE_PEAKS (
         ch_bam_library,
+        ch_flagstat_library,
+        ch_fragments_library,
         PREPARE_GENOME.out.fasta,
         PREPARE_GENOME.out.gtf,
         PREPARE_GENOME.out.macs_gsize,
@@ -457,6 +487,7 @@ workflow ATACSEQ {
         ch_multiqc_merged_library_peak_count_header,
         ch_multiqc_merged_library_frip_score_header,
         ch_multiqc_merged_library_peak_annotation_header,
+        ch_multiqc_merged_library_peak_jaccard_header,
         params.narrow_peak,
         params.skip_peak_annotation,
         params.skip_peak_qc
@@ -474,13 +505,16 @@ workflow ATACSEQ {
         MERGED_LIBRARY_CONSENSUS_PEAKS (
             MERGED_LIBRARY_CALL_ANNOTATE_PEAKS.out.peaks,
             ch_bam_library,
+            MERGED_LIBRARY_FILTER_BAM.out.bai,
+            ch_fragments_library,
             PREPARE_GENOME.out.fasta,
             PREPARE_GENOME.out.gtf,
             ch_multiqc_merged_library_deseq2_pca_header,
             ch_multiqc_merged_library_deseq2_clustering_header,
             params.narrow_peak,
             params.skip_peak_annotation,
-            params.skip_deseq2_qc
+            params.skip_deseq2_qc,
+            params.native_counts
         )
         ch_macs2_consensus_library_bed       = MERGED_LIBRARY_CONSENSUS_PEAKS.out.consensus_bed
         ch_featurecounts_library_multiqc     = MERGED_LIBRARY_CONSENSUS_PEAKS.out.featurecounts_summary
@@ -529,6 +563,7 @@ workflow ATACSEQ {
     ch_macs2_frip_replicate_multiqc                     = Channel.empty()
     ch_macs2_peak_count_replicate_multiqc               = Channel.empty()
     ch_macs2_plot_homer_annotatepeaks_replicate_multiqc = Channel.empty()
+    ch_macs2_peak_jaccard_replicate_multiqc             = Channel.empty()
     ch_macs2_consensus_replicate_bed                    = Channel.empty()
     ch_featurecounts_replicate_multiqc                  = Channel.empty()
     ch_deseq2_pca_replicate_multiqc                     = Channel.empty()
@@ -539,20 +574,25 @@ workflow ATACSEQ {
         MERGED_LIBRARY_FILTER_BAM
             .out
             .bam
+            .join(MERGED_LIBRARY_FILTER_BAM.out.bai, by: [0])
             .map {
-                meta, bam ->
+                meta, bam, bai ->
                     def meta_clone = meta.clone()
                     meta_clone.id = meta_clone.id - ~/_REP\d+$/
                     meta_clone.control = meta_clone.control ? meta_clone.control - ~/_REP\d+$/ : ""
-                    [ meta_clone.id, meta_clone, bam ]
+                    [ meta_clone.id, meta_clone, bam, bai ]
             }
             .groupTuple()
             .map {
-                id, metas, bams ->
+                id, metas, bams, bais ->
                     if (bams.size() > 1) {
-                        return [ metas[0], bams ]
+                        return [ metas[0], bams, bais ]
                     }
             }
+            .set { ch_merged_library_replicate_bam_bai }
+
+        ch_merged_library_replicate_bam_bai
+            .map { meta, bams, bais -> [ meta, bams ] }
             .set { ch_merged_library_replicate_bam }
 
         //
@@ -585,10 +625,28 @@ workflow ATACSEQ {
         ch_markduplicates_replicate_metrics  = MERGED_REPLICATE_MARKDUPLICATES_PICARD.out.metrics
         ch_versions = ch_versions.mix(MERGED_REPLICATE_MARKDUPLICATES_PICARD.out.versions)
 
+        //
+        // MODULE: Write Tn5-shifted fragment files for merged paired-end replicates
+        //
+        ch_fragments_replicate = Channel.empty()
+        if (params.fragment_engine) {
+            MERGED_REPLICATE_FRAGMENT_FILE (
+                MERGED_REPLICATE_MARKDUPLICATES_PICARD
+                    .out
+                    .bam
+                    .join(MERGED_REPLICATE_MARKDUPLICATES_PICARD.out.bai, by: [0])
+                    .filter { meta, bam, bai -> !meta.single_end }
+            )
+            ch_fragments_replicate = MERGED_REPLICATE_FRAGMENT_FILE.out.fragments
+            ch_versions = ch_versions.mix(MERGED_REPLICATE_FRAGMENT_FILE.out.versions.first())
+        }
+
+        //
         // SUBWORKFLOW: Normalised bigWig coverage tracks
         //
         MERGED_REPLICATE_BAM_TO_BIGWIG (
             MERGED_REPLICATE_MARKDUPLICATES_PICARD.out.bam.join(MERGED_REPLICATE_MARKDUPLICATES_PICARD.out.flagstat, by: [0]),
+            ch_fragments_replicate,
             PREPARE_GENOME.out.chrom_sizes
         )
         ch_ucsc_bedgraphtobigwig_replicate_bigwig = MERGED_REPLICATE_BAM_TO_BIGWIG.out.bigwig
@@ -630,6 +688,8 @@ workflow ATACSEQ {
         //
         MERGED_REPLICATE_CALL_ANNOTATE_PEAKS (
             ch_bam_replicate,
+            MERGED_REPLICATE_MARKDUPLICATES_PICARD.out.flagstat,
+            ch_fragments_replicate,
             PREPARE_GENOME.out.fasta,
             PREPARE_GENOME.out.gtf,
             PREPARE_GENOME.out.macs_gsize,
@@ -637,6 +697,7 @@ workflow ATACSEQ {
             ch_multiqc_merged_replicate_peak_count_header,
             ch_multiqc_merged_replicate_frip_score_header,
             ch_multiqc_merged_replicate_peak_annotation_header,
+            ch_multiqc_merged_replicate_peak_jaccard_header,
             params.narrow_peak,
             params.skip_peak_annotation,
             params.skip_peak_qc
@@ -645,22 +706,44 @@ workflow ATACSEQ {
         ch_macs2_frip_replicate_multiqc                     = MERGED_REPLICATE_CALL_ANNOTATE_PEAKS.out.frip_multiqc
         ch_macs2_peak_count_replicate_multiqc               = MERGED_REPLICATE_CALL_ANNOTATE_PEAKS.out.peak_count_multiqc
         ch_macs2_plot_homer_annotatepeaks_replicate_multiqc = MERGED_REPLICATE_CALL_ANNOTATE_PEAKS.out.plot_homer_annotatepeaks_tsv
+        ch_macs2_peak_jaccard_replicate_multiqc             = MERGED_REPLICATE_CALL_ANNOTATE_PEAKS.out.peak_jaccard_multiqc
         ch_versions = ch_versions.mix(MERGED_REPLICATE_CALL_ANNOTATE_PEAKS.out.versions)
 
         //
         // SUBWORKFLOW: Consensus peaks analysis
         //
         if (!params.skip_consensus_peaks) {
+            // Create channels: [ meta, [ fragments ], [ tbi ] ]
+            ch_fragments_library
+                .map {
+                    meta, fragments, tbi ->
+                        def meta_clone = meta.clone()
+                        meta_clone.id = meta_clone.id - ~/_REP\d+$/
+                        meta_clone.control = meta_clone.control ? meta_clone.control - ~/_REP\d+$/ : ""
+                        [ meta_clone.id, meta_clone, fragments, tbi ]
+                }
+                .groupTuple()
+                .map {
+                    id, metas, fragments, tbis ->
+                        if (fragments.size() > 1) {
+                            return [ metas[0], fragments, tbis ]
+                        }
+                }
+                .set { ch_merged_library_replicate_fragments }
+
             MERGED_REPLICATE_CONSENSUS_PEAKS (
                 MERGED_REPLICATE_CALL_ANNOTATE_PEAKS.out.peaks,
                 ch_merged_library_replicate_bam,
+                ch_merged_library_replicate_bam_bai.map { meta, bams, bais -> [ meta, bais ] },
+                ch_merged_library_replicate_fragments,
                 PREPARE_GENOME.out.fasta,
                 PREPARE_GENOME.out.gtf,
                 ch_multiqc_merged_replicate_deseq2_pca_header,
                 ch_multiqc_merged_replicate_deseq2_clustering_header,
                 params.narrow_peak,
                 params.skip_peak_annotation,
-                params.skip_deseq2_qc
+                params.skip_deseq2_qc,
+                params.native_counts
             )
             ch_macs2_consensus_replicate_bed       = MERGED_REPLICATE_CONSENSUS_PEAKS.out.consensus_bed
             ch_featurecounts_replicate_multiqc     = MERGED_REPLICATE_CONSENSUS_PEAKS.out.featurecounts_summary
@@ -752,6 +835,7 @@ workflow ATACSEQ {
             MERGED_LIBRARY_CALL_ANNOTATE_PEAKS.out.frip_multiqc.collect{it[1]}.ifEmpty([]),
             MERGED_LIBRARY_CALL_ANNOTATE_PEAKS.out.peak_count_multiqc.collect{it[1]}.ifEmpty([]),
             MERGED_LIBRARY_CALL_ANNOTATE_PEAKS.out.plot_homer_annotatepeaks_tsv.collect().ifEmpty([]),
+            MERGED_LIBRARY_CALL_ANNOTATE_PEAKS.out.peak_jaccard_multiqc.collect().ifEmpty([]),
             ch_featurecounts_library_multiqc.collect{it[1]}.ifEmpty([]),
 
             ch_markduplicates_replicate_stats.collect{it[1]}.ifEmpty([]),
@@ -762,6 +846,7 @@ workflow ATACSEQ {
             ch_macs2_frip_replicate_multiqc.collect{it[1]}.ifEmpty([]),
             ch_macs2_peak_count_replicate_multiqc.collect{it[1]}.ifEmpty([]),
             ch_macs2_plot_homer_annotatepeaks_replicate_multiqc.collect().ifEmpty([]),
+            ch_macs2_peak_jaccard_replicate_multiqc.collect().ifEmpty([]),
             ch_featurecounts_replicate_multiqc.collect{it[1]}.ifEmpty([]),
 
             ch_deseq2_pca_library_multiqc.collect().ifEmpty([]),